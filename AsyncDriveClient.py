@@ -0,0 +1,157 @@
+import asyncio
+import json
+
+from authenticate import get_api_root_url_override, get_credentials
+
+DRIVE_API_URL = 'https://www.googleapis.com/drive/v3'
+
+
+class AsyncDriveError(Exception):
+    """Error response from the Drive API, carrying the HTTP status like googleapiclient's HttpError."""
+
+    def __init__(self, status, content):
+        self.status = status
+        self.content = content
+        super().__init__(f"<HttpError {status}: {content}>")
+
+    @property
+    def reason(self):
+        # The first error reason, e.g. 'userRateLimitExceeded' or 'exportSizeLimitExceeded'
+        try:
+            return json.loads(self.content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
+
+
+class AsyncDriveClient:
+    """Native asyncio client for the few Drive endpoints the sync uses.
+
+    Requests share one pooled httpx client with keep-alive (HTTP/2 when the h2 package is installed), so
+    hundreds of requests can be in flight without a thread per request.
+    """
+
+    def __init__(self, max_connections=100, base_url=None, credentials=None, timeout=60):
+        self.max_connections = max_connections
+        if base_url is None:
+            root_url = get_api_root_url_override()
+            base_url = f"{root_url}drive/v3" if root_url else DRIVE_API_URL
+        self.base_url = base_url
+        self.credentials = credentials
+        self.timeout = timeout
+        self.client = None
+        self.refresh_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("AsyncDriveClient needs httpx: pip install 'httpx[http2]'")
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+
+        if self.credentials is None:
+            self.credentials = get_credentials()
+
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        self.client = httpx.AsyncClient(http2=http2, limits=limits, timeout=self.timeout)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def get_token(self, rejected_token=None):
+        """Return a valid access token, refreshing it once for all waiting requests.
+
+        rejected_token is a token the server answered with 401; it is refreshed unless another request already did.
+        """
+        def stale():
+            credentials = self.credentials
+            return not credentials.valid or (rejected_token is not None and credentials.token == rejected_token)
+
+        if stale():
+            async with self.refresh_lock:
+                if stale():
+                    from google.auth.transport.requests import Request
+
+                    await asyncio.get_event_loop().run_in_executor(None, self.credentials.refresh, Request())
+        return self.credentials.token
+
+    async def send(self, path, params, stream=False):
+        """Send a GET request, retrying once with a fresh token on 401. Returns the open response."""
+        token = None
+        for attempt in range(2):
+            token = await self.get_token(rejected_token=token if attempt > 0 else None)
+            # Anonymous credentials (for a local endpoint) have no token
+            headers = {'Authorization': f"Bearer {token}"} if token else {}
+            # Absolute URLs, such as exportLinks, are sent as they are
+            url = path if '://' in path else f"{self.base_url}{path}"
+            request = self.client.build_request('GET', url, params=params or None, headers=headers)
+            response = await self.client.send(request, stream=stream)
+            if response.status_code == 401 and attempt == 0:
+                await response.aclose()
+                continue
+            if response.status_code >= 400:
+                content = (await response.aread()).decode('utf-8', errors='replace')
+                await response.aclose()
+                raise AsyncDriveError(response.status_code, content)
+            return response
+
+    async def list_files(self, **params):
+        """files.list; takes the same keyword arguments as service.files().list()."""
+        response = await self.send('/files', self.encode_params(params))
+        return response.json()
+
+    async def get_file(self, file_id, **params):
+        """files.get for metadata; takes the same keyword arguments as service.files().get()."""
+        response = await self.send(f"/files/{file_id}", self.encode_params(params))
+        return response.json()
+
+    async def get_media(self, file_id, fh, progress=None, **params):
+        """Stream the content of a binary file into the writable file object fh. Returns bytes written.
+
+        progress, if given, is called with the size of each chunk as it is written.
+        """
+        params = dict(params, alt='media', supportsAllDrives=True)
+        return await self.stream_to(f"/files/{file_id}", params, fh, progress)
+
+    async def export_media(self, file_id, mime_type, fh, progress=None):
+        """Stream a Google-native document exported as mime_type into fh. Returns bytes written."""
+        return await self.stream_to(f"/files/{file_id}/export", {'mimeType': mime_type}, fh, progress)
+
+    async def get_url(self, url, fh, progress=None):
+        """Stream an absolute URL from a file resource, such as one of its exportLinks, into fh."""
+        return await self.stream_to(url, {}, fh, progress)
+
+    async def stream_to(self, path, params, fh, progress=None):
+        response = await self.send(path, self.encode_params(params), stream=True)
+        written = 0
+        try:
+            async for chunk in response.aiter_bytes():
+                fh.write(chunk)
+                written += len(chunk)
+                if progress is not None:
+                    progress(len(chunk))
+        finally:
+            await response.aclose()
+        return written
+
+    @staticmethod
+    def encode_params(params):
+        # Drop unset values and send booleans the way the REST API expects them
+        encoded = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            encoded[key] = ('true' if value else 'false') if isinstance(value, bool) else value
+        return encoded
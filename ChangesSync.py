@@ -0,0 +1,280 @@
+import asyncio
+import json
+import os
+
+from authenticate import get_service
+from FolderFilesFetcher import FolderFilesFetcher
+from RecursiveFolderFetcher import RecursiveFolderFetcher
+from SyncManifest import SyncManifest
+from drive_query import DriveQuery
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class ChangesSync:
+    """Keeps the local sync folder up to date using the Drive Changes feed instead of full re-crawls."""
+
+    def __init__(self, root_folder_id, file_downloader, state_file='sync_state.json', service=None,
+                 max_concurrent_calls=20, client=None, index=None, query=None, excluded_folders=()):
+        self.root_folder_id = root_folder_id
+        self.file_downloader = file_downloader
+        self.state_file = state_file
+        self.service = service  # Any object exposing changes()/files() like the Drive service, e.g. a fake
+        self.max_concurrent_calls = max_concurrent_calls
+        self.client = client  # Optional AsyncDriveClient passed on to the fetchers crawling new folders
+        self.index = index  # Optional MetadataIndex kept up to date with the changes
+
+        # Persisted state: changes page token, tracked folders and the files downloaded from them
+        self.start_page_token = None
+        self.folders = {}  # folder id -> {"name": ..., "parent": ...}
+        self.files = {}  # file id -> {"name": ..., "mime_type": ..., "parent": ..., "path": ...}
+        self.file_metadata = {}  # file id -> listing fields of files to download this run
+        self.pending = {}  # file id -> listing fields of tracked files whose download failed, retried next run
+
+        # Listing filters and excluded subtrees of the full sync. They are saved with the state, so changes and
+        # new folders are filtered the same way; other filters than the saved ones need a new full sync.
+        self.query = query or DriveQuery()
+        self.excluded_folders = list(excluded_folders)
+
+    def get_service(self):
+        # An injected service (e.g. a fake) wins over the calling thread's shared service
+        return self.service if self.service is not None else get_service()
+
+    def has_state(self):
+        return os.path.exists(self.state_file)
+
+    def load_state(self):
+        with open(self.state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('root_folder_id', self.root_folder_id) != self.root_folder_id:
+            raise ValueError(f"{self.state_file} is the state of root folder {state['root_folder_id']}, not "
+                             f"{self.root_folder_id}; run a full sync to switch folders")
+        # State files from before the filters were saved were written by unfiltered full syncs
+        saved = {'filters': state.get('filters', DriveQuery().settings()),
+                 'excluded_folders': state.get('excluded_folders', [])}
+        if saved != {'filters': self.query.settings(), 'excluded_folders': self.excluded_folders}:
+            raise ValueError(f"Listing filters differ from those of the last full sync in {self.state_file}; "
+                             "run a full sync to apply them")
+        self.start_page_token = state['start_page_token']
+        self.folders = state.get('folders', {})
+        self.files = state.get('files', {})
+        self.pending = state.get('pending', {})
+
+    def save_state(self):
+        # Write to a temporary file first so a crash never leaves a truncated state file behind
+        state = {
+            'root_folder_id': self.root_folder_id,
+            'start_page_token': self.start_page_token,
+            'folders': self.folders,
+            'files': self.files,
+            'pending': self.pending,
+            'filters': self.query.settings(),
+            'excluded_folders': self.excluded_folders,
+        }
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def get_start_page_token(self):
+        """Fetch the current changes token. Call this before a full crawl so no change is missed."""
+        response = self.get_service().changes().getStartPageToken(supportsAllDrives=True).execute()
+        return response['startPageToken']
+
+    def record_full_sync(self, start_page_token, folder_fetcher, file_fetcher, failed_ids=None):
+        """Save the token and the tree seen by a full crawl, so the next run can sync incrementally.
+
+        failed_ids are the files whose download failed, by default those of the file downloader; they are
+        downloaded again by the next incremental run even if they didn't change.
+        """
+        self.start_page_token = start_page_token
+        self.folders = {
+            folder_id: {'name': folder_name, 'parent': folder_fetcher.folder_parents.get(folder_id)}
+            for folder_id, folder_name in folder_fetcher.all_folders
+        }
+        self.files = {}
+        for file_name, file_id, mime_type, _ in file_fetcher.final_file_list:
+            self.track_file(file_id, file_name, mime_type, file_fetcher.file_parents.get(file_id))
+        if failed_ids is None:
+            failed_ids = [entry[1] for entry in self.file_downloader.failed_files]
+        self.pending = {file_id: file_fetcher.file_metadata.get(file_id) or {}
+                        for file_id in failed_ids if file_id in self.files}
+        self.save_state()
+
+    def track_file(self, file_id, file_name, mime_type, parent_id):
+        self.files[file_id] = {
+            'name': file_name,
+            'mime_type': mime_type,
+            'parent': parent_id,
+            'path': self.file_downloader.get_file_path(file_name, file_id, mime_type),
+        }
+
+    def is_tracked_folder(self, folder_id):
+        return folder_id == self.root_folder_id or folder_id in self.folders
+
+    def fetch_changes(self):
+        """Read every change since the saved token. Returns (changes, new_start_page_token)."""
+        service = self.get_service()
+        page_token = self.start_page_token
+        changes = []
+        file_fields = f"parents, trashed, {SyncManifest.LISTING_FIELDS}"
+        if self.query.owner:
+            # Owners are only needed to check an owner filter
+            file_fields += ", owners(emailAddress)"
+
+        while True:
+            results = service.changes().list(
+                pageToken=page_token,
+                pageSize=1000,
+                includeRemoved=True,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+                fields=f"nextPageToken, newStartPageToken, changes(changeType, removed, fileId, file({file_fields}))"
+            ).execute()
+
+            changes.extend(results.get('changes', []))
+
+            if 'newStartPageToken' in results:
+                return changes, results['newStartPageToken']
+            page_token = results['nextPageToken']
+
+    def remove_folder(self, folder_id):
+        """Stop tracking a folder and everything below it, deleting the local copies of its files.
+
+        Returns the ids of the folders and files that were removed.
+        """
+        removed = {folder_id}
+        pending = [folder_id]
+        while pending:
+            current = pending.pop()
+            for child_id, child in list(self.folders.items()):
+                if child['parent'] == current and child_id not in removed:
+                    removed.add(child_id)
+                    pending.append(child_id)
+
+        for removed_id in removed:
+            self.folders.pop(removed_id, None)
+        removed_files = [file_id for file_id, entry in self.files.items() if entry['parent'] in removed]
+        for file_id in removed_files:
+            self.remove_file(file_id)
+        return list(removed) + removed_files
+
+    def remove_file(self, file_id):
+        entry = self.files.pop(file_id, None)
+        if self.file_downloader.manifest is not None:
+            self.file_downloader.manifest.remove(file_id)
+        if entry and os.path.exists(entry['path']):
+            os.remove(entry['path'])
+            print(f"Removed: {os.path.basename(entry['path'])}")
+
+    def apply_change(self, change, to_download, new_folders):
+        """Apply a single change entry to the tracked tree. Downloads and new subtrees are collected by the caller."""
+        if change.get('changeType', 'file') != 'file':
+            return
+
+        file_id = change['fileId']
+        item = change.get('file')
+
+        # Deleted or trashed items
+        if change.get('removed') or not item or item.get('trashed'):
+            removed_ids = [file_id]
+            if file_id in self.folders:
+                # Everything below a trashed or deleted folder goes with it
+                removed_ids = self.remove_folder(file_id)
+            elif file_id in self.files:
+                self.remove_file(file_id)
+            if self.index is not None:
+                self.index.mark_trashed(removed_ids)
+            return
+
+        if self.index is not None:
+            self.index.add_items([item])
+
+        parents = item.get('parents', [])
+        parent_id = next((parent for parent in parents if self.is_tracked_folder(parent)), None)
+
+        if item['mimeType'] == FOLDER_MIME_TYPE:
+            if parent_id is None:
+                # Moved out of the synced tree
+                if file_id in self.folders:
+                    self.remove_folder(file_id)
+            elif file_id in self.folders:
+                # Renamed or moved within the tree
+                self.folders[file_id] = {'name': item['name'], 'parent': parent_id}
+            elif file_id != self.root_folder_id and file_id not in self.excluded_folders:
+                # Created in, or moved into, the tree. Its existing contents have to be crawled.
+                self.folders[file_id] = {'name': item['name'], 'parent': parent_id}
+                new_folders.append((file_id, item['name']))
+            return
+
+        # Files directly in the root folder are not synced, matching the full crawl
+        in_scope = parent_id is not None and parent_id != self.root_folder_id and self.query.accepts(item)
+        if not in_scope:
+            if file_id in self.files:
+                self.remove_file(file_id)
+            return
+
+        # Added or edited; a rename changes the local path, so drop the old copy first
+        new_path = self.file_downloader.get_file_path(item['name'], file_id, item['mimeType'])
+        old_entry = self.files.get(file_id)
+        if old_entry and old_entry['path'] != new_path:
+            self.remove_file(file_id)
+        self.track_file(file_id, item['name'], item['mimeType'], parent_id)
+        self.file_metadata[file_id] = item
+        to_download[file_id] = (item['name'], file_id, item['mimeType'], self.folders[parent_id]['name'])
+
+    async def crawl_new_folders(self, new_folders, to_download):
+        """Crawl folders that entered the tree, the same way a full sync would."""
+        folder_fetcher = RecursiveFolderFetcher(max_concurrent_calls=self.max_concurrent_calls, client=self.client,
+                                                index=self.index, excluded_folders=self.excluded_folders)
+        for folder_id, _ in new_folders:
+            await folder_fetcher.fetch_all_folders(folder_id)
+
+        for folder_id, folder_name in folder_fetcher.all_folders:
+            self.folders[folder_id] = {'name': folder_name, 'parent': folder_fetcher.folder_parents.get(folder_id)}
+
+        file_fetcher = FolderFilesFetcher(folder_ids=new_folders + folder_fetcher.all_folders,
+                                          max_concurrent_calls=self.max_concurrent_calls, client=self.client,
+                                          index=self.index, query=self.query)
+        await file_fetcher.fetch_all_files()
+        for file_item in file_fetcher.final_file_list:
+            file_name, file_id, mime_type, _ = file_item
+            self.track_file(file_id, file_name, mime_type, file_fetcher.file_parents.get(file_id))
+            to_download[file_id] = file_item
+        self.file_metadata.update(file_fetcher.file_metadata)
+
+    async def sync_changes(self):
+        """Apply all changes since the last run to the local sync folder and save the new token."""
+        self.load_state()
+
+        changes, new_start_page_token = await asyncio.get_event_loop().run_in_executor(None, self.fetch_changes)
+        print(f"Changes since last sync: {len(changes)}")
+
+        to_download = {}
+        new_folders = []
+        for change in changes:
+            self.apply_change(change, to_download, new_folders)
+
+        if new_folders:
+            print(f"Crawling {len(new_folders)} new folders...")
+            await self.crawl_new_folders(new_folders, to_download)
+
+        # Downloads that failed before are retried, unless a change already brought the file in
+        for file_id, metadata in self.pending.items():
+            entry = self.files.get(file_id)
+            if entry is not None and file_id not in to_download:
+                folder_name = self.folders.get(entry['parent'], {}).get('name')
+                to_download[file_id] = (entry['name'], file_id, entry['mime_type'], folder_name)
+                self.file_metadata[file_id] = metadata
+
+        # Files whose folder was removed later in the same batch must not be downloaded
+        file_list = [file_item for file_id, file_item in to_download.items() if file_id in self.files]
+        failed_seen = len(self.file_downloader.failed_files)
+        if file_list:
+            await self.file_downloader.download_all_files_async(file_list, self.file_metadata)
+        self.pending = {entry[1]: self.file_metadata.get(entry[1]) or {}
+                        for entry in self.file_downloader.failed_files[failed_seen:] if entry[1] in self.files}
+
+        self.start_page_token = new_start_page_token
+        self.save_state()
+        return file_list
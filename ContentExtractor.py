@@ -0,0 +1,241 @@
+import json
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+# OOXML namespaces
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DRAWING_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+CORE_PROPERTIES = {
+    '{http://purl.org/dc/elements/1.1/}title': 'title',
+    '{http://purl.org/dc/elements/1.1/}creator': 'author',
+    '{http://schemas.openxmlformats.org/package/2006/metadata/core-properties}lastModifiedBy': 'last_modified_by',
+    '{http://purl.org/dc/terms/}created': 'created',
+    '{http://purl.org/dc/terms/}modified': 'modified',
+}
+
+TEXT_EXTENSIONS = ('.txt', '.json', '.csv', '.md', '.html')
+
+
+def numbered(names, pattern):
+    # slide10.xml sorts after slide9.xml
+    matches = [(int(match.group(1)), name) for name in names for match in [re.fullmatch(pattern, name)] if match]
+    return [name for _, name in sorted(matches)]
+
+
+def core_properties(archive):
+    properties = {}
+    if 'docProps/core.xml' in archive.namelist():
+        for element in ElementTree.fromstring(archive.read('docProps/core.xml')):
+            if element.tag in CORE_PROPERTIES and element.text:
+                properties[CORE_PROPERTIES[element.tag]] = element.text
+    return properties
+
+
+def extract_docx(archive):
+    root = ElementTree.fromstring(archive.read('word/document.xml'))
+    paragraphs = [''.join(node.text or '' for node in paragraph.iter(f'{WORD_NS}t'))
+                  for paragraph in root.iter(f'{WORD_NS}p')]
+    return '\n'.join(paragraphs), {'paragraphs': len(paragraphs)}
+
+
+def extract_xlsx(archive):
+    shared_strings = []
+    if 'xl/sharedStrings.xml' in archive.namelist():
+        for item in ElementTree.fromstring(archive.read('xl/sharedStrings.xml')).iter(f'{SHEET_NS}si'):
+            shared_strings.append(''.join(node.text or '' for node in item.iter(f'{SHEET_NS}t')))
+
+    # Sheet names in workbook order, resolved to their parts through the workbook's relationships
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {relationship.get('Id'): relationship.get('Target') for relationship in relationships}
+    sheets = []
+    for sheet in workbook.iter(f'{SHEET_NS}sheet'):
+        target = targets.get(sheet.get(f'{RELATIONSHIP_NS}id'), '')
+        sheets.append((sheet.get('name'), target.lstrip('/') if target.startswith('/xl/') else f'xl/{target}'))
+
+    lines = []
+    for name, part in sheets:
+        lines.append(f'# {name}')
+        for row in ElementTree.fromstring(archive.read(part)).iter(f'{SHEET_NS}row'):
+            values = []
+            for cell in row.iter(f'{SHEET_NS}c'):
+                if cell.get('t') == 'inlineStr':
+                    values.append(''.join(node.text or '' for node in cell.iter(f'{SHEET_NS}t')))
+                    continue
+                value = cell.find(f'{SHEET_NS}v')
+                if value is None or value.text is None:
+                    values.append('')
+                elif cell.get('t') == 's':
+                    values.append(shared_strings[int(value.text)])
+                else:
+                    values.append(value.text)
+            lines.append('\t'.join(values))
+    return '\n'.join(lines), {'sheets': [name for name, _ in sheets]}
+
+
+def extract_pptx(archive):
+    slides = numbered(archive.namelist(), r'ppt/slides/slide(\d+)\.xml')
+    texts = []
+    for slide in slides:
+        root = ElementTree.fromstring(archive.read(slide))
+        texts.append('\n'.join(''.join(node.text or '' for node in paragraph.iter(f'{DRAWING_NS}t'))
+                               for paragraph in root.iter(f'{DRAWING_NS}p')))
+    return '\n\n'.join(texts), {'slides': len(slides)}
+
+
+def extract_pdf(file_path):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ImportError("PDF extraction needs pypdf: pip install pypdf")
+
+    reader = PdfReader(file_path)
+    properties = {'pages': len(reader.pages)}
+    info = reader.metadata or {}
+    for key, name in (('/Title', 'title'), ('/Author', 'author')):
+        if info.get(key):
+            properties[name] = str(info[key])
+    return '\n\n'.join(page.extract_text() or '' for page in reader.pages), properties
+
+
+OOXML_EXTRACTORS = {'.docx': extract_docx, '.xlsx': extract_xlsx, '.pptx': extract_pptx}
+
+
+def is_supported(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    return extension in OOXML_EXTRACTORS or extension == '.pdf' or extension in TEXT_EXTENSIONS
+
+
+def extract_file(file_path):
+    """Plain text and basic properties of a synced file, by extension. Runs in the extractor's worker processes.
+
+    Returns (text, properties), or None for unsupported file types.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in OOXML_EXTRACTORS:
+        with zipfile.ZipFile(file_path) as archive:
+            text, properties = OOXML_EXTRACTORS[extension](archive)
+            properties.update(core_properties(archive))
+    elif extension == '.pdf':
+        text, properties = extract_pdf(file_path)
+    elif extension in TEXT_EXTENSIONS:
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            text, properties = f.read(), {}
+    else:
+        return None
+    properties['characters'] = len(text)
+    return text, properties
+
+
+class ContentExtractor:
+    """Extracts plain text and properties of synced files in a process pool, while downloads continue.
+
+    FileDownloader submits each file as it is synced. Parsing runs in worker processes, so it overlaps with
+    the network I/O instead of competing with it for the GIL. Results are written to output_folder as
+    <file name>.txt and <file name>.json, and to the MetadataIndex when one is given. A file is only extracted
+    again when its checksum (or version, for exports) differs from the last extraction recorded in state_file.
+    """
+
+    def __init__(self, output_folder, index=None, workers=None, state_file='extraction_state.json'):
+        self.output_folder = output_folder
+        self.index = index
+        self.state_file = state_file
+        self.state = {}  # file id -> {"key", "path"} of the last extraction
+        self.stats = {'extracted': 0, 'skipped': 0, 'unsupported': 0, 'failed': 0}
+        self.lock = threading.Lock()  # Files are submitted from download threads, results land on pool threads
+        # Spawned workers don't inherit the downloader's threads and locks
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def load(self):
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def save(self):
+        with self.lock:
+            tmp_file = f"{self.state_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_file, self.state_file)
+
+    @staticmethod
+    def content_key(metadata, file_path):
+        # The listed checksum, or the version of exports; local files without a listing use size and mtime
+        metadata = metadata or {}
+        if metadata.get('md5Checksum'):
+            return f"md5:{metadata['md5Checksum']}"
+        if metadata.get('version'):
+            return f"version:{metadata['version']}"
+        stat = os.stat(file_path)
+        return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def output_path(self, file_path, extension):
+        return os.path.join(self.output_folder, f"{os.path.basename(file_path)}{extension}")
+
+    def submit(self, file_id, file_path, metadata=None):
+        """Queue a synced file for extraction, unless this content was already extracted to the same path."""
+        if not is_supported(file_path):
+            with self.lock:
+                self.stats['unsupported'] += 1
+            return
+        key = self.content_key(metadata, file_path)
+        with self.lock:
+            previous = self.state.get(file_id)
+            if previous and previous['key'] == key and previous['path'] == file_path and \
+                    os.path.exists(self.output_path(file_path, '.txt')):
+                self.stats['skipped'] += 1
+                return
+        future = self.pool.submit(extract_file, file_path)
+        future.add_done_callback(lambda future: self.store(future, file_id, file_path, key))
+
+    def store(self, future, file_id, file_path, key):
+        try:
+            text, properties = future.result()
+            properties.update(file_id=file_id, path=file_path, content_key=key)
+
+            os.makedirs(self.output_folder, exist_ok=True)
+            for extension, content in (('.txt', text), ('.json', json.dumps(properties, indent=2))):
+                output_path = self.output_path(file_path, extension)
+                with open(f"{output_path}.tmp", 'w', encoding='utf-8') as f:
+                    f.write(content)
+                os.replace(f"{output_path}.tmp", output_path)
+            if self.index is not None:
+                self.index.set_content(file_id, key, text, properties)
+
+            with self.lock:
+                self.state[file_id] = {'key': key, 'path': file_path}
+                self.stats['extracted'] += 1
+        except Exception as e:
+            print(f"Failed to extract {os.path.basename(file_path)}: {e}")
+            with self.lock:
+                self.stats['failed'] += 1
+
+    def close(self):
+        """Wait for the queued extractions and their results, then save the state."""
+        self.pool.shutdown(wait=True)
+        self.save()
+        print(f"Content extraction: {self.stats}")
+
+
+# Example usage
+if __name__ == '__main__':
+    import sys
+
+    # Extract every file given on the command line
+    with ContentExtractor(output_folder='./extracted') as extractor:
+        for path in sys.argv[1:]:
+            extractor.submit(path, path)
@@ -0,0 +1,83 @@
+import os
+import shutil
+
+# ioctl request for reflink copies on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+class ContentStore:
+    """Content-addressed store of downloaded blobs, keyed by md5Checksum and size.
+
+    Each unique blob is kept once; every copy in the sync folder is a hardlink to it, or a reflink or plain
+    copy when hardlinks aren't possible. A blob no file links to any more is removed by collect_garbage().
+    """
+
+    def __init__(self, store_folder):
+        self.store_folder = store_folder
+
+    def blob_path(self, metadata):
+        """Return the store path for a file's content, or None when the listing has no checksum."""
+        if not metadata or not metadata.get('md5Checksum') or metadata.get('size') is None:
+            return None
+        md5_checksum = metadata['md5Checksum']
+        return os.path.join(self.store_folder, md5_checksum[:2], f"{md5_checksum}-{metadata['size']}")
+
+    def has(self, blob_path):
+        return blob_path is not None and os.path.exists(blob_path)
+
+    def add(self, file_path, blob_path):
+        """Record a freshly downloaded file as the blob for its content."""
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if not os.path.exists(blob_path):
+            self.link(file_path, blob_path)
+
+    def materialize(self, blob_path, file_path):
+        """Create file_path from a stored blob without downloading it."""
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        self.link(blob_path, file_path)
+
+    def collect_garbage(self):
+        """Remove the blobs no file in the sync folder links to any more. Run it while no downloads are going on.
+
+        A blob whose only link is its store entry belonged to files that were deleted or replaced since. Blobs
+        stored as reflinks or copies always look unreferenced, so on such filesystems the store only lasts a run.
+        """
+        removed = freed = 0
+        if not os.path.isdir(self.store_folder):
+            return removed, freed
+        for prefix in os.listdir(self.store_folder):
+            folder = os.path.join(self.store_folder, prefix)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                blob_path = os.path.join(folder, name)
+                stat = os.stat(blob_path)
+                if stat.st_nlink == 1:
+                    os.remove(blob_path)
+                    removed += 1
+                    freed += stat.st_size
+            if not os.listdir(folder):
+                os.rmdir(folder)
+        if removed:
+            print(f"Content store: removed {removed} unreferenced blobs, {freed} bytes")
+        return removed, freed
+
+    @staticmethod
+    def link(source, destination):
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+
+        # Hardlinks fail across filesystems; try a reflink, then fall back to a copy
+        try:
+            import fcntl
+
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        shutil.copyfile(source, destination)
@@ -0,0 +1,144 @@
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+GOOGLE_NATIVE_PREFIX = 'application/vnd.google-apps.'
+
+POLICIES = ('listing', 'smallest_first', 'largest_first', 'folder_priority', 'fair')
+
+
+class DownloadScheduler:
+    """Runs a FileDownloader's downloads in a chosen order, in separate lanes for exports and binary files.
+
+    Google-native documents are exported and binary files are downloaded; the two hit different server-side
+    limits, so each lane has its own workers and a slow batch of exports can't hold every slot. Within a
+    lane, files are taken from a priority queue ordered by the policy:
+
+    - 'listing': listing order, as download_all_files_async does
+    - 'smallest_first': many small files finish early
+    - 'largest_first': large files start early, which shortens the tail of the run
+    - 'folder_priority': by folder_priorities (folder id or name -> number, lower first), then listing order
+    - 'fair': round-robin across folders (or the groups given by file_groups), so no single folder hogs a lane
+
+    Workers pull one file at a time, so tasks are only created for files that are actually downloading.
+    """
+
+    def __init__(self, file_downloader, policy='smallest_first', export_workers=4, binary_workers=12,
+                 folder_priorities=None, file_groups=None, default_priority=100):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, expected one of {', '.join(POLICIES)}")
+        self.file_downloader = file_downloader
+        self.policy = policy
+        self.lane_workers = {'export': export_workers, 'binary': binary_workers}
+        self.folder_priorities = folder_priorities or {}
+        self.file_groups = file_groups or {}  # file id -> folder or root id, for 'folder_priority' and 'fair'
+        self.default_priority = default_priority
+        self.lanes = None  # lane name -> asyncio.PriorityQueue, while running
+        self.sequence = itertools.count()  # Listing order, the tie-breaker of every policy
+        self.group_counts = {}  # group -> files added so far, for 'fair'
+
+    @staticmethod
+    def top_level_groups(file_parents, folder_parents, root_folder_id):
+        """Map file id -> the folder directly under root_folder_id that contains it, to interleave across roots."""
+        top_level = {}
+
+        def top_of(folder_id):
+            path = []
+            while folder_id not in top_level and folder_parents.get(folder_id) not in (None, root_folder_id):
+                path.append(folder_id)
+                folder_id = folder_parents[folder_id]
+            top = top_level.get(folder_id, folder_id)
+            for folder in path + [folder_id]:
+                top_level[folder] = top
+            return top
+
+        return {file_id: top_of(folder_id) for file_id, folder_id in file_parents.items()}
+
+    def lane(self, mime_type):
+        return 'export' if mime_type.startswith(GOOGLE_NATIVE_PREFIX) else 'binary'
+
+    def priority(self, file_id, folder_name, metadata, sequence):
+        """Sort key of a file under the policy; smaller runs first."""
+        size = (metadata or {}).get('size')
+        size = int(size) if size is not None else 0  # Exports have no size and keep listing order
+        group = self.file_groups.get(file_id, folder_name)
+
+        if self.policy == 'smallest_first':
+            return size, sequence
+        if self.policy == 'largest_first':
+            return -size, sequence
+        if self.policy == 'folder_priority':
+            priority = self.folder_priorities.get(group, self.folder_priorities.get(folder_name,
+                                                                                    self.default_priority))
+            return priority, sequence
+        if self.policy == 'fair':
+            # The n-th file of every group comes before the (n+1)-th file of any group
+            rank = self.group_counts.get(group, 0)
+            self.group_counts[group] = rank + 1
+            return rank, sequence
+        return (sequence,)
+
+    def add(self, file_item, metadata=None):
+        """Queue a (file_name, file_id, mime_type[, folder_name]) item; call between start() and close()."""
+        file_name, file_id, mime_type = file_item[:3]
+        folder_name = file_item[3] if len(file_item) > 3 else None
+        sequence = next(self.sequence)
+        # Files sort before the end-of-work markers (1,) that close() adds
+        self.lanes[self.lane(mime_type)].put_nowait(
+            (0, self.priority(file_id, folder_name, metadata, sequence), (file_name, file_id, mime_type, metadata))
+        )
+
+    async def worker(self, lane, executor, semaphore):
+        queue = self.lanes[lane]
+        while True:
+            entry = await queue.get()
+            if entry[0] == 1:
+                return
+            file_name, file_id, mime_type, metadata = entry[2]
+            await self.file_downloader.download_file_async(file_name, file_id, mime_type, semaphore, metadata,
+                                                           executor)
+
+    def start(self, executor):
+        """Create the lanes and their workers. Returns the worker tasks."""
+        self.lanes = {lane: asyncio.PriorityQueue() for lane in self.lane_workers}
+        # The lane's workers already bound its concurrency; the semaphore is what download_file_async expects
+        semaphores = {lane: asyncio.Semaphore(workers) for lane, workers in self.lane_workers.items()}
+        return [asyncio.ensure_future(self.worker(lane, executor, semaphores[lane]))
+                for lane, workers in self.lane_workers.items() for _ in range(workers)]
+
+    def close(self):
+        """Let the workers finish once their lane is empty."""
+        for lane, workers in self.lane_workers.items():
+            for _ in range(workers):
+                self.lanes[lane].put_nowait((1,))
+
+    async def run(self, file_list, file_metadata=None):
+        """Download file_list in policy order, like FileDownloader.download_all_files_async."""
+        file_metadata = file_metadata or {}
+        max_workers = sum(self.lane_workers.values())
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download') as executor:
+            self.file_downloader.open_progress_bar()
+            try:
+                workers = self.start(executor)
+                for file_item in file_list:
+                    self.add(file_item, file_metadata.get(file_item[1]))
+                self.close()
+                await asyncio.gather(*workers)
+            finally:
+                self.file_downloader.close_progress_bar()
+                self.lanes = None
+        self.file_downloader.finish_downloads()
+
+
+# Example usage
+if __name__ == '__main__':
+    from FileDownloader import FileDownloader
+    from FileFetcher import FileFetcher
+    from authenticate import get_service
+
+    file_fetcher = FileFetcher(get_service())
+    file_list = file_fetcher.list_all_files()
+
+    # Large binary files first, with exports in their own lane
+    scheduler = DownloadScheduler(FileDownloader(sync_folder='./guidelines'), policy='largest_first')
+    asyncio.run(scheduler.run(file_list, file_fetcher.file_metadata))
@@ -0,0 +1,273 @@
+import asyncio
+import os
+import queue
+import threading
+
+# Chunk sizes are kept to multiples of this, like the API's own upload and download chunks
+CHUNK_ALIGNMENT = 256 * 1024
+
+
+def preallocate(fd, size):
+    # Reserve the blocks up front, so the file isn't fragmented and a full disk fails before the download
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+def fsync_directory(path):
+    # Makes a rename inside the directory durable; not possible on every platform
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class ChunkSizer:
+    """Chooses the bytes per download request from the measured throughput of recent requests.
+
+    Requests are sized to take about target_seconds each: fast connections get large chunks and few round
+    trips, slow ones small chunks that still report progress and retry cheaply.
+    """
+
+    def __init__(self, initial=4 * 1024 * 1024, minimum=CHUNK_ALIGNMENT, maximum=64 * 1024 * 1024,
+                 target_seconds=1.0, smoothing=0.3):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing  # Weight of the newest measurement in the moving average
+        self.throughput = None  # Bytes per second of a single request
+        self.lock = threading.Lock()
+
+    def record(self, byte_count, seconds):
+        if byte_count <= 0 or seconds <= 0:
+            return
+        rate = byte_count / seconds
+        with self.lock:
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = self.smoothing * rate + (1 - self.smoothing) * self.throughput
+
+    def chunk_size(self):
+        with self.lock:
+            throughput = self.throughput
+        if throughput is None:
+            return self.initial
+        size = min(max(int(throughput * self.target_seconds), self.minimum), self.maximum)
+        return max(size // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT, CHUNK_ALIGNMENT)
+
+
+class BufferPool:
+    """Reusable write buffers. Acquiring waits while all of them are queued for the disk, which bounds memory.
+
+    Each open sink holds one partly filled buffer, so count must exceed the number of downloads at once.
+    """
+
+    def __init__(self, buffer_size=256 * 1024, count=64):
+        self.buffer_size = buffer_size
+        self.available = threading.Semaphore(count)
+        self.free = []  # Buffers are allocated on first use and then reused
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.available.acquire()
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        with self.lock:
+            self.free.append(buffer)
+        self.available.release()
+
+
+class DiskWriter:
+    """Writes filled buffers to their files on dedicated threads, so network threads don't wait on the disk."""
+
+    def __init__(self, threads=2):
+        self.thread_count = threads
+        self.jobs = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, sink, buffer, length, offset):
+        if len(self.threads) < self.thread_count:
+            with self.lock:
+                while len(self.threads) < self.thread_count:
+                    thread = threading.Thread(target=self.run, name=f"disk-writer-{len(self.threads)}", daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        self.jobs.put((sink, buffer, length, offset))
+
+    def run(self):
+        while True:
+            sink, buffer, length, offset = self.jobs.get()
+            error = None
+            try:
+                view = memoryview(buffer)[:length]
+                while view:
+                    written = os.pwrite(sink.fd, view, offset)
+                    view = view[written:]
+                    offset += written
+            except OSError as e:
+                error = e
+            finally:
+                sink.written(buffer, error)
+
+
+class DownloadSink:
+    """Writable file object that downloads write into, in place of io.FileIO.
+
+    Data goes to file_path.part: writes are copied into pooled buffers and written by the DiskWriter's
+    threads, and the file is preallocated when its size is known. Closing without an error waits for the
+    writes, fsyncs and renames the .part file over file_path; an error removes it. A partial download
+    never appears under the final name, and an existing copy stays in place until the new one is complete.
+
+    Writers on an event loop pass pooled=False, so write() allocates its buffers instead of waiting for a
+    pooled one, and use `async with`, which waits for the writer and fsyncs in the default executor.
+    """
+
+    def __init__(self, file_path, size=None, writer=None, pool=None, fsync=True, pooled=True,
+                 buffer_size=256 * 1024):
+        self.file_path = file_path
+        self.part_path = f"{file_path}.part"
+        self.size = size  # Expected length, checked on commit; None for exports
+        self.writer = writer or DiskWriter(threads=1)
+        self.pool = (pool or BufferPool(count=4)) if pooled else None
+        self.buffer_size = self.pool.buffer_size if self.pool is not None else buffer_size
+        self.fsync = fsync
+        self.fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        if size:
+            preallocate(self.fd, size)
+        self.position = 0  # Bytes accepted so far
+        self.buffer = None  # Buffer being filled, and the file offset its first byte goes to
+        self.buffer_offset = 0
+        self.filled = 0
+        self.pending = 0  # Buffers queued for the writer
+        self.error = None
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.commit()
+        except BaseException:
+            self.abort()
+            raise
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # Waiting for the disk writer, fsync and rename would stall every download on the loop
+        await asyncio.get_running_loop().run_in_executor(None, self.__exit__, exc_type, exc_value, traceback)
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        view = memoryview(data).cast('B')
+        while view:
+            if self.buffer is None:
+                self.buffer = self.pool.acquire() if self.pool is not None else bytearray(self.buffer_size)
+                self.buffer_offset = self.position
+                self.filled = 0
+            count = min(len(view), len(self.buffer) - self.filled)
+            self.buffer[self.filled:self.filled + count] = view[:count]
+            self.filled += count
+            self.position += count
+            view = view[count:]
+            if self.filled == len(self.buffer):
+                self.flush_buffer()
+        return len(data)
+
+    def flush_buffer(self):
+        buffer, self.buffer = self.buffer, None
+        if buffer is None:
+            return
+        if not self.filled:
+            self.release(buffer)
+            return
+        with self.condition:
+            self.pending += 1
+        self.writer.submit(self, buffer, self.filled, self.buffer_offset)
+
+    def release(self, buffer):
+        if self.pool is not None:
+            self.pool.release(buffer)
+
+    def written(self, buffer, error):
+        # Called by the writer thread once a buffer is on disk
+        self.release(buffer)
+        with self.condition:
+            self.pending -= 1
+            if error is not None and self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def flush(self):
+        """Wait until everything written so far is in the file."""
+        self.flush_buffer()
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+        if self.error is not None:
+            raise self.error
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise ValueError("DownloadSink only seeks to absolute offsets")
+        self.flush()
+        self.position = offset
+        return offset
+
+    def truncate(self, size=None):
+        self.flush()
+        size = self.position if size is None else size
+        os.ftruncate(self.fd, size)
+        return size
+
+    def commit(self):
+        self.flush()
+        if self.size is not None and self.position != self.size:
+            raise IOError(f"Expected {self.size} bytes for {self.file_path}, received {self.position}")
+        if self.fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.part_path, self.file_path)
+        if self.fsync:
+            fsync_directory(os.path.dirname(self.file_path) or '.')
+
+    def abort(self):
+        if self.fd is None:
+            return
+        # The writer may still hold buffers for this file; let them land before closing it
+        try:
+            self.flush()
+        except OSError:
+            pass
+        os.close(self.fd)
+        self.fd = None
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
@@ -0,0 +1,44 @@
+import os
+import re
+
+from ContentStore import ContentStore
+
+
+class ExportCache:
+    """Exports of Google-native documents, keyed by file id, version and export format.
+
+    Docs, Sheets and Slides have no md5Checksum, so the content store can't recognize them, and every export
+    is slow and expensive in quota. An export is kept here once; while the document's version is unchanged
+    any copy of it in the sync folder (a lost file, a second sync folder, a moved file) is recreated from the
+    cache instead of exporting again. Only the newest version of each file is kept.
+    """
+
+    def __init__(self, cache_folder):
+        self.cache_folder = cache_folder
+
+    def entry_path(self, file_id, metadata, export_mime_type):
+        """Return the cache path of an export, or None when the listing has no version."""
+        if not metadata or metadata.get('version') is None or not export_mime_type:
+            return None
+        export_format = re.sub(r'[^\w.-]', '_', export_mime_type)
+        return os.path.join(self.cache_folder, file_id, f"{metadata['version']}.{export_format}")
+
+    def has(self, entry_path):
+        return entry_path is not None and os.path.exists(entry_path)
+
+    def add(self, file_path, entry_path):
+        """Record a fresh export, replacing the exports of older versions of the same file."""
+        folder = os.path.dirname(entry_path)
+        os.makedirs(folder, exist_ok=True)
+        version = os.path.basename(entry_path).split('.', 1)[0]
+        for name in os.listdir(folder):
+            if name.split('.', 1)[0] != version:
+                os.remove(os.path.join(folder, name))
+        if not os.path.exists(entry_path):
+            ContentStore.link(file_path, entry_path)
+
+    def materialize(self, entry_path, file_path):
+        """Create file_path from a cached export without calling the API."""
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        ContentStore.link(entry_path, file_path)
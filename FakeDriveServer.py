@@ -0,0 +1,670 @@
+import hashlib
+import json
+import operator
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+GOOGLE_NATIVE_PREFIX = 'application/vnd.google-apps.'
+SERVICE_PATH = '/drive/v3/'
+UPLOAD_PATH = '/upload/drive/v3/'
+BATCH_PATH = '/batch/drive/v3'
+EXPORT_LINK_PATH = '/export-links/'
+
+# Formats each Google-native type can be exported to, listed in its exportLinks
+EXPORT_FORMATS = {
+    "application/vnd.google-apps.document": [
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document", "application/pdf",
+        "text/plain", "text/html", "text/markdown", "application/rtf", "application/vnd.oasis.opendocument.text",
+    ],
+    "application/vnd.google-apps.spreadsheet": [
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "application/pdf", "text/csv",
+        "text/tab-separated-values", "application/vnd.oasis.opendocument.spreadsheet",
+    ],
+    "application/vnd.google-apps.presentation": [
+        "application/vnd.openxmlformats-officedocument.presentationml.presentation", "application/pdf",
+        "text/plain", "application/vnd.oasis.opendocument.presentation",
+    ],
+}
+
+# Mix of MIME types for generated files, with relative weights
+DEFAULT_MIME_TYPES = {
+    "application/pdf": 4,
+    "application/vnd.google-apps.document": 3,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": 2,
+    "application/vnd.google-apps.spreadsheet": 1,
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": 1,
+    "application/vnd.google-apps.presentation": 1,
+    "text/plain": 1,
+    "application/json": 1,
+}
+
+
+def file_content(file_id, size):
+    """Deterministic content of a generated file: its id hashed into a block, repeated."""
+    block = hashlib.sha256(file_id.encode('utf-8')).digest() * 128
+    return (block * (size // len(block) + 1))[:size]
+
+
+def file_size(rng, size_distribution, mean_size):
+    if size_distribution == 'fixed':
+        return mean_size
+    if size_distribution == 'uniform':
+        return rng.randint(0, 2 * mean_size)
+    if size_distribution == 'lognormal':
+        # Many small files and a long tail of large ones, with the given mean
+        sigma = 1.5
+        return int(rng.lognormvariate(0, sigma) * mean_size / (2.718281828 ** (sigma ** 2 / 2)))
+    raise ValueError(f"Unknown size distribution: {size_distribution}")
+
+
+def generate_tree(depth=3, fan_out=4, files_per_folder=10, size_distribution='lognormal', mean_size=256 * 1024,
+                  mime_types=None, root_id='root-folder', seed=0):
+    """Generate the items of a synthetic Drive tree below root_id.
+
+    Every folder at depth < depth has fan_out subfolders and every folder, including the root, holds
+    files_per_folder files. Binary files get a size from size_distribution ('fixed', 'uniform' or
+    'lognormal') around mean_size and a matching md5Checksum; Google-native documents have no size.
+    """
+    rng = random.Random(seed)
+    mime_types = mime_types or DEFAULT_MIME_TYPES
+    mime_type_choices, weights = list(mime_types), list(mime_types.values())
+    items = []
+    counter = 0
+
+    to_process = [(root_id, 0)]
+    while to_process:
+        folder_id, level = to_process.pop()
+        for _ in range(files_per_folder):
+            counter += 1
+            mime_type = rng.choices(mime_type_choices, weights)[0]
+            item = {
+                'id': f"file-{counter}", 'name': f"File {counter}", 'mimeType': mime_type, 'parents': [folder_id],
+                'modifiedTime': f"2024-{counter % 12 + 1:02d}-01T00:00:00.000Z", 'version': str(counter % 7 + 1),
+            }
+            if not mime_type.startswith(GOOGLE_NATIVE_PREFIX):
+                size = file_size(rng, size_distribution, mean_size)
+                item['size'] = str(size)
+                item['md5Checksum'] = hashlib.md5(file_content(item['id'], size)).hexdigest()
+            items.append(item)
+
+        if level < depth:
+            for _ in range(fan_out):
+                counter += 1
+                subfolder_id = f"folder-{counter}"
+                items.append({
+                    'id': subfolder_id, 'name': f"Folder {counter}", 'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [folder_id], 'modifiedTime': '2024-01-01T00:00:00.000Z', 'version': '1',
+                })
+                to_process.append((subfolder_id, level + 1))
+    return items
+
+
+COMPARISONS = {'<': operator.lt, '<=': operator.le, '=': operator.eq, '!=': operator.ne, '>': operator.gt,
+               '>=': operator.ge}
+
+
+# Parent clauses, the negated ones excluded
+PARENTS_PATTERN = r"(?<!not )'([^']+)' in parents"
+STRING_PATTERN = r"'((?:[^'\\]|\\.)*)'"
+
+
+def unquote(value):
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def error_body(status, reason, message):
+    return {'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+
+
+def split_multipart(body, boundary):
+    """Parts of a multipart body as (headers, content), with LF or CRLF line endings."""
+    parts = []
+    for part in (b'\n' + body).split(b'\n--' + boundary)[1:]:
+        if part.startswith(b'--'):
+            break
+        crlf = part.startswith(b'\r\n')
+        header_block, content = re.split(rb'\r?\n\r?\n', part[2 if crlf else 1:], maxsplit=1)
+        if crlf and content.endswith(b'\r'):
+            content = content[:-1]
+        headers = {}
+        for line in re.split(rb'\r?\n', header_block):
+            name, _, value = line.decode('utf-8').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        parts.append((headers, content))
+    return parts
+
+
+def parse_time(value):
+    # RFC 3339 as Drive returns it, or the zone-less form queries may use, which Drive reads as UTC
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def matches_query(item, query):
+    """Evaluate the subset of the Drive query language this repo generates."""
+    if not query:
+        return True
+    if 'trashed=false' in query.replace(' ', '') and item.get('trashed'):
+        return False
+
+    included = re.findall(r"mimeType\s*=\s*'([^']+)'", query)
+    if included and item['mimeType'] not in included:
+        return False
+    if item['mimeType'] in re.findall(r"mimeType\s*!=\s*'([^']+)'", query):
+        return False
+
+    parents = re.findall(PARENTS_PATTERN, query)
+    if parents and not set(parents) & set(item.get('parents', [])):
+        return False
+    if set(re.findall(r"not '([^']+)' in parents", query)) & set(item.get('parents', [])):
+        return False
+
+    # Drive matches name contains against the start of the name and of each of its words
+    name = item['name'].lower()
+    for negated, value in re.findall(r"(not )?name contains " + STRING_PATTERN, query):
+        value = unquote(value).lower()
+        found = name.startswith(value) or any(word.startswith(value) for word in re.findall(r"\w+", name))
+        if found == bool(negated):
+            return False
+
+    for value in re.findall(r"name\s*=\s*" + STRING_PATTERN, query):
+        if item['name'] != unquote(value):
+            return False
+
+    for owner in re.findall(STRING_PATTERN + r" in owners", query):
+        if unquote(owner) not in [owner_item.get('emailAddress') for owner_item in item.get('owners', [])]:
+            return False
+
+    for comparison, value in re.findall(r"modifiedTime\s*(<=|>=|!=|<|>|=)\s*'([^']+)'", query):
+        if 'modifiedTime' not in item or not COMPARISONS[comparison](parse_time(item['modifiedTime']),
+                                                                     parse_time(value)):
+            return False
+    return True
+
+
+class FakeDriveServer:
+    """Local stand-in for the Drive v3 endpoints the sync uses, for benchmarks and offline runs.
+
+    Serves files.list (with pagination and the repo's mimeType / parents / modifiedTime / name / owners / trashed
+    queries), files.get, alt=media downloads with Range support, export, exportLinks, and the changes feed.
+    Uploads are accepted too: files.create and files.update with multipart and resumable media, and batch
+    requests of metadata calls. Uploaded content is kept in memory and served back by alt=media. Creates,
+    updates, trashing and files.delete are logged as changes, which changes.list serves after the given page
+    token. Every request can be delayed by latency seconds, and a throttle_rate share of them is answered with
+    403 rateLimitExceeded or 429, as Drive does under load. Exports larger than export_limit fail with
+    exportSizeLimitExceeded and are only served from exportLinks.
+
+    Point the sync at it with DRIVE_API_ROOT_URL=server.root_url.
+    """
+
+    def __init__(self, items, host='127.0.0.1', port=0, latency=0.0, throttle_rate=0.0, export_size=64 * 1024,
+                 export_limit=None, seed=0):
+        self.items = {item['id']: item for item in items}
+        self.children = {}  # parent id -> [items], so parents queries don't scan the whole drive
+        for item in items:
+            for parent_id in item.get('parents', []):
+                self.children.setdefault(parent_id, []).append(item)
+        self.root_id = next((parent_id for parent_id in self.children if parent_id not in self.items), None)
+        self.latency = latency  # Seconds added to every request
+        self.throttle_rate = throttle_rate  # Share of requests answered with a rate limit error
+        self.export_size = export_size  # Bytes returned for exports of Google-native documents
+        self.export_limit = export_limit  # Larger exports fail, as Drive's 10 MB export limit does
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}  # endpoint -> number of requests
+        self.bytes_served = 0
+        self.bytes_received = 0
+        self.throttled = 0
+        self.contents = {}  # file id -> uploaded bytes
+        self.uploads = {}  # resumable upload id -> {"method", "file_id", "metadata", "params", "data"}
+        self.next_id = 0
+        self.changes = []  # ids of changed files, in order; page token N starts at entry N - 1
+
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def root_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.bytes_served = 0
+            self.bytes_received = 0
+            self.throttled = 0
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'total_calls': sum(self.calls.values()),
+                    'bytes_served': self.bytes_served, 'bytes_received': self.bytes_received,
+                    'throttled': self.throttled}
+
+    def count(self, endpoint, bytes_served=0, bytes_received=0):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytes_served += bytes_served
+            self.bytes_received += bytes_received
+
+    def should_throttle(self):
+        with self.lock:
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                self.throttled += 1
+                return True
+        return False
+
+    def export_links(self, item):
+        link = f"{self.root_url}{EXPORT_LINK_PATH[1:]}{item['id']}"
+        return {export_mime_type: f"{link}?mimeType={quote(export_mime_type)}"
+                for export_mime_type in EXPORT_FORMATS.get(item['mimeType'], [])}
+
+    def list_files(self, params):
+        query = params.get('q', '')
+        page_size = min(int(params.get('pageSize', 100)), 1000)
+        offset = int(params.get('pageToken') or 0)
+
+        parents = re.findall(PARENTS_PATTERN, query)
+        if parents:
+            candidates = [item for parent_id in dict.fromkeys(parents) for item in self.children.get(parent_id, [])]
+        else:
+            candidates = list(self.items.values())
+        # An item in several listed parents is still returned once
+        matching = list({item['id']: item for item in candidates if matches_query(item, query)}.values())
+
+        response = {'files': matching[offset:offset + page_size]}
+        if offset + page_size < len(matching):
+            response['nextPageToken'] = str(offset + page_size)
+        return response
+
+    def start_page_token(self):
+        with self.lock:
+            return str(len(self.changes) + 1)
+
+    def list_changes(self, params):
+        """changes.list: the changes made since pageToken, each with the file's current state."""
+        page_size = min(int(params.get('pageSize', 100)), 1000)
+        offset = int(params.get('pageToken') or 1) - 1
+        with self.lock:
+            changes = []
+            for file_id in self.changes[offset:offset + page_size]:
+                item = self.items.get(file_id)
+                change = {'kind': 'drive#change', 'changeType': 'file', 'fileId': file_id, 'removed': item is None}
+                if item is not None:
+                    change['file'] = dict(item)
+                changes.append(change)
+            response = {'changes': changes}
+            if offset + page_size < len(self.changes):
+                response['nextPageToken'] = str(offset + page_size + 1)
+            else:
+                response['newStartPageToken'] = str(len(self.changes) + 1)
+        return response
+
+    def content(self, item):
+        if item['id'] in self.contents:
+            return self.contents[item['id']]
+        return file_content(item['id'], int(item['size']))
+
+    def set_content(self, item, content):
+        self.contents[item['id']] = content
+        item['size'] = str(len(content))
+        item['md5Checksum'] = hashlib.md5(content).hexdigest()
+
+    def create_item(self, metadata, content=None):
+        """files.create: a new item under metadata's parents (default the root), with optional uploaded content."""
+        with self.lock:
+            self.next_id += 1
+            item = {
+                'id': f"uploaded-{self.next_id}", 'name': metadata.get('name', 'Untitled'),
+                'mimeType': metadata.get('mimeType') or 'application/octet-stream',
+                'parents': list(metadata.get('parents') or [self.root_id]),
+                'modifiedTime': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'), 'version': '1',
+            }
+            if content is not None:
+                self.set_content(item, content)
+            self.items[item['id']] = item
+            for parent_id in item['parents']:
+                self.children.setdefault(parent_id, []).append(item)
+            self.changes.append(item['id'])
+        return item
+
+    def update_item(self, file_id, metadata, params, content=None):
+        """files.update: rename, move with addParents / removeParents, and replace the content. None if not found."""
+        with self.lock:
+            item = self.items.get(file_id)
+            if item is None:
+                return None
+            if metadata.get('name'):
+                item['name'] = metadata['name']
+            if 'trashed' in metadata:
+                item['trashed'] = bool(metadata['trashed'])
+            for parent_id in filter(None, params.get('removeParents', '').split(',')):
+                if parent_id in item['parents']:
+                    item['parents'].remove(parent_id)
+                    self.children[parent_id].remove(item)
+            for parent_id in filter(None, params.get('addParents', '').split(',')):
+                if parent_id not in item['parents']:
+                    item['parents'].append(parent_id)
+                    self.children.setdefault(parent_id, []).append(item)
+            if content is not None:
+                self.set_content(item, content)
+            item['modifiedTime'] = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+            item['version'] = str(int(item.get('version', '1')) + 1)
+            self.changes.append(file_id)
+        return item
+
+    def delete_item(self, file_id):
+        """files.delete: remove the item for good. False if not found."""
+        with self.lock:
+            item = self.items.pop(file_id, None)
+            if item is None:
+                return False
+            for parent_id in item['parents']:
+                self.children[parent_id].remove(item)
+            self.contents.pop(file_id, None)
+            self.changes.append(file_id)
+        return True
+
+    def write(self, method, path, params, metadata, content=None):
+        """Apply a files.create (POST files) or files.update (PATCH files/{id}). Returns (status, body)."""
+        if method == 'POST' and path == 'files':
+            return 200, self.create_item(metadata, content)
+        if method == 'PATCH' and path.startswith('files/'):
+            file_id = path[len('files/'):]
+            item = self.update_item(file_id, metadata, params, content)
+            if item is not None:
+                return 200, item
+            return 404, error_body(404, 'notFound', f"File not found: {file_id}")
+        return 404, error_body(404, 'notFound', f"Unknown path {method} {path}")
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body):
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def send_error_json(self, status, reason, message):
+                self.send_json(status, error_body(status, reason, message))
+
+            def send_content(self, endpoint, content):
+                status = 200
+                content_range = None
+                range_header = self.headers.get('Range')
+                if range_header:
+                    start, end = re.match(r'bytes=(\d+)-(\d*)', range_header).groups()
+                    start, end = int(start), min(int(end), len(content) - 1) if end else len(content) - 1
+                    content_range = f"bytes {start}-{end}/{len(content)}"
+                    content = content[start:end + 1]
+                    status = 206
+                server.count(endpoint, len(content))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream')
+                if content_range:
+                    # Chunked downloads read the total size from it
+                    self.send_header('Content-Range', content_range)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def delay_or_throttle(self):
+                # True when the request was answered with a rate limit error
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.should_throttle():
+                    if server.random.random() < 0.5:
+                        self.send_error_json(429, 'rateLimitExceeded', 'Rate Limit Exceeded')
+                    else:
+                        self.send_error_json(403, 'userRateLimitExceeded', 'User Rate Limit Exceeded')
+                    return True
+                return False
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if self.delay_or_throttle():
+                    return
+
+                path = url.path[len(SERVICE_PATH):] if url.path.startswith(SERVICE_PATH) else None
+                if path == 'files':
+                    server.count('files.list')
+                    self.send_json(200, server.list_files(params))
+                elif path == 'changes/startPageToken':
+                    server.count('changes.getStartPageToken')
+                    self.send_json(200, {'startPageToken': server.start_page_token()})
+                elif path == 'changes':
+                    server.count('changes.list')
+                    self.send_json(200, server.list_changes(params))
+                elif path and path.startswith('files/'):
+                    self.get_file(path[len('files/'):], params)
+                elif url.path.startswith(EXPORT_LINK_PATH):
+                    file_id = url.path[len(EXPORT_LINK_PATH):]
+                    if file_id not in server.items or params.get('mimeType') not in server.export_links(
+                            server.items[file_id]):
+                        self.send_error_json(404, 'notFound', f"No export link {url.path}")
+                        return
+                    self.send_content('exportLinks', file_content(file_id, server.export_size))
+                else:
+                    self.send_error_json(404, 'notFound', f"Unknown path {url.path}")
+
+            def get_file(self, path, params):
+                file_id, _, action = path.partition('/')
+                if file_id == 'root' and server.root_id:
+                    file_id = server.root_id
+                item = server.items.get(file_id)
+                if item is None and file_id != server.root_id:
+                    self.send_error_json(404, 'notFound', f"File not found: {file_id}")
+                    return
+                item = item or {'id': file_id, 'name': 'My Drive', 'mimeType': FOLDER_MIME_TYPE}
+
+                if action == 'export':
+                    if not item['mimeType'].startswith(GOOGLE_NATIVE_PREFIX):
+                        self.send_error_json(403, 'fileNotExportable', 'Only Google Docs can be exported')
+                        return
+                    if server.export_limit is not None and server.export_size > server.export_limit:
+                        server.count('files.export')
+                        self.send_error_json(403, 'exportSizeLimitExceeded', 'This file is too large to be exported.')
+                        return
+                    self.send_content('files.export', file_content(file_id, server.export_size))
+                elif params.get('alt') == 'media':
+                    if 'size' not in item:
+                        self.send_error_json(403, 'fileNotDownloadable', 'Use Export with Docs Editors files')
+                        return
+                    self.send_content('files.get_media', server.content(item))
+                else:
+                    server.count('files.get')
+                    links = server.export_links(item)
+                    self.send_json(200, dict(item, exportLinks=links) if links else item)
+
+            def read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def do_POST(self):
+                self.write_request('POST')
+
+            def do_PATCH(self):
+                self.write_request('PATCH')
+
+            def do_PUT(self):
+                self.write_request('PUT')
+
+            def do_DELETE(self):
+                url = urlparse(self.path)
+                if self.delay_or_throttle():
+                    return
+                path = url.path[len(SERVICE_PATH):] if url.path.startswith(SERVICE_PATH) else ''
+                if not path.startswith('files/'):
+                    self.send_error_json(404, 'notFound', f"Unknown path DELETE {url.path}")
+                    return
+                server.count('files.delete')
+                file_id = path[len('files/'):]
+                if not server.delete_item(file_id):
+                    self.send_error_json(404, 'notFound', f"File not found: {file_id}")
+                    return
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def write_request(self, method):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                body = self.read_body()  # Read before answering, so the connection can be reused
+                if self.delay_or_throttle():
+                    return
+
+                if url.path == BATCH_PATH and method == 'POST':
+                    self.batch(body)
+                elif url.path.startswith(UPLOAD_PATH):
+                    self.upload(method, url.path[len(UPLOAD_PATH):], params, body)
+                elif url.path.startswith(SERVICE_PATH):
+                    path = url.path[len(SERVICE_PATH):]
+                    server.count('files.create' if method == 'POST' else 'files.update')
+                    self.send_json(*server.write(method, path, params, json.loads(body or b'{}')))
+                else:
+                    self.send_error_json(404, 'notFound', f"Unknown path {method} {url.path}")
+
+            def upload(self, method, path, params, body):
+                upload_type = params.get('uploadType')
+                endpoint = 'files.create' if method == 'POST' else 'files.update'
+                if upload_type == 'multipart':
+                    boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get('Content-Type', '')).group(1)
+                    (_, metadata), (media_headers, content) = split_multipart(body, boundary.encode('utf-8'))
+                    metadata = json.loads(metadata or b'{}')
+                    # Drive takes the type of new files from the media when the metadata has none
+                    metadata.setdefault('mimeType', media_headers.get('content-type'))
+                    server.count(f"{endpoint}.multipart", bytes_received=len(content))
+                    self.send_json(*server.write(method, path, params, metadata, content))
+                elif upload_type == 'resumable' and 'upload_id' in params:
+                    self.upload_chunk(params['upload_id'], body)
+                elif upload_type == 'resumable':
+                    # Start a session; the chunks are PUT to the returned Location
+                    with server.lock:
+                        server.next_id += 1
+                        upload_id = f"upload-{server.next_id}"
+                        metadata = json.loads(body or b'{}')
+                        metadata.setdefault('mimeType', self.headers.get('X-Upload-Content-Type'))
+                        server.uploads[upload_id] = {'method': method, 'path': path, 'params': params,
+                                                     'metadata': metadata, 'data': bytearray()}
+                    server.count(f"{endpoint}.resumable")
+                    self.send_response(200)
+                    self.send_header('Location', f"{server.root_url}{UPLOAD_PATH[1:]}files?uploadType=resumable"
+                                                 f"&upload_id={upload_id}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                else:
+                    self.send_error_json(400, 'badRequest', f"Unsupported uploadType {upload_type}")
+
+            def upload_chunk(self, upload_id, body):
+                session = server.uploads.get(upload_id)
+                if session is None:
+                    self.send_error_json(404, 'notFound', f"Unknown upload {upload_id}")
+                    return
+                if 'item' in session:
+                    # A finished upload answers a retried last chunk or a status query with its file
+                    server.count('upload.chunk')
+                    self.send_json(200, session['item'])
+                    return
+                match = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', self.headers.get('Content-Range', ''))
+                total = match.group(3) if match else None
+                if match and match.group(1) is not None:
+                    # A chunk resent after a lost response overlaps what was stored
+                    del session['data'][int(match.group(1)):]
+                    session['data'] += body
+                server.count('upload.chunk', bytes_received=len(body))
+
+                if total is not None and total != '*' and len(session['data']) >= int(total):
+                    status, body = server.write(session['method'], session['path'], session['params'],
+                                                session['metadata'], bytes(session['data']))
+                    if status == 200:
+                        session['item'] = body
+                        session['data'] = b''
+                    self.send_json(status, body)
+                    return
+                self.send_response(308)  # Resume Incomplete
+                if session['data']:
+                    self.send_header('Range', f"bytes=0-{len(session['data']) - 1}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def batch(self, body):
+                # Each part is an HTTP request of its own; answered in one multipart response, in order
+                boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get('Content-Type', '')).group(1)
+                server.count('batch')
+                response_parts = []
+                for headers, request in split_multipart(body, boundary.encode('utf-8')):
+                    head, _, request_body = request.partition(b'\r\n\r\n') if b'\r\n\r\n' in request \
+                        else request.partition(b'\n\n')
+                    method, target = head.decode('utf-8').split()[:2]
+                    url = urlparse(target)
+                    params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    path = url.path[len(SERVICE_PATH):] if url.path.startswith(SERVICE_PATH) else url.path
+                    server.count(f"batch.{'files.create' if method == 'POST' else 'files.update'}")
+                    status, response = server.write(method, path, params, json.loads(request_body.strip() or b'{}'))
+                    content_id = headers.get('content-id', '<>')[1:-1]
+                    response_parts.append(
+                        f"--batch_response\r\nContent-Type: application/http\r\n"
+                        f"Content-ID: <response-{content_id}>\r\n\r\n"
+                        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        f"Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(response)}\r\n"
+                    )
+                content = (''.join(response_parts) + "--batch_response--\r\n").encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/mixed; boundary=batch_response')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+
+# Example usage
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a synthetic Drive tree on a local port")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fan-out', type=int, default=4)
+    parser.add_argument('--files-per-folder', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Share of requests answered with 403/429")
+    args = parser.parse_args()
+
+    tree = generate_tree(depth=args.depth, fan_out=args.fan_out, files_per_folder=args.files_per_folder)
+    fake_server = FakeDriveServer(tree, port=args.port, latency=args.latency, throttle_rate=args.throttle_rate)
+    print(f"Serving {len(tree)} items under folder id 'root-folder'")
+    print(f"Run the sync against it with DRIVE_API_ROOT_URL={fake_server.root_url}")
+    fake_server.httpd.serve_forever()
@@ -1,17 +1,79 @@
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import os
-import io
-from tqdm import tqdm
+import threading
+import time
 
-from googleapiclient.http import MediaIoBaseDownload
+from DownloadSink import BufferPool, ChunkSizer, DiskWriter, DownloadSink
+from Metrics import get_default_metrics
+from RangedDownloader import RangedDownloader
+from RateController import get_default_controller, is_retryable
+from authenticate import get_http, get_service
 
-from authenticate import create_service
+GOOGLE_NATIVE_PREFIX = 'application/vnd.google-apps.'
+
+# File extensions of the formats Google-native documents can be exported to
+EXPORT_EXTENSIONS = {
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+    "application/vnd.oasis.opendocument.text": ".odt",
+    "application/vnd.oasis.opendocument.spreadsheet": ".ods",
+    "application/vnd.oasis.opendocument.presentation": ".odp",
+    "application/pdf": ".pdf",
+    "application/rtf": ".rtf",
+    "application/epub+zip": ".epub",
+    "application/zip": ".zip",
+    "text/plain": ".txt",
+    "text/markdown": ".md",
+    "text/html": ".html",
+    "text/csv": ".csv",
+    "text/tab-separated-values": ".tsv",
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/svg+xml": ".svg",
+}
+
+
+def is_export_too_large(error):
+    # Docs Editors files above the export size limit can still be fetched through their exportLinks
+    return getattr(error, 'reason', None) == 'exportSizeLimitExceeded' or \
+        'This file is too large to be exported.' in str(error)
 
 
 class FileDownloader:
-    def __init__(self, sync_folder):
+    def __init__(self, sync_folder, manifest=None, client=None, max_concurrent_downloads=15, controller=None,
+                 ranged_downloader=None, ranged_threshold=8 * 1024 * 1024, content_store=None, index=None,
+                 metrics=None, export_cache=None, export_formats=None, export_links_fallback=True, chunk_sizer=None,
+                 disk_writer=None, buffer_pool=None, extractor=None):
         self.sync_folder = sync_folder
+        self.manifest = manifest  # Optional SyncManifest used to skip unchanged files
+        self.client = client  # Optional AsyncDriveClient used instead of googleapiclient in threads
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.controller = controller or get_default_controller()  # Shared rate limit and retry budget
+        self.chunk_sizer = chunk_sizer or ChunkSizer()  # Bytes per download request, from measured throughput
+        # Resumable downloads of large files
+        self.ranged_downloader = ranged_downloader or RangedDownloader(chunk_sizer=self.chunk_sizer)
+        # Downloads are written by the disk writer's threads, so a slow disk doesn't hold network slots
+        self.disk_writer = disk_writer or DiskWriter()
+        self.buffer_pool = buffer_pool or BufferPool(count=2 * max_concurrent_downloads)
+        self.ranged_threshold = ranged_threshold  # Binary files at least this large use ranged downloads
+        self.failed_files = []  # (file_name, file_id, error) of downloads that failed for good
+        self.content_store = content_store  # Optional ContentStore so identical files are fetched once
+        self.blob_locks = {}  # Blob path -> asyncio.Lock, so concurrent copies of one blob download it once
+        self.index = index  # Optional MetadataIndex that records the sync state of each file
+        self.metrics = metrics or get_default_metrics()  # Bytes per worker and files per outcome
+        self.progress_bar = None  # tqdm bar in bytes, set while a batch of downloads runs
+        self.export_cache = export_cache  # Optional ExportCache so unchanged documents are exported once
+        # Google-native MIME type -> export MIME type, e.g. text/plain for documents that are only indexed
+        self.export_formats = export_formats or {}
+        for native_mime_type, export_mime_type in self.export_formats.items():
+            if not native_mime_type.startswith(GOOGLE_NATIVE_PREFIX):
+                raise ValueError(f"Only Google-native files are exported, not {native_mime_type}")
+            if export_mime_type not in EXPORT_EXTENSIONS:
+                raise ValueError(f"Unknown export format {export_mime_type} for {native_mime_type}")
+        self.export_links_fallback = export_links_fallback  # Fetch exports over the size limit from exportLinks
+        self.extractor = extractor  # Optional ContentExtractor that receives every synced file
 
     def sanitize_filename(self, file_name):
         # This ensures that the file name is safe to use on most file systems
@@ -19,7 +81,10 @@ class FileDownloader:
 
     def get_extension_and_export_type(self, mime_type):
         # This function returns the correct extension and export MIME type based on the file type
-        if mime_type == "application/vnd.google-apps.document":
+        if mime_type in self.export_formats:
+            export_mime_type = self.export_formats[mime_type]
+            return EXPORT_EXTENSIONS[export_mime_type], export_mime_type
+        elif mime_type == "application/vnd.google-apps.document":
             return ".docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         elif mime_type == "application/vnd.google-apps.spreadsheet":
             return ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
@@ -39,7 +104,163 @@ class FileDownloader:
             # Default to .txt for unknown types, as a fallback
             return ".txt", None
 
-    def download_file(self, file_name, file_id, mime_type, service):
+    def get_file_path(self, file_name, file_id, mime_type):
+        # Construct the local file path, ensure there's only one extension
+        sanitized_file_name = self.sanitize_filename(file_name)
+        extension, _ = self.get_extension_and_export_type(mime_type)
+        return os.path.join(self.sync_folder, f"{sanitized_file_name}.{file_id}{extension}")
+
+    def is_up_to_date(self, file_name, file_id, mime_type, metadata):
+        # A file is skipped when the manifest shows the local copy matches the listed remote version
+        if self.manifest is None:
+            return False
+        return self.manifest.is_unchanged(file_id, metadata, self.get_file_path(file_name, file_id, mime_type))
+
+    @staticmethod
+    def listed_size(metadata):
+        size = (metadata or {}).get('size')
+        return int(size) if size is not None else None
+
+    def use_ranged_download(self, mime_type, metadata):
+        # Exports have no size and don't support Range requests, so only large binary files qualify
+        _, export_mime_type = self.get_extension_and_export_type(mime_type)
+        size = (metadata or {}).get('size')
+        return export_mime_type is None and size is not None and int(size) >= self.ranged_threshold
+
+    def materialize_from_store(self, file_name, file_id, mime_type, metadata):
+        # Create the file from an identical blob that was already downloaded, returns True if it did
+        if self.content_store is None:
+            return False
+        blob_path = self.content_store.blob_path(metadata)
+        if not self.content_store.has(blob_path):
+            return False
+
+        file_path = self.get_file_path(file_name, file_id, mime_type)
+        self.prepare_file_path(file_path)
+        self.content_store.materialize(blob_path, file_path)
+        print(f"Linked: {os.path.basename(file_path)}")
+        self.record_synced(file_id, metadata, file_path, 'linked')
+        return True
+
+    def materialize_from_export_cache(self, file_name, file_id, mime_type, metadata):
+        # Create an export from the cache when this version was already exported, returns True if it did
+        if self.export_cache is None:
+            return False
+        _, export_mime_type = self.get_extension_and_export_type(mime_type)
+        entry_path = self.export_cache.entry_path(file_id, metadata, export_mime_type)
+        if not self.export_cache.has(entry_path):
+            return False
+
+        file_path = self.get_file_path(file_name, file_id, mime_type)
+        self.prepare_file_path(file_path)
+        self.export_cache.materialize(entry_path, file_path)
+        print(f"Cached export: {os.path.basename(file_path)}")
+        self.record_synced(file_id, metadata, file_path, 'cached')
+        return True
+
+    def prepare_file_path(self, file_path):
+        # Downloads write a .part file and rename it over the old copy, so a hardlinked blob is never written to
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    def open_sink(self, file_path, size=None, pooled=True):
+        return DownloadSink(file_path, size, self.disk_writer, self.buffer_pool, pooled=pooled)
+
+    def record_synced(self, file_id, metadata, file_path, sync_state):
+        self.metrics.inc('drive_files_total', status=sync_state)
+        if self.manifest is not None:
+            self.manifest.record(file_id, metadata, file_path)
+        if self.index is not None:
+            self.index.set_sync_state(file_id, sync_state, file_path)
+        self.extract(file_id, metadata, file_path)
+
+    def record_failed(self, file_name, file_id, error):
+        # Non-retryable errors end here too, so callers such as shard workers see every failed file
+        self.failed_files.append((file_name, file_id, str(error)))
+        self.metrics.inc('drive_files_total', status='failed')
+        if self.index is not None:
+            self.index.set_sync_state(file_id, 'failed')
+
+    def extract(self, file_id, metadata, file_path):
+        # Unchanged files are submitted too; the extractor skips content it has already extracted
+        if self.extractor is not None:
+            self.extractor.submit(file_id, file_path, metadata)
+
+    def track_progress(self, metadata):
+        """Return callbacks for one file: count bytes as they are written, start over on a retry, and finish."""
+        # Files with a listed size count towards the bar's total up front; exports grow it as their bytes arrive
+        expected = (metadata or {}).get('size')
+        expected = int(expected) if expected is not None else None
+        if expected and self.progress_bar is not None:
+            self.progress_bar.total += expected
+        received = [0]  # Bytes on the bar, at most expected
+
+        def progress(byte_count):
+            # The metric counts every byte transferred, retries included; the bar only counts the file once
+            self.metrics.inc('drive_download_bytes_total', byte_count, worker=threading.current_thread().name)
+            if expected is not None:
+                byte_count = max(0, min(byte_count, expected - received[0]))
+            received[0] += byte_count
+            if self.progress_bar is not None:
+                if expected is None:
+                    self.progress_bar.total += byte_count
+                self.progress_bar.update(byte_count)
+
+        def restart():
+            # A retried download writes the file from the start again; take back what the failed attempt counted
+            if self.progress_bar is not None and received[0]:
+                if expected is None:
+                    self.progress_bar.total -= received[0]
+                self.progress_bar.update(-received[0])
+            received[0] = 0
+
+        def finish():
+            # Linked, resumed and failed files still complete their share of the bar
+            if expected is not None and self.progress_bar is not None and received[0] < expected:
+                self.progress_bar.update(expected - received[0])
+
+        return progress, restart, finish
+
+    def store_downloaded(self, file_path, file_id, metadata, export_mime_type=None):
+        if self.content_store is not None:
+            blob_path = self.content_store.blob_path(metadata)
+            if blob_path is not None:
+                self.content_store.add(file_path, blob_path)
+        if self.export_cache is not None:
+            entry_path = self.export_cache.entry_path(file_id, metadata, export_mime_type)
+            if entry_path is not None:
+                self.export_cache.add(file_path, entry_path)
+
+    def get_export_link(self, file_id, export_mime_type, service):
+        # exportLinks serve Docs Editors files in each export format, without the export size limit
+        links = service.files().get(fileId=file_id, fields='exportLinks', supportsAllDrives=True).execute()
+        link = links.get('exportLinks', {}).get(export_mime_type)
+        if link is None:
+            raise ValueError(f"No export link for {export_mime_type}")
+        return link
+
+    def download_export_link(self, file_id, export_mime_type, file_path, service, progress=None):
+        from googleapiclient.http import HttpRequest
+
+        link = self.get_export_link(file_id, export_mime_type, service)
+        # The link is fetched with the calling thread's authorized connection, in chunks like any download
+        self.download_request(HttpRequest(get_http(), lambda response, content: content, link), file_path, progress)
+
+    def download_request(self, request, file_path, progress=None, size=None):
+        from googleapiclient.http import MediaIoBaseDownload
+
+        # Download the file in chunks sized from recent throughput
+        with self.open_sink(file_path, size) as sink:
+            downloader = MediaIoBaseDownload(sink, request, chunksize=self.chunk_sizer.chunk_size())
+            done = False
+            while not done:
+                written = sink.tell()
+                start = time.perf_counter()
+                _, done = downloader.next_chunk()
+                self.chunk_sizer.record(sink.tell() - written, time.perf_counter() - start)
+                if progress is not None:
+                    progress(sink.tell() - written)
+
+    def download_file(self, file_name, file_id, mime_type, service=None, metadata=None, progress=None, loop=None):
         # Sanitize the file name
         sanitized_file_name = self.sanitize_filename(file_name)
 
@@ -47,47 +268,186 @@ class FileDownloader:
         extension, export_mime_type = self.get_extension_and_export_type(mime_type)
 
         # Construct the file path, ensure there's only one extension
-        file_path = os.path.join(self.sync_folder, f"{sanitized_file_name}.{file_id}{extension}")
+        file_path = self.get_file_path(file_name, file_id, mime_type)
+
+        if self.is_up_to_date(file_name, file_id, mime_type, metadata):
+            print(f"Unchanged: {sanitized_file_name}.{file_id}{extension}")
+            self.metrics.inc('drive_files_total', status='unchanged')
+            self.extract(file_id, metadata, file_path)
+            return
+        if self.materialize_from_store(file_name, file_id, mime_type, metadata):
+            return
+        if self.materialize_from_export_cache(file_name, file_id, mime_type, metadata):
+            return
+
+        # Use the calling thread's shared service unless one is given
+        service = service or get_service()
 
         try:
-            # If it's a Google Docs-type file, export it using the correct MIME type
-            if export_mime_type:
-                request = service.files().export_media(fileId=file_id, mimeType=export_mime_type)
+            self.prepare_file_path(file_path)
+            if self.use_ranged_download(mime_type, metadata):
+                # Large binary files resume from a .part file and download in parallel segments; called from
+                # download_file_async, each Range request takes its own rate controller slot on loop
+                slot = (lambda: self.controller.slot_from_thread(loop)) if loop is not None else None
+                self.ranged_downloader.download(file_id, file_path, int(metadata['size']), metadata.get('md5Checksum'),
+                                                progress, slot)
             else:
-                # Otherwise, download it directly
-                request = service.files().get_media(fileId=file_id)
+                # If it's a Google Docs-type file, export it using the correct MIME type
+                if export_mime_type:
+                    try:
+                        self.download_request(service.files().export_media(fileId=file_id, mimeType=export_mime_type),
+                                              file_path, progress)
+                    except Exception as e:
+                        if not (self.export_links_fallback and is_export_too_large(e)):
+                            raise
+                        print(f"Export of {sanitized_file_name} is too large, fetching it from its export link")
+                        self.download_export_link(file_id, export_mime_type, file_path, service, progress)
+                else:
+                    # Otherwise, download it directly
+                    self.download_request(service.files().get_media(fileId=file_id), file_path, progress,
+                                          self.listed_size(metadata))
 
-            # Download the file in chunks
-            with io.FileIO(file_path, mode='wb') as fh:
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while not done:
-                    _, done = downloader.next_chunk()
+            print(f"Downloaded: {sanitized_file_name}.{file_id}{extension}")
+            self.store_downloaded(file_path, file_id, metadata, export_mime_type)
+            self.record_synced(file_id, metadata, file_path, 'downloaded')
+
+        except Exception as e:
+            if is_retryable(e):
+                # Throttling and server errors are retried by the rate controller
+                raise
+            if 'This file is too large to be exported.' in str(e):
+                print(f"Cannot download {sanitized_file_name}, file too large. Skipping file...")
+            else:
+                print(f"Unexpected error: {e}")
+            self.record_failed(file_name, file_id, e)
+
+    async def download_file_native(self, file_name, file_id, mime_type, metadata=None, progress=None):
+        # Same as download_file, but streamed through the AsyncDriveClient on the event loop
+        sanitized_file_name = self.sanitize_filename(file_name)
+        extension, export_mime_type = self.get_extension_and_export_type(mime_type)
+        file_path = self.get_file_path(file_name, file_id, mime_type)
+
+        loop = asyncio.get_event_loop()
+        size = None if export_mime_type else self.listed_size(metadata)
+
+        def open_sink():
+            self.prepare_file_path(file_path)
+            # Buffers aren't pooled here, waiting for a free one would block the loop
+            return self.open_sink(file_path, size, pooled=False)
+
+        try:
+            async with await loop.run_in_executor(None, open_sink) as fh:
+                if export_mime_type:
+                    try:
+                        await self.client.export_media(file_id, export_mime_type, fh, progress)
+                    except Exception as e:
+                        if not (self.export_links_fallback and is_export_too_large(e)):
+                            raise
+                        print(f"Export of {sanitized_file_name} is too large, fetching it from its export link")
+                        links = await self.client.get_file(file_id, fields='exportLinks', supportsAllDrives=True)
+                        link = links.get('exportLinks', {}).get(export_mime_type)
+                        if link is None:
+                            raise ValueError(f"No export link for {export_mime_type}")
+                        await loop.run_in_executor(None, lambda: (fh.seek(0), fh.truncate()))
+                        await self.client.get_url(link, fh, progress)
+                else:
+                    await self.client.get_media(file_id, fh, progress)
 
             print(f"Downloaded: {sanitized_file_name}.{file_id}{extension}")
+            self.store_downloaded(file_path, file_id, metadata, export_mime_type)
+            self.record_synced(file_id, metadata, file_path, 'downloaded')
 
         except Exception as e:
+            if is_retryable(e):
+                # Throttling and server errors are retried by the rate controller
+                raise
             if 'This file is too large to be exported.' in str(e):
                 print(f"Cannot download {sanitized_file_name}, file too large. Skipping file...")
             else:
                 print(f"Unexpected error: {e}")
+            self.record_failed(file_name, file_id, e)
+
+    async def download_file_async(self, file_name, file_id, mime_type, semaphore, metadata=None, executor=None):
+        # Skip unchanged files before taking a slot or creating a service
+        if self.is_up_to_date(file_name, file_id, mime_type, metadata):
+            self.metrics.inc('drive_files_total', status='unchanged')
+            self.extract(file_id, metadata, self.get_file_path(file_name, file_id, mime_type))
+            return
 
-    async def download_file_async(self, file_name, file_id, mime_type, semaphore):
-        async with semaphore:
-            # Create a new service instance in an async context
-            service = await asyncio.get_event_loop().run_in_executor(None, create_service)
-            # Call the download_file method in a thread pool executor
-            await asyncio.get_event_loop().run_in_executor(
-                None, self.download_file, file_name, file_id, mime_type, service
+        _, export_mime_type = self.get_extension_and_export_type(mime_type)
+        ranged = self.use_ranged_download(mime_type, metadata)
+        endpoint = 'files.export' if export_mime_type else 'files.get_media_ranged' if ranged else 'files.get_media'
+        progress, restart, finish = self.track_progress(metadata)
+        attempts = [0]
+
+        async def request():
+            # Each attempt of a plain download starts over; a ranged one resumes its .part file
+            if attempts[0] and not ranged:
+                restart()
+            attempts[0] += 1
+            # Large binary files always take the ranged path, which runs in the thread pool
+            if self.client is not None and not ranged:
+                return await self.download_file_native(file_name, file_id, mime_type, metadata, progress)
+
+            # Call the download_file method in a thread pool executor; each worker thread reuses its own service
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                executor, self.download_file, file_name, file_id, mime_type, None, metadata, progress, loop
             )
 
-    async def download_all_files_async(self, file_list):
-        semaphore = asyncio.Semaphore(15)  # Limit concurrency to 15
-        with ThreadPoolExecutor(max_workers=15) as executor:
+        async def download():
+            async with semaphore:
+                try:
+                    # Ranged downloads take a slot per Range request instead of one for the whole file
+                    await self.controller.call(request, endpoint=endpoint, metered=not ranged)
+                except Exception as e:
+                    # Record the file instead of losing it silently
+                    print(f"Failed to download {file_name} ({file_id}): {e}")
+                    self.record_failed(file_name, file_id, e)
+
+        try:
+            if export_mime_type and self.materialize_from_export_cache(file_name, file_id, mime_type, metadata):
+                return
+            blob_path = self.content_store.blob_path(metadata) if self.content_store is not None else None
+            if blob_path is None:
+                await download()
+                return
+
+            # Copies of the same content wait for the first download and are then linked from the store
+            lock = self.blob_locks.setdefault(blob_path, asyncio.Lock())
+            async with lock:
+                if not self.materialize_from_store(file_name, file_id, mime_type, metadata):
+                    await download()
+        finally:
+            finish()
+
+    def open_progress_bar(self):
+        from tqdm import tqdm
+
+        # Counts bytes written, not files scheduled, so the bar only completes when the downloads do
+        self.progress_bar = tqdm(total=0, desc="Downloading files", unit='B', unit_scale=True, unit_divisor=1024)
+        return self.progress_bar
+
+    def close_progress_bar(self):
+        self.progress_bar.close()
+        self.progress_bar = None
+
+    def finish_downloads(self):
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.failed_files:
+            print(f"{len(self.failed_files)} files failed to download")
+
+    async def download_all_files_async(self, file_list, file_metadata=None):
+        # file_metadata maps file id -> listing fields (md5Checksum, modifiedTime, version, size)
+        file_metadata = file_metadata or {}
+        semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_downloads, thread_name_prefix='download') as executor:
             tasks = []
 
             # Set up progress bar
-            with tqdm(total=len(file_list), desc="Downloading files", unit="file") as progress_bar:
+            self.open_progress_bar()
+            try:
                 for file_item in file_list:
                     # Support both file_name, file_id, mime_type and file_name, file_id, mime_type, folder_name formats
                     if len(file_item) == 3:
@@ -97,10 +457,41 @@ class FileDownloader:
 
                     # Schedule async download for each file
                     task = asyncio.ensure_future(
-                        self.download_file_async(file_name, file_id, mime_type, semaphore)
+                        self.download_file_async(file_name, file_id, mime_type, semaphore,
+                                                 file_metadata.get(file_id), executor)
                     )
                     tasks.append(task)
-                    progress_bar.update(1)
 
                 # Wait for all tasks to complete
                 await asyncio.gather(*tasks)
+            finally:
+                self.close_progress_bar()
+
+        self.finish_downloads()
+
+    async def download_pages_async(self, pages):
+        """Download FileRecords from an async iterator of pages, such as FolderFilesFetcher.iter_all_files().
+
+        Only a bounded number of downloads are scheduled at a time, so memory doesn't grow with the listing.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+        max_pending = 2 * self.max_concurrent_downloads
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_downloads, thread_name_prefix='download') as executor:
+            self.open_progress_bar()
+            try:
+                async for records in pages:
+                    for record in records:
+                        if len(pending) >= max_pending:
+                            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                            for task in done:
+                                task.result()
+                        pending.add(asyncio.ensure_future(
+                            self.download_file_async(record.name, record.id, record.mime_type, semaphore,
+                                                     record.metadata(), executor)
+                        ))
+                await asyncio.gather(*pending)
+            finally:
+                self.close_progress_bar()
+
+        self.finish_downloads()
@@ -1,95 +1,69 @@
-import re
+from FileRecord import FileRecord
+from NameGrouper import NameGrouper
+from SyncManifest import SyncManifest
+from drive_query import DriveQuery
 
 
 class FileFetcher:
-    def __init__(self, service):
+    def __init__(self, service, index=None, name_grouper=None, query=None):
         self.service = service
+        self.query = query or DriveQuery()  # Filters pushed into the listing query where Drive supports them
+        self.name_grouper = name_grouper or NameGrouper()  # Filters near-duplicate file names
+        self.index = index  # Optional MetadataIndex; when set it replaces all_files.txt
+        self.file_metadata = {}  # Map of file id -> listing fields (md5Checksum, modifiedTime, version, size)
 
     def filter_files(self, file_list):
-        def get_base_name(file_name):
-            tokens = re.split(r'\W+', file_name)
-            tokens = [
-                token for token in tokens
-                if not (
-                    token.isdigit() or
-                    (len(token) <= 2 and any(char.isdigit() for char in token))
-                )
-            ]
-            base_name = ''.join(tokens).lower()
-            return base_name
+        # Drop files whose names come in large groups of numbered or dated variants; this has no query term
+        return list(self.name_grouper.filter(file_list))
 
-        base_name_to_files = {}
-        for item in file_list:
-            name, file_id, mime_type = item
-            base_name = get_base_name(name)
-            if base_name in base_name_to_files:
-                base_name_to_files[base_name].append(item)
-            else:
-                base_name_to_files[base_name] = [item]
-
-        filtered_files = []
-        for base_name, files in base_name_to_files.items():
-            if len(files) < 5:
-                filtered_files.extend(files)
-
-        return filtered_files
-
-    def list_all_files(self, mime_types=None, folder_id=None):
+    def iter_pages(self, mime_types=None, folder_id=None):
+        """Yield each listing page as a list of FileRecords, without keeping earlier pages."""
         page_token = None
-        all_files = []
         page_number = 0
         total_files_fetched = 0
 
-        if mime_types is None:
-            mime_types = [
-                "text/plain",
-                "application/vnd.google-apps.document",
-                "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                "application/pdf",
-                "application/vnd.google-apps.presentation",
-                "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-                "application/vnd.google-apps.spreadsheet",
-                "application/json"
-            ]
-
-        mime_types_query = " or ".join([f"mimeType='{mime_type}'" for mime_type in mime_types])
+        query = self.query if mime_types is None else DriveQuery(mime_types)
 
-        if folder_id:
-            query = f"({mime_types_query}) and '{folder_id}' in parents and trashed=false"
-        else:
-            query = f"({mime_types_query}) and trashed=false"
-
-        print("Fetching files page by page...")
+        print(f"Fetching files page by page (filters {query.report()})...")
         while True:
             page_number += 1
             print(f"Fetching page {page_number}...")
 
             results = self.service.files().list(
                 pageSize=1000,
-                fields="nextPageToken, files(id, name, mimeType)",
+                fields=query.fields(SyncManifest.LISTING_FIELDS),
                 pageToken=page_token,
                 supportsAllDrives=True,
                 includeItemsFromAllDrives=True,
-                q=query
+                q=query.q(folder_id or None)
             ).execute()
 
-            items = results.get('files', [])
-            all_files.extend([(item['name'], item['id'], item['mimeType']) for item in items])
+            items = query.filter(results.get('files', []))
+            if self.index is not None:
+                self.index.add_items(items, parent_id=folder_id)
             total_files_fetched += len(items)
 
             print(f"Fetched {len(items)} files from page {page_number} (Total so far: {total_files_fetched})")
+            yield [FileRecord.from_item(item, folder_id) for item in items]
 
             page_token = results.get('nextPageToken')
             if not page_token:
                 break
 
         print(f"Total files fetched: {total_files_fetched}")
+
+    def list_all_files(self, mime_types=None, folder_id=None):
+        all_files = []
+        for records in self.iter_pages(mime_types, folder_id):
+            all_files.extend([(record.name, record.id, record.mime_type) for record in records])
+            self.file_metadata.update({record.id: record.metadata() for record in records})
+
         filtered_files_list = self.filter_files(all_files)
 
-        output_file = 'all_files.txt'
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for file_name, file_id, mime_type in filtered_files_list:
-                f.write(f"{file_name}, {file_id}, {mime_type}\n")
+        if self.index is None:
+            output_file = 'all_files.txt'
+            with open(output_file, 'w', encoding='utf-8') as f:
+                for file_name, file_id, mime_type in filtered_files_list:
+                    f.write(f"{file_name}, {file_id}, {mime_type}\n")
 
-        return filtered_files_list
\ No newline at end of file
+        return filtered_files_list
@@ -0,0 +1,55 @@
+import sys
+
+
+class FileRecord:
+    """Compact listing entry yielded by the streaming listing methods.
+
+    Uses __slots__ instead of a per-file dict, stores the size as an int and interns the MIME type, so a
+    page of records is several times smaller than the raw API response it came from. Records unpack like
+    the tuples the list methods return: (file_name, file_id, mime_type) or, when the folder is known,
+    (file_name, file_id, mime_type, folder_name).
+    """
+
+    __slots__ = ('name', 'id', 'mime_type', 'md5_checksum', 'modified_time', 'version', 'size', 'parent_id',
+                 'folder_name')
+
+    def __init__(self, name, file_id, mime_type, md5_checksum=None, modified_time=None, version=None, size=None,
+                 parent_id=None, folder_name=None):
+        self.name = name
+        self.id = file_id
+        self.mime_type = sys.intern(mime_type)  # A handful of distinct values shared by millions of files
+        self.md5_checksum = md5_checksum
+        self.modified_time = modified_time
+        self.version = version
+        self.size = size
+        self.parent_id = parent_id  # Folder the file was listed in, if it was listed per folder
+        self.folder_name = folder_name
+
+    @classmethod
+    def from_item(cls, item, parent_id=None, folder_name=None):
+        """Build a record from a files().list item requested with SyncManifest.LISTING_FIELDS."""
+        size = item.get('size')
+        return cls(item['name'], item['id'], item['mimeType'], item.get('md5Checksum'), item.get('modifiedTime'),
+                   item.get('version'), int(size) if size is not None else None, parent_id, folder_name)
+
+    def metadata(self):
+        """The listing fields in Drive's naming, as FileDownloader and SyncManifest expect them."""
+        return {
+            'md5Checksum': self.md5_checksum,
+            'modifiedTime': self.modified_time,
+            'version': self.version,
+            'size': self.size,
+        }
+
+    def __iter__(self):
+        yield self.name
+        yield self.id
+        yield self.mime_type
+        if self.folder_name is not None:
+            yield self.folder_name
+
+    def __len__(self):
+        return 3 if self.folder_name is None else 4
+
+    def __repr__(self):
+        return f"FileRecord({self.name!r}, {self.id!r}, {self.mime_type!r})"
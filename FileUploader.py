@@ -0,0 +1,425 @@
+import asyncio
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Metrics import get_default_metrics
+from RateController import get_default_controller, is_retryable
+from authenticate import get_service
+from drive_query import DEFAULT_MAX_QUERY_LENGTH, FOLDER_MIME_TYPE, DriveQuery, batch_parent_ids, quote
+
+# Drive accepts at most 100 calls per batch request
+MAX_BATCH_SIZE = 100
+# Resumable upload chunks, except the last, must be a multiple of 256 KB
+CHUNK_GRANULARITY = 256 * 1024
+# Fields of the remote files an upload is compared with
+REMOTE_FIELDS = "id, name, mimeType, md5Checksum, size, parents"
+
+
+def file_md5(file_path, block_size=1024 * 1024):
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileUploader:
+    """Uploads a local folder tree into a Drive folder, the other direction of FileDownloader.
+
+    Remote folders are looked up in the folder-id map of a RecursiveFolderFetcher crawl of the target. Missing
+    folders are created level by level in batch requests, like renames. A file is skipped when its md5 matches
+    the remote file of the same name, and a file that was moved or renamed locally moves or renames the file
+    it was uploaded to instead of uploading it again. The rest upload in parallel under max_concurrent_uploads
+    and the shared rate controller: small files in one multipart request each, large ones in resumable chunks
+    that continue from the last stored byte after a failed chunk. A create is only repeated after checking that
+    the failed attempt didn't create the file, so a lost response doesn't leave a duplicate.
+    """
+
+    def __init__(self, root_folder_id, folder_fetcher=None, max_concurrent_uploads=15, controller=None,
+                 resumable_threshold=5 * 1024 * 1024, chunk_size=8 * 1024 * 1024, batch_size=MAX_BATCH_SIZE,
+                 max_query_length=DEFAULT_MAX_QUERY_LENGTH, state_file='upload_state.json', metrics=None):
+        if chunk_size % CHUNK_GRANULARITY:
+            raise ValueError(f"chunk_size must be a multiple of {CHUNK_GRANULARITY} bytes")
+        self.root_folder_id = root_folder_id
+        # Relative path -> folder id, '' being the root; folders created by the upload are added
+        self.folder_ids = folder_fetcher.folder_paths(root_folder_id) if folder_fetcher is not None else None
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.controller = controller or get_default_controller()  # Shared rate limit and retry budget
+        self.resumable_threshold = resumable_threshold  # Files at least this large use resumable uploads
+        self.chunk_size = chunk_size  # Bytes per resumable upload request
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_query_length = max_query_length  # Upper bound for the packed parents queries of the listing
+        self.state_file = state_file
+        self.state = {}  # relative path -> {"size", "mtime_ns", "md5", "id"} of the last upload
+        self.metrics = metrics or get_default_metrics()
+        self.executor = None  # Thread pool running the blocking API calls, set while uploading
+        self.progress_bar = None  # tqdm bar in bytes, set while the uploads run
+        self.failed_files = []  # (relative path, error) of uploads that failed after all retries
+        self.stats = {'folders_created': 0, 'uploaded': 0, 'updated': 0, 'moved': 0, 'unchanged': 0, 'conflicts': 0,
+                      'failed': 0}
+        self.lock = threading.Lock()  # Uploads record their results from executor threads
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def save(self):
+        with self.lock:
+            tmp_file = f"{self.state_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_file, self.state_file)
+
+    @staticmethod
+    def scan(local_folder):
+        """Relative folder paths and {relative file path: local path} under local_folder, without dot entries."""
+        folders, files = [], {}
+        for directory, subdirectories, file_names in os.walk(local_folder):
+            # Content store, caches and extracted text of a sync folder stay local
+            subdirectories[:] = sorted(name for name in subdirectories if not name.startswith('.'))
+            relative_directory = os.path.relpath(directory, local_folder).replace(os.sep, '/')
+            relative_directory = '' if relative_directory == '.' else relative_directory
+            if relative_directory:
+                folders.append(relative_directory)
+            for file_name in sorted(file_names):
+                if not file_name.startswith('.'):
+                    relative_path = f"{relative_directory}/{file_name}" if relative_directory else file_name
+                    files[relative_path] = os.path.join(directory, file_name)
+        return folders, files
+
+    def checksum(self, relative_path, file_path):
+        """(md5, size, mtime_ns) of a local file; unchanged size and mtime reuse the md5 of the last upload."""
+        stat = os.stat(file_path)
+        previous = self.state.get(relative_path)
+        if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+            return previous['md5'], stat.st_size, stat.st_mtime_ns
+        return file_md5(file_path), stat.st_size, stat.st_mtime_ns
+
+    def execute_batch(self, calls):
+        """Send calls [(key, build)], build(service) returning an HttpRequest, as one batch request.
+
+        Returns ({key: response}, {key: error}); errors of single calls don't fail the batch.
+        """
+        service = get_service()
+        responses, errors = {}, {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                responses[request_id] = response
+
+        batch = service.new_batch_http_request(callback=callback)
+        for key, build in calls:
+            batch.add(build(service), request_id=key)
+        batch.execute()
+        return responses, errors
+
+    async def run_batches(self, calls, endpoint):
+        """Run metadata-only calls [(key, build)] in batch requests of batch_size, in parallel.
+
+        Calls failing with a retryable error are sent again in a later batch. Returns ({key: response},
+        {key: error}).
+        """
+        responses, failures = {}, {}
+        pending = list(calls)
+        attempt = 0
+        while pending:
+            chunks = [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+
+            async def send(chunk):
+                async def request():
+                    return await asyncio.get_event_loop().run_in_executor(self.executor, self.execute_batch, chunk)
+
+                return await self.controller.call(request, endpoint='batch')
+
+            builds = dict(pending)
+            pending = []
+            for chunk_responses, chunk_errors in await asyncio.gather(*[send(chunk) for chunk in chunks]):
+                responses.update(chunk_responses)
+                for key, error in chunk_errors.items():
+                    if is_retryable(error) and attempt < self.controller.max_retries:
+                        pending.append((key, builds[key]))
+                    else:
+                        failures[key] = error
+            self.metrics.inc('drive_batch_calls_total', len(builds), endpoint=endpoint)
+            if pending:
+                await asyncio.sleep(self.controller.backoff_delay(attempt))
+                attempt += 1
+        return responses, failures
+
+    async def create_folders(self, folders):
+        """Create the local folders missing on Drive, one level at a time so parents exist before children."""
+        levels = {}
+        for path in folders:
+            if path not in self.folder_ids:
+                levels.setdefault(path.count('/'), []).append(path)
+
+        for depth in sorted(levels):
+            calls = []
+            for path in levels[depth]:
+                parent_path, _, name = path.rpartition('/')
+                if parent_path not in self.folder_ids:
+                    continue  # Its parent couldn't be created; its files are reported as failed
+                body = {'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [self.folder_ids[parent_path]]}
+                calls.append((path, lambda service, body=body: service.files().create(
+                    body=body, fields='id', supportsAllDrives=True)))
+
+            created, failures = await self.run_batches(calls, 'files.create')
+            for path, item in created.items():
+                self.folder_ids[path] = item['id']
+            self.stats['folders_created'] += len(created)
+            for path, error in failures.items():
+                print(f"Failed to create folder {path}: {error}")
+
+    async def list_remote_files(self, folder_ids):
+        """Files (not folders) in folder_ids, as items with REMOTE_FIELDS, from packed parents queries."""
+        query = DriveQuery(mime_types=[])
+        items = []
+
+        async def list_batch(batch):
+            page_token = None
+            while True:
+                params = dict(pageSize=1000, fields=query.fields(REMOTE_FIELDS), pageToken=page_token,
+                              supportsAllDrives=True, includeItemsFromAllDrives=True, q=query.q(batch))
+
+                async def request():
+                    return await asyncio.get_event_loop().run_in_executor(
+                        self.executor, lambda: get_service().files().list(**params).execute()
+                    )
+
+                results = await self.controller.call(request, endpoint='files.list')
+                items.extend(item for item in results.get('files', []) if item['mimeType'] != FOLDER_MIME_TYPE)
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+
+        batches = batch_parent_ids(list(folder_ids), query.q(), self.max_query_length)
+        await asyncio.gather(*[list_batch(batch) for batch in batches])
+        return items
+
+    def upload_file(self, upload, name, parent_id, file_id=None):
+        """Upload the open file of upload as name into parent_id, or as the new content of file_id.
+
+        upload is a dict holding the file and, once started, the request, so a retry of a resumable upload
+        continues its session from the last byte Drive stored instead of starting a new one. Returns the item.
+        """
+        from googleapiclient.http import MediaIoBaseUpload
+
+        size = upload['size']
+        request = upload.get('request')
+        if request is None:
+            service = get_service()
+            mime_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            upload['file'].seek(0)
+            media = MediaIoBaseUpload(upload['file'], mimetype=mime_type, chunksize=self.chunk_size,
+                                      resumable=upload['resumable'])
+            if file_id is None:
+                request = service.files().create(body={'name': name, 'parents': [parent_id]}, media_body=media,
+                                                 fields=REMOTE_FIELDS, supportsAllDrives=True)
+            else:
+                request = service.files().update(fileId=file_id, body={}, media_body=media, fields=REMOTE_FIELDS,
+                                                 supportsAllDrives=True)
+            if not upload['resumable']:
+                # Metadata and content in one multipart request
+                item = request.execute()
+                self.count_bytes(size)
+                return item
+            upload['request'] = request
+
+        item = None
+        while item is None:
+            # A failed chunk leaves the session in an error state; the next call asks Drive where to resume
+            sent = request.resumable_progress
+            _, item = request.next_chunk()
+            self.count_bytes((size if item is not None else request.resumable_progress) - sent)
+        return item
+
+    def find_uploaded(self, name, parent_id, md5):
+        """A file named name in parent_id with checksum md5, e.g. created by a request whose response was lost."""
+        results = get_service().files().list(
+            q=f"name = {quote(name)} and '{parent_id}' in parents and trashed=false", fields=f"files({REMOTE_FIELDS})",
+            supportsAllDrives=True, includeItemsFromAllDrives=True
+        ).execute()
+        return next((item for item in results.get('files', []) if item.get('md5Checksum') == md5), None)
+
+    def count_bytes(self, byte_count):
+        self.metrics.inc('drive_upload_bytes_total', byte_count, worker=threading.current_thread().name)
+        if self.progress_bar is not None:
+            self.progress_bar.update(byte_count)
+
+    async def upload_file_async(self, relative_path, file_path, checksum, parent_id, file_id, semaphore):
+        md5, size, mtime_ns = checksum
+        name = relative_path.rpartition('/')[2]
+        loop = asyncio.get_event_loop()
+        upload = {'size': size, 'resumable': size >= self.resumable_threshold, 'attempts': 0}
+
+        async def request():
+            # A create whose response was lost may have created the file; a multipart create is only sent again
+            # when it didn't. Resumable uploads continue their session, and updates can simply be repeated.
+            if upload['attempts'] and file_id is None and not upload['resumable']:
+                item = await loop.run_in_executor(self.executor, self.find_uploaded, name, parent_id, md5)
+                if item is not None:
+                    return item
+            upload['attempts'] += 1
+            return await loop.run_in_executor(self.executor, self.upload_file, upload, name, parent_id, file_id)
+
+        async with semaphore:
+            try:
+                with open(file_path, 'rb') as upload['file']:
+                    item = await self.controller.call(request, endpoint='files.update' if file_id else 'files.create')
+                if item.get('md5Checksum') not in (None, md5):
+                    raise IOError(f"checksum mismatch, local {md5}, uploaded {item['md5Checksum']}")
+            except Exception as e:
+                print(f"Failed to upload {relative_path}: {e}")
+                self.failed_files.append((relative_path, str(e)))
+                self.stats['failed'] += 1
+                self.metrics.inc('drive_upload_files_total', status='failed')
+                return
+        status = 'updated' if file_id else 'uploaded'
+        self.stats[status] += 1
+        self.metrics.inc('drive_upload_files_total', status=status)
+        with self.lock:
+            self.state[relative_path] = {'size': size, 'mtime_ns': mtime_ns, 'md5': md5, 'id': item['id']}
+
+    async def upload_folder(self, local_folder):
+        """Mirror local_folder into the root folder. Returns the stats."""
+        loop = asyncio.get_event_loop()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_uploads, thread_name_prefix='upload') as executor:
+            self.executor = executor
+            if self.folder_ids is None:
+                from RecursiveFolderFetcher import RecursiveFolderFetcher
+
+                folder_fetcher = RecursiveFolderFetcher(max_concurrent_calls=self.max_concurrent_uploads,
+                                                        batch_parents=True, controller=self.controller)
+                await folder_fetcher.fetch_all_folders(self.root_folder_id)
+                self.folder_ids = folder_fetcher.folder_paths(self.root_folder_id)
+
+            folders, files = self.scan(local_folder)
+            known_folders = set(self.folder_ids.values())
+            await self.create_folders(folders)
+
+            # Hash in the pool while the remote files are listed; only folders that existed can have files, and
+            # the folders of files uploaded before are listed too, to find where moved files are
+            checksums = asyncio.gather(*[loop.run_in_executor(executor, self.checksum, relative_path, file_path)
+                                         for relative_path, file_path in files.items()])
+            listed_folders = {self.folder_ids.get(relative_path.rpartition('/')[0])
+                              for relative_path in list(files) + list(self.state)}
+            remote_items = await self.list_remote_files(listed_folders & known_folders)
+            checksums = dict(zip(files, await checksums))
+
+            moves, uploads = self.plan(files, checksums, remote_items)
+            await self.move_files(moves, checksums)
+
+            # Largest first, so a big file doesn't start last and hold up the end of the run
+            uploads.sort(key=lambda upload: -checksums[upload[0]][1])
+            semaphore = asyncio.Semaphore(self.max_concurrent_uploads)
+            self.open_progress_bar(sum(checksums[upload[0]][1] for upload in uploads))
+            try:
+                await asyncio.gather(*[
+                    self.upload_file_async(relative_path, files[relative_path], checksums[relative_path], parent_id,
+                                           file_id, semaphore)
+                    for relative_path, parent_id, file_id in uploads
+                ])
+            finally:
+                self.close_progress_bar()
+        self.executor = None
+
+        # Files removed locally are forgotten; their remote copies are left alone
+        with self.lock:
+            self.state = {relative_path: entry for relative_path, entry in self.state.items() if relative_path in files}
+        self.save()
+        if self.failed_files:
+            print(f"{len(self.failed_files)} files failed to upload")
+        print(f"Upload of {local_folder}: {self.stats}")
+        return self.stats
+
+    def plan(self, files, checksums, remote_items):
+        """Sort the local files into moves [(relative path, item)] and uploads [(relative path, parent id, file id)].
+
+        Unchanged files are recorded right away.
+        """
+        remote_by_name = {}
+        for item in remote_items:
+            for parent_id in item.get('parents', []):
+                remote_by_name.setdefault((parent_id, item['name']), item)
+        remote_by_id = {item['id']: item for item in remote_items}
+
+        # Remote files uploaded from a path that is gone locally, by checksum, for moved and renamed files
+        moved_away = {}
+        for relative_path, entry in self.state.items():
+            item = remote_by_id.get(entry['id'])
+            if relative_path not in files and item is not None and item.get('md5Checksum') == entry['md5']:
+                moved_away.setdefault(entry['md5'], []).append(item)
+
+        moves, uploads = [], []
+        for relative_path in files:
+            md5, size, mtime_ns = checksums[relative_path]
+            folder_path, _, name = relative_path.rpartition('/')
+            parent_id = self.folder_ids.get(folder_path)
+            if parent_id is None:
+                self.failed_files.append((relative_path, "folder could not be created"))
+                self.stats['failed'] += 1
+                continue
+
+            item = remote_by_name.get((parent_id, name))
+            if item is None and moved_away.get(md5):
+                moves.append((relative_path, moved_away[md5].pop()))
+            elif item is None:
+                uploads.append((relative_path, parent_id, None))
+            elif item.get('md5Checksum') == md5:
+                self.stats['unchanged'] += 1
+                self.metrics.inc('drive_upload_files_total', status='unchanged')
+                self.state[relative_path] = {'size': size, 'mtime_ns': mtime_ns, 'md5': md5, 'id': item['id']}
+            elif 'md5Checksum' not in item:
+                # A Google-native document of the same name; replacing it with a binary upload would convert it
+                print(f"Skipping {relative_path}: a Google-native document has its name")
+                self.stats['conflicts'] += 1
+            else:
+                uploads.append((relative_path, parent_id, item['id']))
+        return moves, uploads
+
+    async def move_files(self, moves, checksums):
+        """Rename and move remote files to their new local paths, in batch requests."""
+        calls = []
+        for relative_path, item in moves:
+            folder_path, _, name = relative_path.rpartition('/')
+            parent_id = self.folder_ids[folder_path]
+            params = {'fileId': item['id'], 'body': {'name': name}, 'fields': 'id', 'supportsAllDrives': True}
+            if parent_id not in item['parents']:
+                params.update(addParents=parent_id, removeParents=','.join(item['parents']))
+            calls.append((relative_path, lambda service, params=params: service.files().update(**params)))
+
+        moved, failures = await self.run_batches(calls, 'files.update')
+        for relative_path, item in moved.items():
+            md5, size, mtime_ns = checksums[relative_path]
+            self.state[relative_path] = {'size': size, 'mtime_ns': mtime_ns, 'md5': md5, 'id': item['id']}
+        self.stats['moved'] += len(moved)
+        self.metrics.inc('drive_upload_files_total', len(moved), status='moved')
+        for relative_path, error in failures.items():
+            print(f"Failed to move {relative_path}: {error}")
+            self.failed_files.append((relative_path, str(error)))
+            self.stats['failed'] += 1
+
+    def open_progress_bar(self, total):
+        from tqdm import tqdm
+
+        self.progress_bar = tqdm(total=total, desc="Uploading files", unit='B', unit_scale=True, unit_divisor=1024)
+
+    def close_progress_bar(self):
+        self.progress_bar.close()
+        self.progress_bar = None
+
+
+# Example usage
+if __name__ == '__main__':
+    # Upload a local folder into a Drive folder, creating the folder tree as needed
+    root_folder_id = '1VWELDrSkd1wAbR-L8sho4-eVQmNpxRx8'  # Replace with the actual folder ID if needed
+    file_uploader = FileUploader(root_folder_id, max_concurrent_uploads=20)
+    asyncio.run(file_uploader.upload_folder('./artifacts'))
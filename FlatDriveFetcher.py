@@ -0,0 +1,112 @@
+from collections import defaultdict
+
+from FileRecord import FileRecord
+from SyncManifest import SyncManifest
+from drive_query import DriveQuery
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class FlatDriveFetcher:
+    """Lists a whole drive (or corpus) with flat paginated calls and rebuilds the folder tree in memory."""
+
+    def __init__(self, service, mime_types=None, drive_id=None, index=None, query=None):
+        self.service = service
+        self.index = index  # Optional MetadataIndex that receives every listing page
+        self.drive_id = drive_id  # Shared drive to list; None lists everything the user can see
+        # Supported MIME types and other filters, pushed into the listing query where Drive supports them
+        self.query = query or DriveQuery(mime_types or None)
+        self.mime_types = self.query.mime_types
+        self.items = {}  # id -> (name, mime_type)
+        self.children = defaultdict(list)  # parent id -> [child ids]
+        self.file_metadata = {}  # Map of file id -> listing fields (md5Checksum, modifiedTime, version, size)
+        self.api_calls = 0  # Number of files().list calls made
+
+    def list_pages(self, query, fields):
+        """Yield each page of a flat listing across the drive or corpus."""
+        if self.drive_id:
+            corpus = {'corpora': 'drive', 'driveId': self.drive_id}
+        else:
+            corpus = {'corpora': 'allDrives'}
+
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                pageSize=1000,
+                fields=fields,
+                pageToken=page_token,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+                q=query,
+                **corpus
+            ).execute()
+            self.api_calls += 1
+
+            yield results.get('files', [])
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+    def add_items(self, items):
+        if self.index is not None:
+            self.index.add_items(items)
+        for item in items:
+            self.items[item['id']] = (item['name'], item['mimeType'])
+            for parent_id in item.get('parents', []):
+                self.children[parent_id].append(item['id'])
+
+    def index_folders(self):
+        """Stream every folder into the parent -> children index."""
+        folders = DriveQuery.folders()
+        for items in self.list_pages(folders.q(), folders.fields("id, name, mimeType, parents")):
+            self.add_items(items)
+
+    def index_files(self, excluded_folders=()):
+        """Stream every file of a supported MIME type into the parent -> children index.
+
+        When the folders are indexed already, files directly in excluded_folders and their subfolders are
+        left out by the query itself.
+        """
+        excluded_parents = [folder_id for root_id in excluded_folders if root_id in self.items
+                            for folder_id in [root_id] + self.folders_under(root_id)]
+        query = self.query.excluding(excluded_parents) if excluded_parents else self.query
+        for items in self.list_pages(query.q(), query.fields(f"parents, {SyncManifest.LISTING_FIELDS}")):
+            items = query.filter(items)
+            self.add_items(items)
+            self.file_metadata.update({item['id']: item for item in items})
+
+    def walk(self, root_id, excluded_folders=()):
+        """Yield (item_id, path) for everything below root_id, skipping excluded folders and their subtrees."""
+        excluded_folders = set(excluded_folders)
+        visited = {root_id}
+        stack = [(root_id, '')]
+
+        while stack:
+            folder_id, folder_path = stack.pop()
+            for child_id in self.children.get(folder_id, []):
+                name, mime_type = self.items[child_id]
+                path = f"{folder_path}/{name}" if folder_path else name
+                if mime_type == FOLDER_MIME_TYPE:
+                    # Folders can have several parents; visit each one once
+                    if child_id in excluded_folders or child_id in visited:
+                        continue
+                    visited.add(child_id)
+                    stack.append((child_id, path))
+                yield child_id, path
+
+    def folders_under(self, root_id, excluded_folders=()):
+        return [item_id for item_id, _ in self.walk(root_id, excluded_folders)
+                if self.items[item_id][1] == FOLDER_MIME_TYPE]
+
+    def iter_files_under(self, root_id, excluded_folders=()):
+        """Yield FileRecords for all files under root_id, minus excluded folders, with folder_name set to the path."""
+        for item_id, path in self.walk(root_id, excluded_folders):
+            name, mime_type = self.items[item_id]
+            if mime_type != FOLDER_MIME_TYPE:
+                metadata = self.file_metadata.get(item_id, {'id': item_id, 'name': name, 'mimeType': mime_type})
+                yield FileRecord.from_item(metadata, folder_name=path)
+
+    def files_under(self, root_id, excluded_folders=()):
+        """Return (file_name, file_id, mime_type, path) for all files under root_id, minus excluded folders."""
+        return [tuple(record) for record in self.iter_files_under(root_id, excluded_folders)]
@@ -1,73 +1,197 @@
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from googleapiclient.discovery import build
 
+from FileRecord import FileRecord
 from RecursiveFolderFetcher import RecursiveFolderFetcher
-from authenticate import authenticate
+from SyncManifest import SyncManifest
+from RateController import get_default_controller
+from authenticate import get_service
+from drive_query import DEFAULT_MAX_QUERY_LENGTH, DriveQuery, batch_parent_ids
 
 
 class FolderFilesFetcher:
-    def __init__(self, folder_ids, max_concurrent_calls=20):
+    def __init__(self, folder_ids, max_concurrent_calls=20, batch_parents=False,
+                 max_query_length=DEFAULT_MAX_QUERY_LENGTH, client=None,
+                 controller=None, index=None, query=None):
         self.folder_ids = folder_ids  # List of (folder_id, folder_name) tuples
         self.max_concurrent_calls = max_concurrent_calls  # Limit parallel API calls
         self.semaphore = asyncio.Semaphore(max_concurrent_calls)
+        self.batch_parents = batch_parents  # Pack many parent ids into one query per list call
+        self.max_query_length = max_query_length  # Upper bound for a packed parents query
+        self.api_calls = 0  # Number of files().list calls made
+        self.executor = None  # Thread pool running the blocking API calls, set while fetching
+        self.client = client  # Optional AsyncDriveClient used instead of the thread pool
+        self.controller = controller or get_default_controller()  # Shared rate limit and retry budget
+        self.index = index  # Optional MetadataIndex that receives every listing page
         self.final_file_list = []  # Store tuples of (file_name, file_id, mime_type, folder_name)
-
-        # Supported MIME types
-        self.mime_types = [
-            "text/plain",
-            "application/vnd.google-apps.document",  # Google Docs
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",  # Word Document
-            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",  # Excel Spreadsheet
-            "application/pdf",  # PDF
-            "application/vnd.google-apps.presentation",  # Google Slides
-            "application/vnd.openxmlformats-officedocument.presentationml.presentation",  # PowerPoint Presentation
-            "application/vnd.google-apps.spreadsheet",  # Google Sheets
-            "application/json"  # JSON
-        ]
+        self.file_parents = {}  # Map of file id -> folder id it was listed in
+        self.file_metadata = {}  # Map of file id -> listing fields (md5Checksum, modifiedTime, version, size)
+        # Supported MIME types and other filters, pushed into the listing query where Drive supports them
+        self.query = query or DriveQuery(max_query_length=max_query_length)
 
     def create_service(self):
-        # Authenticate or create a new service instance
-        return build('drive', 'v3', credentials=authenticate())
+        # Reuse the calling thread's service and its keep-alive connection
+        return get_service()
 
-    async def fetch_files_in_folder(self, folder_id, folder_name):
-        """Asynchronously fetch files in a given folder ID, filtered by supported MIME types."""
+    async def list_page(self, **params):
+        """Run one files().list call, natively when an AsyncDriveClient is set, otherwise in the thread pool.
+
+        The call goes through the rate controller, which retries throttled and failed requests.
+        """
+        async def request():
+            if self.client is not None:
+                return await self.client.list_files(**params)
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, lambda: self.create_service().files().list(**params).execute()
+            )
+
+        return await self.controller.call(request, endpoint='files.list')
+
+    async def iter_folder_pages(self, folder_id, folder_name):
+        """Yield each listing page of a folder's files as a list of FileRecords, keeping nothing."""
+        async with self.semaphore:
+            page_token = None
+
+            while True:
+                results = await self.list_page(
+                    pageSize=1000,
+                    fields=self.query.fields(SyncManifest.LISTING_FIELDS),
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                    q=self.query.q(folder_id)
+                )
+                self.api_calls += 1
+
+                items = self.query.filter(results.get('files', []))
+                if self.index is not None:
+                    self.index.add_items(items, parent_id=folder_id)
+                yield [FileRecord.from_item(item, folder_id, folder_name) for item in items]
+
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+
+    async def iter_batch_pages(self, folders):
+        """Yield the FileRecords of several (folder_id, folder_name) folders listed with one packed parents query."""
         async with self.semaphore:
-            service = await asyncio.get_event_loop().run_in_executor(None, self.create_service)
+            folder_names = dict(folders)
             page_token = None
-            mime_types_query = " or ".join([f"mimeType='{mime_type}'" for mime_type in self.mime_types])
-            query = f"({mime_types_query}) and '{folder_id}' in parents and trashed=false"
 
             while True:
-                results = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: service.files().list(
-                        pageSize=1000,
-                        fields="nextPageToken, files(id, name, mimeType)",
-                        pageToken=page_token,
-                        supportsAllDrives=True,
-                        includeItemsFromAllDrives=True,
-                        q=query
-                    ).execute()
+                results = await self.list_page(
+                    pageSize=1000,
+                    fields=self.query.fields(f"parents, {SyncManifest.LISTING_FIELDS}"),
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                    q=self.query.q(list(folder_names))
                 )
+                self.api_calls += 1
+
+                items = self.query.filter(results.get('files', []))
+                if self.index is not None:
+                    self.index.add_items(items)
 
-                items = results.get('files', [])
-                self.final_file_list.extend([(item['name'], item['id'], item['mimeType'], folder_name) for item in items])
+                # Spread the results back to each folder of the batch, as separate per-folder calls would
+                yield [FileRecord.from_item(item, parent_id, folder_names[parent_id])
+                       for item in items for parent_id in item.get('parents', []) if parent_id in folder_names]
 
                 page_token = results.get('nextPageToken')
                 if not page_token:
                     break
 
+    def add_records(self, records):
+        """Keep streamed records in final_file_list, file_parents and file_metadata, and return them as tuples."""
+        folder_files = []
+        for record in records:
+            folder_files.append((record.name, record.id, record.mime_type, record.folder_name))
+            self.file_parents[record.id] = record.parent_id
+            self.file_metadata[record.id] = record.metadata()
+        self.final_file_list.extend(folder_files)
+        return folder_files
+
+    async def fetch_files_in_folder(self, folder_id, folder_name):
+        """Asynchronously fetch files in a given folder ID, filtered by supported MIME types.
+
+        The files are added to final_file_list and also returned, so a caller can pass them on right away.
+        """
+        folder_files = []
+        async for records in self.iter_folder_pages(folder_id, folder_name):
+            folder_files.extend(self.add_records(records))
+        return folder_files
+
+    async def fetch_files_in_folders(self, folders):
+        """Fetch files of several (folder_id, folder_name) folders with one packed parents query."""
+        async for records in self.iter_batch_pages(folders):
+            self.add_records(records)
+
+    def folder_batches(self):
+        """Group folder_ids into packed parents queries of at most max_query_length characters."""
+        folder_names = dict(self.folder_ids)
+        for batch in batch_parent_ids(list(folder_names), self.query.q(), self.max_query_length):
+            yield [(folder_id, folder_names[folder_id]) for folder_id in batch]
+
+    async def iter_all_files(self, max_pending_pages=None):
+        """Yield pages of FileRecords from every folder as they arrive, without keeping any of them.
+
+        At most max_pending_pages pages wait for the consumer; listing pauses while it catches up, so memory
+        stays bounded by the page size rather than the size of the drive.
+        """
+        pages = asyncio.Queue(maxsize=max_pending_pages or self.max_concurrent_calls)
+
+        async def produce(page_iterator):
+            async for records in page_iterator:
+                await pages.put(records)
+                self.controller.metrics.set('sync_queue_depth', pages.qsize(), queue='listing_pages')
+
+        async def produce_all(page_iterators):
+            # A sentinel follows the last page, or the first listing error, which the consumer then re-raises
+            try:
+                await asyncio.gather(*[produce(page_iterator) for page_iterator in page_iterators])
+            except Exception:
+                await pages.put(None)
+                raise
+            await pages.put(None)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_calls) as executor:
+            self.executor = executor
+            if self.batch_parents:
+                page_iterators = [self.iter_batch_pages(folders) for folders in self.folder_batches()]
+            else:
+                page_iterators = [self.iter_folder_pages(folder_id, folder_name)
+                                  for folder_id, folder_name in self.folder_ids]
+            producers = asyncio.ensure_future(produce_all(page_iterators))
+
+            try:
+                while True:
+                    records = await pages.get()
+                    if records is None:
+                        break
+                    yield records
+                await producers
+            finally:
+                producers.cancel()
+                self.executor = None
+
     async def fetch_all_files(self):
         """Fetch all files from each folder ID in parallel."""
+        print(f"Listing files with filters {self.query.report()}")
         with ThreadPoolExecutor(max_workers=self.max_concurrent_calls) as executor:
+            self.executor = executor
             tasks = []
-            for folder_id, folder_name in self.folder_ids:
-                # Schedule fetching files in each folder
-                tasks.append(asyncio.ensure_future(self.fetch_files_in_folder(folder_id, folder_name)))
+            if self.batch_parents:
+                # Schedule one packed query per batch of folders
+                for folders in self.folder_batches():
+                    tasks.append(asyncio.ensure_future(self.fetch_files_in_folders(folders)))
+            else:
+                for folder_id, folder_name in self.folder_ids:
+                    # Schedule fetching files in each folder
+                    tasks.append(asyncio.ensure_future(self.fetch_files_in_folder(folder_id, folder_name)))
 
             # Await all tasks to complete
             await asyncio.gather(*tasks)
+        self.executor = None
 
 # Example usage
 if __name__ == '__main__':
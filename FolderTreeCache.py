@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from drive_query import DEFAULT_MAX_QUERY_LENGTH, batch_parent_ids, drive_time, parents_query
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Items modified shortly before a folder was listed still count as changes, in case of clock skew
+CLOCK_SKEW_SECONDS = 300
+
+
+class FolderTreeCache:
+    """Folder tree of earlier crawls, so the children of unchanged folders aren't listed again.
+
+    Each folder keeps its child folders (id, name, modifiedTime), optionally its files, a fingerprint of that
+    listing and when it was listed. A folder's own modifiedTime doesn't change when its children do, so
+    before a crawl the cached folders are revalidated with packed parents queries for items modified since
+    they were listed: one list call per batch of folders, usually with no results. Folders with such a child
+    are listed again, the others reuse their cached children.
+
+    Deleted children and items moved in without being modified don't show up in those queries; folders
+    listed longer than ttl seconds ago are always listed again, and force_refresh ignores the cache.
+    """
+
+    def __init__(self, cache_file='folder_tree.json', ttl=7 * 24 * 3600, force_refresh=False):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.force_refresh = force_refresh
+        # folder id -> {"folders": [[id, name, modifiedTime]], "files": [items], "files_key", "fingerprint",
+        # "listed_at"}
+        self.folders = {}
+        # Folders revalidated or listed in this run, whose cached children can be used -> whether their files
+        # were checked too
+        self.fresh = {}
+        self.stats = {'reused': 0, 'listed': 0, 'changed': 0}
+        self.lock = threading.Lock()  # Listings are recorded from executor threads too
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                self.folders = json.load(f)
+
+    def save(self):
+        with self.lock:
+            tmp_file = f"{self.cache_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.folders, f)
+            os.replace(tmp_file, self.cache_file)
+
+    @staticmethod
+    def fingerprint(items):
+        digest = hashlib.sha1()
+        for item in sorted(items, key=lambda item: item['id']):
+            digest.update(f"{item['id']}\t{item.get('name')}\t{item.get('modifiedTime')}\t"
+                          f"{item.get('md5Checksum')}\n".encode('utf-8'))
+        return digest.hexdigest()
+
+    def record(self, folder_id, folders, files=None, files_key=None, listed_at=None):
+        """Store a fresh listing of folder_id: child folder items (id, name, modifiedTime) and optionally files.
+
+        files_key identifies the query the files were listed with, so another file filter doesn't reuse them.
+        listed_at is when the listing started, defaulting to now.
+        """
+        entry = {
+            'folders': [[item['id'], item['name'], item.get('modifiedTime')] for item in folders],
+            'fingerprint': self.fingerprint(list(folders) + list(files or [])),
+            'listed_at': time.time() if listed_at is None else listed_at,
+        }
+        if files is not None:
+            entry['files'] = files
+            entry['files_key'] = files_key
+
+        with self.lock:
+            previous = self.folders.get(folder_id)
+            self.folders[folder_id] = entry
+            self.fresh[folder_id] = files is not None
+            self.stats['listed'] += 1
+            if previous is None:
+                return
+            if previous.get('files_key') == files_key and previous['fingerprint'] != entry['fingerprint']:
+                self.stats['changed'] += 1
+            # Folders that are no longer children take their cached subtrees with them
+            removed = {child[0] for child in previous['folders']} - {child[0] for child in entry['folders']}
+            for removed_id in removed:
+                for subfolder_id in self.subtree(removed_id):
+                    self.folders.pop(subfolder_id, None)
+                    self.fresh.pop(subfolder_id, None)
+
+    def subtree(self, folder_id):
+        """Cached folder ids under folder_id, including itself, parents before children."""
+        folder_ids = []
+        seen = set()
+        to_visit = [folder_id]
+        while to_visit:
+            current_id = to_visit.pop()
+            if current_id in seen or current_id not in self.folders:
+                continue
+            seen.add(current_id)
+            folder_ids.append(current_id)
+            to_visit.extend(child[0] for child in reversed(self.folders[current_id]['folders']))
+        return folder_ids
+
+    def revalidation_queries(self, root_folder_id, folders_only=False, max_query_length=DEFAULT_MAX_QUERY_LENGTH):
+        """Yield (query, folder_ids): packed queries for children modified since the folders were listed.
+
+        Folders past the ttl are left out and will be listed again. folders_only limits the queries to
+        child folders, for crawls that don't cache files.
+        """
+        if self.force_refresh:
+            return
+        now = time.time()
+        with self.lock:
+            listed_at = {folder_id: self.folders[folder_id]['listed_at'] for folder_id in self.subtree(root_folder_id)}
+        # Folders listed at about the same time share a batch, so each batch's cutoff fits all of its folders
+        candidates = sorted((folder_id for folder_id, listed in listed_at.items() if now - listed < self.ttl),
+                            key=listed_at.get)
+
+        def base_query(since):
+            query = f"modifiedTime > '{drive_time(since - CLOCK_SKEW_SECONDS)}'"
+            return f"mimeType='{FOLDER_MIME_TYPE}' and {query}" if folders_only else query
+
+        for batch in batch_parent_ids(candidates, base_query(now), max_query_length):
+            yield parents_query(base_query(min(listed_at[folder_id] for folder_id in batch)), batch), batch
+
+    def revalidate(self, folder_ids, changed_items, files_checked=True):
+        """Mark folder_ids fresh, except those that are parents of changed_items (items with parents).
+
+        files_checked is False when the query only looked at child folders.
+        """
+        changed_parents = {parent_id for item in changed_items for parent_id in item.get('parents', [])}
+        with self.lock:
+            for folder_id in folder_ids:
+                if folder_id not in changed_parents and folder_id in self.folders:
+                    self.fresh[folder_id] = files_checked
+
+    def is_fresh(self, folder_id, files_key=None):
+        """True if the cached children of folder_id can be used; with files_key, its cached files too."""
+        if self.force_refresh or folder_id not in self.fresh:
+            return False
+        if files_key is None:
+            return True
+        return self.fresh[folder_id] and self.folders[folder_id].get('files_key') == files_key
+
+    def children(self, folder_id):
+        """Cached child folders of folder_id as (id, name)."""
+        with self.lock:
+            self.stats['reused'] += 1
+            return [(child_id, name) for child_id, name, _ in self.folders[folder_id]['folders']]
+
+    def child_items(self, folder_id):
+        """Cached child folders of folder_id as items with id, name and modifiedTime."""
+        with self.lock:
+            self.stats['reused'] += 1
+            return [{'id': child_id, 'name': name, 'modifiedTime': modified_time}
+                    for child_id, name, modified_time in self.folders[folder_id]['folders']]
+
+    def files(self, folder_id):
+        return self.folders[folder_id].get('files', [])
@@ -0,0 +1,172 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    md5_checksum TEXT,
+    size INTEGER,
+    modified_time TEXT,
+    version TEXT,
+    trashed INTEGER NOT NULL DEFAULT 0,
+    listed_at TEXT NOT NULL,
+    local_path TEXT,
+    sync_state TEXT,
+    synced_at TEXT
+);
+CREATE TABLE IF NOT EXISTS parents (
+    file_id TEXT NOT NULL,
+    parent_id TEXT NOT NULL,
+    PRIMARY KEY (file_id, parent_id)
+);
+CREATE TABLE IF NOT EXISTS content (
+    file_id TEXT PRIMARY KEY,
+    content_key TEXT NOT NULL,
+    text TEXT NOT NULL,
+    properties TEXT,
+    extracted_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parents_by_parent ON parents (parent_id);
+CREATE INDEX IF NOT EXISTS files_by_mime_type ON files (mime_type);
+CREATE INDEX IF NOT EXISTS files_by_modified_time ON files (modified_time);
+CREATE INDEX IF NOT EXISTS files_by_md5_checksum ON files (md5_checksum);
+'''
+
+FILE_COLUMNS = "id, name, mime_type, md5_checksum, size, modified_time, version, local_path, sync_state"
+
+
+class MetadataIndex:
+    """Persistent SQLite (WAL) index of listed files, folders, parents, checksums and sync state."""
+
+    def __init__(self, db_file='drive_index.sqlite'):
+        self.db_file = db_file
+        # Pages are added from the event loop and sync state from download threads, so one connection is shared
+        # behind a lock
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def add_items(self, items, parent_id=None, mime_type=None):
+        """Bulk insert one listing page.
+
+        Items carry Drive fields (id, name, mimeType, parents, md5Checksum, size, ...). Per-folder listings
+        don't request parents or mimeType, so parent_id and mime_type fill them in.
+        """
+        if not items:
+            return
+        listed_at = datetime.now(timezone.utc).isoformat()
+        file_rows = []
+        parent_rows = []
+        for item in items:
+            file_rows.append((
+                item['id'], item['name'], item.get('mimeType', mime_type), item.get('md5Checksum'),
+                int(item['size']) if item.get('size') is not None else None, item.get('modifiedTime'),
+                item.get('version'), 1 if item.get('trashed') else 0, listed_at,
+            ))
+            for parent in item.get('parents', [parent_id] if parent_id else []):
+                parent_rows.append((item['id'], parent))
+
+        with self.lock, self.connection:
+            # Upsert keeps the local sync state of files that were listed before
+            self.connection.executemany(
+                '''INSERT INTO files (id, name, mime_type, md5_checksum, size, modified_time, version, trashed, listed_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET
+                       name=excluded.name, mime_type=excluded.mime_type, md5_checksum=excluded.md5_checksum,
+                       size=excluded.size, modified_time=excluded.modified_time, version=excluded.version,
+                       trashed=excluded.trashed, listed_at=excluded.listed_at''',
+                file_rows
+            )
+            # The parents of a listing replace what was known, so a moved file leaves its old folder; Drive files
+            # have one parent, so a per-folder listing's parent_id replaces it too
+            self.connection.executemany("DELETE FROM parents WHERE file_id = ?",
+                                        [(item['id'],) for item in items if 'parents' in item or parent_id])
+            self.connection.executemany("INSERT OR IGNORE INTO parents (file_id, parent_id) VALUES (?, ?)",
+                                        parent_rows)
+
+    def mark_trashed(self, file_ids):
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE files SET trashed = 1 WHERE id = ?",
+                                        [(file_id,) for file_id in file_ids])
+
+    def set_sync_state(self, file_id, sync_state, local_path=None):
+        """Record the outcome of syncing a file, e.g. 'downloaded', 'linked' or 'failed'."""
+        synced_at = datetime.now(timezone.utc).isoformat()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE files SET sync_state = ?, local_path = COALESCE(?, local_path), synced_at = ? WHERE id = ?",
+                (sync_state, local_path, synced_at, file_id)
+            )
+
+    def set_content(self, file_id, content_key, text, properties=None):
+        """Store the extracted text and properties of a file, with the checksum or version they came from."""
+        extracted_at = datetime.now(timezone.utc).isoformat()
+        with self.lock, self.connection:
+            self.connection.execute(
+                '''INSERT INTO content (file_id, content_key, text, properties, extracted_at) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(file_id) DO UPDATE SET
+                       content_key=excluded.content_key, text=excluded.text, properties=excluded.properties,
+                       extracted_at=excluded.extracted_at''',
+                (file_id, content_key, text, json.dumps(properties) if properties is not None else None, extracted_at)
+            )
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(sql, params).fetchall()]
+
+    def files_in_folder(self, folder_id):
+        """Files and folders directly inside folder_id."""
+        return self.query(
+            f'''SELECT {FILE_COLUMNS} FROM files JOIN parents ON parents.file_id = files.id
+                WHERE parents.parent_id = ? AND trashed = 0 ORDER BY name''',
+            (folder_id,)
+        )
+
+    def files_under(self, folder_id, mime_types=None):
+        """Non-folder files anywhere below folder_id, optionally limited to some MIME types."""
+        sql = f'''
+            WITH RECURSIVE tree(id) AS (
+                SELECT ?
+                UNION
+                SELECT parents.file_id FROM parents JOIN tree ON parents.parent_id = tree.id
+                JOIN files ON files.id = parents.file_id
+                WHERE files.mime_type = '{FOLDER_MIME_TYPE}' AND files.trashed = 0
+            )
+            SELECT DISTINCT {', '.join(f'files.{column.strip()}' for column in FILE_COLUMNS.split(','))}
+            FROM files JOIN parents ON parents.file_id = files.id JOIN tree ON parents.parent_id = tree.id
+            WHERE files.mime_type != '{FOLDER_MIME_TYPE}' AND files.trashed = 0'''
+        params = [folder_id]
+        if mime_types:
+            sql += f" AND files.mime_type IN ({', '.join('?' for _ in mime_types)})"
+            params.extend(mime_types)
+        return self.query(sql, params)
+
+    def changed_since(self, modified_time):
+        """Files modified after an RFC 3339 timestamp such as '2024-10-01T00:00:00Z'."""
+        return self.query(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE modified_time > ? AND trashed = 0 ORDER BY modified_time",
+            (modified_time,)
+        )
+
+    def by_mime_type(self, mime_type):
+        return self.query(f"SELECT {FILE_COLUMNS} FROM files WHERE mime_type = ? AND trashed = 0", (mime_type,))
+
+    def by_sync_state(self, sync_state):
+        return self.query(f"SELECT {FILE_COLUMNS} FROM files WHERE sync_state = ?", (sync_state,))
+
+    def count(self):
+        return self.query("SELECT COUNT(*) AS count FROM files WHERE trashed = 0")[0]['count']
@@ -0,0 +1,177 @@
+import asyncio
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# Latency buckets in seconds, from a fast metadata call to a large download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def current_worker():
+    # Requests on the event loop are attributed to their task, blocking calls to their thread
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task.get_name() if task is not None else threading.current_thread().name
+
+
+class Metrics:
+    """Counters, gauges and histograms for the listing and download stages, with optional trace spans.
+
+    Every metric is keyed by name and labels, e.g. drive_request_duration_seconds{endpoint="files.list"}.
+    Updates take one lock and are cheap enough for the request hot path. The data can be written as
+    Prometheus text or JSON, and spans as a Chrome trace (chrome://tracing or ui.perfetto.dev).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, trace=False, max_spans=100000):
+        self.buckets = buckets
+        self.trace = trace  # Record a span per request; off by default
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self.spans = collections.deque(maxlen=max_spans)  # Oldest spans are dropped on very long runs
+        self.started = time.perf_counter()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def add(self, name, delta, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-1] += value
+
+    def record_span(self, name, start, duration, **attributes):
+        """Keep a finished span when tracing; start is a time.perf_counter() value."""
+        if self.trace:
+            self.spans.append((name, start, duration, current_worker(), attributes))
+
+    @contextlib.contextmanager
+    def span(self, name, histogram=None, **labels):
+        """Time a block, observe it in histogram (if given) and keep it as a span when tracing.
+
+        Yields a dict; attributes added to it, such as a status, are kept on the span but not used as labels.
+        """
+        attributes = {}
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            duration = time.perf_counter() - start
+            if histogram:
+                self.observe(histogram, duration, **labels)
+            self.record_span(name, start, duration, **labels, **attributes)
+
+    def snapshot(self):
+        """All metrics as plain data, for JSON export or printing."""
+        def labelled(items):
+            return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in items]
+
+        with self.lock:
+            histograms = []
+            for (name, labels), histogram in self.histograms.items():
+                cumulative, buckets = 0, {}
+                for bound, count in zip(list(self.buckets) + ['+Inf'], histogram[:-1]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': buckets, 'count': cumulative,
+                                   'sum': histogram[-1]})
+            return {
+                'uptime_seconds': time.perf_counter() - self.started,
+                'counters': labelled(self.counters.items()),
+                'gauges': labelled(self.gauges.items()),
+                'histograms': histograms,
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        """Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for kind, entries in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+            typed = set()
+            for entry in sorted(entries, key=lambda entry: entry['name']):
+                if entry['name'] not in typed:
+                    lines.append(f"# TYPE {entry['name']} {kind}")
+                    typed.add(entry['name'])
+                lines.append(f"{entry['name']}{format_labels(sorted(entry['labels'].items()))} {entry['value']}")
+
+        typed = set()
+        for entry in sorted(snapshot['histograms'], key=lambda entry: entry['name']):
+            name, labels = entry['name'], sorted(entry['labels'].items())
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in entry['buckets'].items():
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {entry['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {entry['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics as JSON for *.json paths, as Prometheus text otherwise."""
+        content = self.to_json() if path.endswith('.json') else self.to_prometheus()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def write_trace(self, path):
+        """Write the recorded spans in the Chrome trace event format."""
+        thread_ids = {}
+        events = []
+        for name, start, duration, worker, attributes in list(self.spans):
+            thread_id = thread_ids.setdefault(worker, len(thread_ids) + 1)
+            events.append({'name': name, 'ph': 'X', 'pid': 1, 'tid': thread_id,
+                           'ts': (start - self.started) * 1e6, 'dur': duration * 1e6,
+                           'args': {key: str(value) for key, value in attributes.items()}})
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread_id, 'args': {'name': worker}}
+                      for worker, thread_id in thread_ids.items())
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events}, f)
+
+
+_default_metrics = None
+
+
+def get_default_metrics():
+    """The process-wide metrics, shared by the rate controller, fetchers and downloader unless told otherwise."""
+    global _default_metrics
+    if _default_metrics is None:
+        _default_metrics = Metrics()
+    return _default_metrics
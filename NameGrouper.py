@@ -0,0 +1,200 @@
+import functools
+import hashlib
+import os
+import random
+import re
+from array import array
+
+# Mersenne prime modulus for the MinHash permutations
+MINHASH_PRIME = (1 << 61) - 1
+# Signatures keep the low 16 bits of each MinHash value; chance agreements (1 in 65536) barely move the estimate
+SIGNATURE_BITS = 16
+SIGNATURE_MASK = (1 << SIGNATURE_BITS) - 1
+# Words that say nothing about which document a name refers to, left out of similarity comparisons
+STOPWORDS = frozenset(['the', 'and', 'of', 'for', 'to', 'in', 'on', 'copy'])
+
+
+class NameGrouper:
+    """Drops files whose names belong to a large group of near-identical names (numbered copies, dated exports).
+
+    Names are normalized to a base name by a precompiled tokenizer: numeric tokens and short tokens that
+    contain a digit (v2, 03, q4) are dropped and the rest is joined and lowercased. Filtering takes two
+    passes over the items: the first only counts group sizes, the second yields the items of groups smaller
+    than threshold in their original order. No group lists are built, so memory is one counter per base
+    name, or a 16-bit MinHash signature and a few integers per file in similarity mode.
+
+    In similarity mode names are also grouped when their token sets, without the extension and stopwords, are
+    similar, which catches variants like "Report final (copy)". LSH banding only proposes candidates: a pair
+    is joined in the union-find over the files when its signatures estimate a Jaccard similarity of at least
+    similarity_threshold, so one shared token such as "guideline" doesn't chain unrelated names together.
+    """
+
+    TOKEN_PATTERN = re.compile(r'\W+')
+
+    def __init__(self, threshold=5, token_pattern=TOKEN_PATTERN, drop_numbers=True, short_token_length=2,
+                 lowercase=True, similarity=False, similarity_threshold=0.7, stopwords=STOPWORDS, num_perm=48,
+                 bands=6, max_bucket_size=64, seed=1, token_cache_size=100000):
+        self.threshold = threshold  # Groups of at least this many files are dropped
+        self.token_pattern = re.compile(token_pattern) if isinstance(token_pattern, str) else token_pattern
+        self.drop_numbers = drop_numbers  # Drop purely numeric tokens
+        self.short_token_length = short_token_length  # Drop tokens up to this length that contain a digit
+        self.lowercase = lowercase
+        self.similarity = similarity  # Also group names with similar token sets
+        self.similarity_threshold = similarity_threshold  # Estimated Jaccard similarity needed to join two names
+        self.stopwords = frozenset(stopwords)
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands  # More bands (fewer rows each) propose more candidate pairs to compare
+        self.rows = num_perm // bands
+        self.max_bucket_size = max_bucket_size  # Candidates kept per LSH bucket, which bounds the comparisons
+        # The built-in hash() of strings is salted per process; tokens are hashed with a keyed blake2b so the
+        # same names and seed always give the same groups
+        self.hash_key = str(seed).encode('utf-8')
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME)) for _ in range(num_perm)]
+        self.token_signature = functools.lru_cache(maxsize=token_cache_size)(self.token_signature)
+
+    def tokens(self, name):
+        tokens = []
+        for token in self.token_pattern.split(name.lower() if self.lowercase else name):
+            if not token:
+                continue
+            if self.drop_numbers and token.isdigit():
+                continue
+            if len(token) <= self.short_token_length and any(char.isdigit() for char in token):
+                continue
+            tokens.append(token)
+        return tokens
+
+    def base_name(self, name):
+        return ''.join(self.tokens(name))
+
+    def similarity_tokens(self, name):
+        # The extension and stopwords are shared by unrelated names
+        return set(self.tokens(os.path.splitext(name)[0])) - self.stopwords
+
+    def token_signature(self, token):
+        digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8, key=self.hash_key).digest()
+        token_hash = int.from_bytes(digest, 'little') & MINHASH_PRIME
+        return tuple((a * token_hash + b) % MINHASH_PRIME for a, b in self.permutations)
+
+    def minhash(self, tokens):
+        # Name vocabularies are small and repetitive, so per-token permutations are cached
+        return list(map(min, zip(*[self.token_signature(token) for token in set(tokens)])))
+
+    def signature(self, tokens):
+        return [value & SIGNATURE_MASK for value in self.minhash(tokens)]
+
+    def band_keys(self, signature):
+        """LSH bucket keys: names sharing any one band of their signature are candidates for the same group."""
+        keys = []
+        for band in range(self.bands):
+            # The band number and its values packed into one int, exact and the same in every process
+            key = band
+            for value in signature[band * self.rows:(band + 1) * self.rows]:
+                key = (key << SIGNATURE_BITS) | value
+            keys.append(key)
+        return keys
+
+    def count(self, names):
+        """First pass of exact mode: number of files per base name."""
+        counts = {}
+        for name in names:
+            base_name = self.base_name(name)
+            counts[base_name] = counts.get(base_name, 0) + 1
+        return counts
+
+    def cluster(self, names):
+        """First pass of similarity mode: union-find root per file position and the size of each cluster."""
+        parents = array('q')
+        sizes = array('q')
+        signatures = array('H')  # num_perm values per file position
+        exact = {}  # Base name -> first file position with it
+        buckets = {}  # LSH bucket key -> candidate file positions
+
+        def find(position):
+            while parents[position] != position:
+                parents[position] = parents[parents[position]]  # Path halving
+                position = parents[position]
+            return position
+
+        def union(position, other):
+            root, other_root = find(position), find(other)
+            if root != other_root:
+                if sizes[root] < sizes[other_root]:
+                    root, other_root = other_root, root
+                parents[other_root] = root
+                sizes[root] += sizes[other_root]
+
+        def similarity(position, other):
+            start, other_start = position * self.num_perm, other * self.num_perm
+            matches = sum(signatures[start + index] == signatures[other_start + index]
+                          for index in range(self.num_perm))
+            return matches / self.num_perm
+
+        for position, name in enumerate(names):
+            parents.append(position)
+            sizes.append(1)
+            # Identical base names always group, as in exact mode
+            union(position, exact.setdefault(self.base_name(name), position))
+
+            tokens = self.similarity_tokens(name)
+            if not tokens:
+                signatures.extend([0] * self.num_perm)
+                continue
+            signature = self.signature(tokens)
+            signatures.extend(signature)
+            for key in self.band_keys(signature):
+                candidates = buckets.setdefault(key, [])
+                joined = False
+                for other in candidates:
+                    if find(other) == find(position):
+                        joined = True
+                    elif similarity(position, other) >= self.similarity_threshold:
+                        union(position, other)
+                        joined = True
+                # Files that joined a candidate's cluster are represented by it
+                if not joined and len(candidates) < self.max_bucket_size:
+                    candidates.append(position)
+
+        return array('q', (find(position) for position in range(len(parents)))), sizes
+
+    def filter(self, items, name=lambda item: item[0]):
+        """Yield the items whose group is smaller than threshold, in their original order.
+
+        items is iterated twice, so pass a list or another re-iterable source; a one-shot iterator is
+        materialized first. name extracts the file name from an item.
+        """
+        if iter(items) is items:
+            items = list(items)
+
+        if self.similarity:
+            roots, sizes = self.cluster(name(item) for item in items)
+            for root, item in zip(roots, items):
+                if sizes[root] < self.threshold:
+                    yield item
+            return
+
+        counts = self.count(name(item) for item in items)
+        for item in items:
+            if counts[self.base_name(name(item))] < self.threshold:
+                yield item
+
+
+# Example usage
+if __name__ == '__main__':
+    names = [f"Invoice {number:04d}.pdf" for number in range(20)] + [
+        "Project plan.docx", "Project plan (copy).docx", "Budget 2024 v2.xlsx", "Meeting notes.docx",
+    ]
+
+    print("Exact grouping:", list(NameGrouper().filter(names, name=lambda item: item)))
+    print("Similarity grouping:", list(NameGrouper(threshold=2, similarity=True).filter(names, name=lambda item: item)))
+
+    # Unrelated names sharing an extension and a common word must not be grouped
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(6)) for _ in range(4000)]
+    unrelated = [f"{words[2 * number]} {words[2 * number + 1]} guideline.pdf" for number in range(2000)]
+    kept = list(NameGrouper(similarity=True).filter(unrelated, name=lambda item: item))
+    assert len(kept) == len(unrelated), f"{len(unrelated) - len(kept)} unrelated names were grouped"
+    print(f"Unrelated names kept: {len(kept)} of {len(unrelated)}")
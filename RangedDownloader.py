@@ -0,0 +1,137 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from DownloadSink import preallocate
+from Metrics import get_default_metrics
+from authenticate import get_api_base_url, get_http
+
+
+class RangedDownloader:
+    """Downloads binary files with HTTP Range requests into a resumable .part file.
+
+    Progress is kept in a .part.json file next to it, so a crashed or restarted sync continues from the last
+    completed chunk. Files above segment_threshold are split into byte-range segments fetched in parallel
+    and written in place.
+    """
+
+    def __init__(self, chunk_size=8 * 1024 * 1024, segment_threshold=64 * 1024 * 1024, segments=4, metrics=None,
+                 chunk_sizer=None):
+        self.chunk_size = chunk_size  # Bytes per Range request
+        self.chunk_sizer = chunk_sizer  # Optional ChunkSizer that picks the bytes per request instead
+        self.metrics = metrics or get_default_metrics()
+        self.segment_threshold = segment_threshold  # Files at least this large are split into segments
+        self.segments = segments  # Number of concurrent segments for large files
+
+    def plan_segments(self, size):
+        count = self.segments if size >= self.segment_threshold else 1
+        segment_size = -(-size // count)
+        # Each segment is [start, end) plus the offset reached so far
+        return [[start, min(start + segment_size, size), start] for start in range(0, size, segment_size)]
+
+    def load_state(self, state_path, size, md5_checksum):
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        # A different remote version can't be resumed
+        if state.get('size') != size or state.get('md5Checksum') != md5_checksum:
+            return None
+        return state
+
+    def save_state(self, state_path, state):
+        tmp_path = f"{state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def fetch_range(self, url, start, end):
+        """GET bytes [start, end) of url with the calling thread's authorized connection."""
+        from googleapiclient.errors import HttpError
+
+        with self.metrics.span('drive_range_request', 'drive_request_duration_seconds',
+                               endpoint='files.get_media_range') as span:
+            response, content = get_http().request(url, 'GET', headers={'Range': f"bytes={start}-{end - 1}"})
+            span['status'] = response.status
+        if response.status == 200 and start == 0:
+            # The server ignored the Range header and sent the whole file
+            return content[:end]
+        if response.status != 206:
+            raise HttpError(response, content, uri=url)
+        return content
+
+    def download_segment(self, url, fd, segment, state, state_path, lock, progress=None, slot=None):
+        start, end, offset = segment
+        while offset < end:
+            chunk_size = self.chunk_sizer.chunk_size() if self.chunk_sizer is not None else self.chunk_size
+            chunk_end = min(offset + chunk_size, end)
+            start_time = time.perf_counter()
+            with slot() if slot is not None else contextlib.nullcontext():
+                content = self.fetch_range(url, offset, chunk_end)
+            if self.chunk_sizer is not None:
+                self.chunk_sizer.record(len(content), time.perf_counter() - start_time)
+            if not content:
+                raise IOError(f"Empty response for bytes {offset}-{chunk_end - 1} of {url}")
+            os.pwrite(fd, content, offset)
+            offset += len(content)
+            if progress is not None:
+                progress(len(content))
+
+            with lock:
+                segment[2] = offset
+                self.save_state(state_path, state)
+
+    def download(self, file_id, file_path, size, md5_checksum=None, progress=None, slot=None):
+        """Download file_id to file_path, resuming a previous .part file when possible.
+
+        progress, if given, is called with the size of each chunk written, from the segment threads. slot, if
+        given, returns a context manager held around each Range request, e.g. a rate controller slot.
+        """
+        part_path = f"{file_path}.part"
+        state_path = f"{part_path}.json"
+        url = f"{get_api_base_url()}files/{file_id}?alt=media&supportsAllDrives=true"
+
+        state = self.load_state(state_path, size, md5_checksum)
+        if state is None or not os.path.exists(part_path):
+            state = {'size': size, 'md5Checksum': md5_checksum, 'segments': self.plan_segments(size)}
+            with open(part_path, 'wb') as f:
+                preallocate(f.fileno(), size)
+            self.save_state(state_path, state)
+
+        lock = threading.Lock()
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            pending = [segment for segment in state['segments'] if segment[2] < segment[1]]
+            if len(pending) == 1:
+                self.download_segment(url, fd, pending[0], state, state_path, lock, progress, slot)
+            elif pending:
+                with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                    futures = [executor.submit(self.download_segment, url, fd, segment, state, state_path, lock,
+                                               progress, slot)
+                               for segment in pending]
+                    for future in futures:
+                        future.result()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if md5_checksum and self.md5_of(part_path) != md5_checksum:
+            # Corrupt assembly: start over next time instead of resuming bad data
+            os.remove(part_path)
+            os.remove(state_path)
+            raise IOError(f"Checksum mismatch for {file_path}")
+
+        os.replace(part_path, file_path)
+        os.remove(state_path)
+
+    @staticmethod
+    def md5_of(path):
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
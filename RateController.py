@@ -0,0 +1,244 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import json
+import random
+import time
+
+from Metrics import get_default_metrics
+
+# Error reasons Drive uses for throttling on 403 responses
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def get_error_status_and_reason(error):
+    """Return (status, reason) for googleapiclient HttpError and AsyncDriveError, or (None, None)."""
+    status = getattr(error, 'status', None)
+    if not isinstance(status, int) and getattr(error, 'resp', None) is not None:
+        status = getattr(error.resp, 'status', None)
+    if status is None:
+        return None, None
+
+    reason = getattr(error, 'reason', None)
+    content = getattr(error, 'content', None)
+    if content:
+        try:
+            if isinstance(content, bytes):
+                content = content.decode('utf-8')
+            reason = json.loads(content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            pass
+    return int(status), reason
+
+
+def is_throttled(error):
+    status, reason = get_error_status_and_reason(error)
+    return status == 429 or (status == 403 and reason in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    """Throttling, server errors and dropped connections are worth retrying; everything else is not."""
+    status, _ = get_error_status_and_reason(error)
+    if status is None:
+        # Dropped connections and timeouts from httplib2 or httpx (TransportError); other OSErrors, such as a
+        # missing local folder, would fail again
+        return (isinstance(error, (ConnectionError, TimeoutError))
+                or any(cls.__name__ == 'TransportError' for cls in type(error).__mro__))
+    return is_throttled(error) or status in RETRYABLE_STATUSES
+
+
+class RateController:
+    """Shared request budget for listing and downloads.
+
+    In-flight requests are limited by an AIMD window that grows by about one request per window of
+    successes and halves on throttling, requests are paced by a token bucket sized to the project quota,
+    and retryable failures are retried with exponential backoff and full jitter.
+    """
+
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=100, queries_per_second=150, burst=None,
+                 max_retries=6, base_delay=1.0, max_delay=64.0, metrics=None):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queries_per_second = queries_per_second  # Token bucket refill rate, i.e. the quota
+        self.burst = burst if burst is not None else queries_per_second  # Token bucket capacity
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        self.in_flight = 0
+
+        # Counters for reporting; metrics has the same per endpoint, plus latency histograms
+        self.metrics = metrics or get_default_metrics()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+        # Requests waiting for a slot; futures belong to the running loop, so they are reset per loop
+        self.loop = None
+        self.waiters = collections.deque()
+
+    def check_loop(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.waiters = collections.deque()
+            self.in_flight = 0
+
+    async def take_token(self):
+        # Token bucket: wait until a request fits in the quota
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.queries_per_second)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.queries_per_second)
+
+    async def acquire(self):
+        self.check_loop()
+        while self.in_flight >= int(self.limit):
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass a wake-up we may have received on to the next waiter
+                if waiter.done() and not waiter.cancelled():
+                    self.wake_waiters()
+                raise
+        self.in_flight += 1
+        self.metrics.set('drive_requests_in_flight', self.in_flight)
+        try:
+            await self.take_token()
+        except asyncio.CancelledError:
+            self.release(completed=False)
+            raise
+
+    def release(self, throttled=False, completed=True):
+        # Synchronous, so a slot is always returned even when the request was cancelled
+        self.in_flight -= 1
+        self.metrics.set('drive_requests_in_flight', self.in_flight)
+        if not completed:
+            # Cancelled requests say nothing about the server, so the window is left as it is
+            self.wake_waiters()
+            return
+        if throttled:
+            # Multiplicative decrease, at most once per backoff window so one burst of 429s counts once
+            now = time.monotonic()
+            if now - self.last_decrease > self.base_delay:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.last_decrease = now
+        else:
+            # Additive increase: about +1 per window's worth of successful requests
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.metrics.set('drive_concurrency_limit', self.limit)
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        free_slots = int(self.limit) - self.in_flight
+        while free_slots > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free_slots -= 1
+
+    def backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @contextlib.contextmanager
+    def slot_from_thread(self, loop):
+        """Hold a slot and a token around one blocking request made in a worker thread of loop.
+
+        For calls that make several HTTP requests, e.g. the chunks of a ranged download, so each of them
+        counts against the window and the quota; run the call itself with call(..., metered=False).
+        """
+        async def acquire():
+            await self.acquire()
+            self.requests += 1
+
+        asyncio.run_coroutine_threadsafe(acquire(), loop).result()
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = is_throttled(e)
+            raise
+        finally:
+            loop.call_soon_threadsafe(functools.partial(self.release, throttled=throttled))
+
+    async def call(self, request, endpoint='request', metered=True):
+        """Run request(), a coroutine function, within the budget, retrying retryable errors.
+
+        endpoint names the API call, e.g. 'files.list', in the metrics. With metered=False request() takes
+        its own slots with slot_from_thread() and only the retries and backoff are done here; holding a slot
+        around it as well could wait forever for the slots it needs.
+        """
+        for attempt in range(self.max_retries + 1):
+            if metered:
+                await self.acquire()
+                self.requests += 1
+            with self.metrics.span('drive_request', 'drive_request_duration_seconds', endpoint=endpoint) as span:
+                span['attempt'] = attempt
+                try:
+                    result = await request()
+                except asyncio.CancelledError:
+                    span['status'] = 'cancelled'
+                    if metered:
+                        self.release(completed=False)
+                    raise
+                except Exception as e:
+                    status, reason = get_error_status_and_reason(e)
+                    span['status'] = reason or status or type(e).__name__
+                    error = e
+                else:
+                    span['status'] = 'ok'
+                    error = None
+            self.metrics.inc('drive_requests_total', endpoint=endpoint, status=span['status'])
+
+            if error is None:
+                if metered:
+                    self.release()
+                return result
+
+            throttled = is_throttled(error)
+            if metered:
+                self.release(throttled=throttled)
+            if throttled:
+                self.throttled += 1
+                self.metrics.inc('drive_throttled_total', endpoint=endpoint)
+            if not is_retryable(error) or attempt == self.max_retries:
+                self.failures += 1
+                self.metrics.inc('drive_failures_total', endpoint=endpoint)
+                raise error
+            self.retries += 1
+            self.metrics.inc('drive_retries_total', endpoint=endpoint)
+            await asyncio.sleep(self.backoff_delay(attempt))
+
+    def stats(self):
+        return {
+            'limit': round(self.limit, 2),
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'failures': self.failures,
+        }
+
+
+_default_controller = None
+
+
+def get_default_controller():
+    """The process-wide controller, so listing and downloads share one budget unless told otherwise."""
+    global _default_controller
+    if _default_controller is None:
+        _default_controller = RateController()
+    return _default_controller
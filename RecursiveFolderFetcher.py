@@ -1,74 +1,252 @@
 import asyncio
+import time
 from concurrent.futures import ThreadPoolExecutor
-from googleapiclient.discovery import build
 
-from authenticate import authenticate
+from RateController import get_default_controller
+from authenticate import get_service
+from drive_query import DEFAULT_MAX_QUERY_LENGTH, DriveQuery, batch_parent_ids
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FOLDERS = DriveQuery.folders()
+FOLDERS_QUERY = FOLDERS.q()
 
 
 class RecursiveFolderFetcher:
-    def __init__(self, max_concurrent_calls=20):
+    def __init__(self, max_concurrent_calls=20, batch_parents=False, max_query_length=DEFAULT_MAX_QUERY_LENGTH,
+                 client=None,
+                 controller=None, index=None, tree_cache=None, excluded_folders=()):
         self.max_concurrent_calls = max_concurrent_calls  # Limit parallel API calls
         self.semaphore = asyncio.Semaphore(max_concurrent_calls)
+        self.batch_parents = batch_parents  # Pack many parent ids into one query per list call
+        self.max_query_length = max_query_length  # Upper bound for a packed parents query
+        self.api_calls = 0  # Number of files().list calls made
+        self.executor = None  # Thread pool running the blocking API calls, set while fetching
+        self.client = client  # Optional AsyncDriveClient used instead of the thread pool
+        self.controller = controller or get_default_controller()  # Shared rate limit and retry budget
+        self.index = index  # Optional MetadataIndex that receives every listing page
+        self.tree_cache = tree_cache  # Optional FolderTreeCache, so unchanged folders aren't listed again
+        self.excluded_folders = set(excluded_folders)  # Subtrees that are never listed
         self.all_folders = []  # Store tuples of (id, name)
+        self.folder_parents = {}  # Map of folder id -> parent folder id
 
     def create_service(self):
-        # Authenticate or create a new service instance
-        return build('drive', 'v3', credentials=authenticate())
+        # Reuse the calling thread's service and its keep-alive connection
+        return get_service()
+
+    async def list_page(self, **params):
+        """Run one files().list call, natively when an AsyncDriveClient is set, otherwise in the thread pool.
+
+        The call goes through the rate controller, which retries throttled and failed requests.
+        """
+        async def request():
+            if self.client is not None:
+                return await self.client.list_files(**params)
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, lambda: self.create_service().files().list(**params).execute()
+            )
+
+        return await self.controller.call(request, endpoint='files.list')
 
     async def fetch_subfolders(self, folder_id):
         """Asynchronously fetch subfolders for a given folder ID."""
         async with self.semaphore:
-            service = await asyncio.get_event_loop().run_in_executor(None, self.create_service)
             subfolders = []
+            subfolder_items = []
             page_token = None
+            listed_at = time.time()
 
             while True:
-                query = f"mimeType='application/vnd.google-apps.folder' and '{folder_id}' in parents and trashed=false"
-                results = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: service.files().list(
-                        pageSize=1000,
-                        fields="nextPageToken, files(id, name)",
-                        pageToken=page_token,
-                        supportsAllDrives=True,
-                        includeItemsFromAllDrives=True,
-                        q=query
-                    ).execute()
+                results = await self.list_page(
+                    pageSize=1000,
+                    fields="nextPageToken, files(id, name, modifiedTime)",
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                    q=FOLDERS.q(folder_id)
                 )
+                self.api_calls += 1
 
                 items = results.get('files', [])
+                if self.index is not None:
+                    self.index.add_items(items, parent_id=folder_id, mime_type=FOLDER_MIME_TYPE)
                 subfolders.extend([(item['id'], item['name']) for item in items])
+                subfolder_items.extend(items)
+
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+
+            if self.tree_cache is not None:
+                self.tree_cache.record(folder_id, subfolder_items, listed_at=listed_at)
+            return subfolders
+
+    async def fetch_subfolders_batch(self, folder_ids):
+        """Fetch subfolders of several folders with one packed parents query. Returns {folder_id: [(id, name)]}."""
+        async with self.semaphore:
+            subfolders = {folder_id: [] for folder_id in folder_ids}
+            subfolder_items = {folder_id: [] for folder_id in folder_ids}
+            page_token = None
+            listed_at = time.time()
+            query = FOLDERS.q(folder_ids)
+
+            while True:
+                results = await self.list_page(
+                    pageSize=1000,
+                    fields="nextPageToken, files(id, name, parents, modifiedTime)",
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                    q=query
+                )
+                self.api_calls += 1
+
+                items = results.get('files', [])
+                if self.index is not None:
+                    self.index.add_items(items, mime_type=FOLDER_MIME_TYPE)
+
+                # Spread the results back to each folder of the batch
+                for item in items:
+                    for parent_id in item.get('parents', []):
+                        if parent_id in subfolders:
+                            subfolders[parent_id].append((item['id'], item['name']))
+                            subfolder_items[parent_id].append(item)
 
                 page_token = results.get('nextPageToken')
                 if not page_token:
                     break
 
+            if self.tree_cache is not None:
+                for folder_id, items in subfolder_items.items():
+                    self.tree_cache.record(folder_id, items, listed_at=listed_at)
             return subfolders
 
+    async def fetch_children(self, folder_id):
+        """Subfolders of folder_id, from the tree cache when it was revalidated, otherwise listed."""
+        if self.tree_cache is not None and self.tree_cache.is_fresh(folder_id):
+            return self.tree_cache.children(folder_id)
+        return await self.fetch_subfolders(folder_id)
+
+    async def revalidate_tree_cache(self, root_folder_id):
+        """Check the cached tree under root_folder_id for changed children, a packed query per batch of folders."""
+        async def revalidate(query, folder_ids):
+            async with self.semaphore:
+                changed_items = []
+                page_token = None
+                while True:
+                    results = await self.list_page(
+                        pageSize=1000,
+                        fields="nextPageToken, files(id, parents)",
+                        pageToken=page_token,
+                        supportsAllDrives=True,
+                        includeItemsFromAllDrives=True,
+                        q=query
+                    )
+                    self.api_calls += 1
+                    changed_items.extend(results.get('files', []))
+                    page_token = results.get('nextPageToken')
+                    if not page_token:
+                        break
+                self.tree_cache.revalidate(folder_ids, changed_items, files_checked=False)
+
+        queries = self.tree_cache.revalidation_queries(root_folder_id, folders_only=True,
+                                                       max_query_length=self.max_query_length)
+        await asyncio.gather(*[revalidate(query, folder_ids) for query, folder_ids in queries])
+
+    async def fetch_level(self, current_level):
+        """Fetch the subfolders of every folder in a BFS level, in the same order as the level."""
+        if not self.batch_parents:
+            tasks = [asyncio.ensure_future(self.fetch_children(folder_id)) for folder_id, _ in current_level]
+            return await asyncio.gather(*tasks)
+
+        subfolders = {}
+        folder_ids = []
+        for folder_id, _ in current_level:
+            if self.tree_cache is not None and self.tree_cache.is_fresh(folder_id):
+                subfolders[folder_id] = self.tree_cache.children(folder_id)
+            else:
+                folder_ids.append(folder_id)
+        batches = batch_parent_ids(folder_ids, FOLDERS_QUERY, self.max_query_length)
+        tasks = [asyncio.ensure_future(self.fetch_subfolders_batch(batch)) for batch in batches]
+
+        for batch_result in await asyncio.gather(*tasks):
+            subfolders.update(batch_result)
+        return [subfolders[folder_id] for folder_id, _ in current_level]
+
     async def fetch_all_folders(self, root_folder_id):
         """Fetch all subfolder IDs and names under the given folder using parallel calls."""
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_calls) as executor:
+            self.executor = executor
+            if self.tree_cache is not None:
+                await self.revalidate_tree_cache(root_folder_id)
+            if self.batch_parents:
+                await self.fetch_all_folders_by_level(root_folder_id)
+            else:
+                await self.fetch_all_folders_streaming(root_folder_id)
+        self.executor = None
+        if self.tree_cache is not None:
+            self.tree_cache.save()
+            print(f"Folder tree cache: {self.tree_cache.stats}")
+
+    def add_subfolders(self, parent_id, subfolder_list, seen):
+        """Record newly discovered subfolders of parent_id and return them."""
+        new_folders = []
+        for folder_id, folder_name in subfolder_list:
+            if folder_id in self.excluded_folders:
+                continue
+            if folder_id not in seen:
+                seen.add(folder_id)
+                new_folders.append((folder_id, folder_name))
+                self.all_folders.append((folder_id, folder_name))
+                self.folder_parents[folder_id] = parent_id
+        return new_folders
+
+    def folder_paths(self, root_folder_id):
+        """Map of relative path -> folder id for the crawled tree, '' being root_folder_id.
+
+        Of two sibling folders with the same name, the first one crawled gets the path.
+        """
+        names = dict(self.all_folders)
+        paths = {root_folder_id: ''}
+
+        def path_of(folder_id):
+            if folder_id not in paths:
+                parent_path = path_of(self.folder_parents[folder_id])
+                paths[folder_id] = f"{parent_path}/{names[folder_id]}" if parent_path else names[folder_id]
+            return paths[folder_id]
+
+        folder_ids = {}
+        for folder_id, _ in self.all_folders:
+            folder_ids.setdefault(path_of(folder_id), folder_id)
+        folder_ids[''] = root_folder_id
+        return folder_ids
+
+    async def fetch_all_folders_streaming(self, root_folder_id):
+        # Each folder's children are scheduled as soon as its own listing finishes, so one slow folder
+        # never holds back the rest of the crawl
+        seen = set()
+        pending = {asyncio.ensure_future(self.fetch_children(root_folder_id)): root_folder_id}
+
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                parent_id = pending.pop(task)
+                for folder_id, _ in self.add_subfolders(parent_id, task.result(), seen):
+                    pending[asyncio.ensure_future(self.fetch_children(folder_id))] = folder_id
+
+    async def fetch_all_folders_by_level(self, root_folder_id):
+        # Packed parents queries need a set of folders to batch, so this mode crawls level by level
         to_process = [(root_folder_id, "Root Folder")]  # Start with the root folder
-        all_folders = set()
+        seen = set()
 
-        with ThreadPoolExecutor(max_workers=self.max_concurrent_calls) as executor:
-            while to_process:
-                current_level = to_process
-                to_process = []
-
-                tasks = []
-                for folder_id, folder_name in current_level:
-                    # Schedule fetching subfolders for each folder in the current level
-                    tasks.append(asyncio.ensure_future(self.fetch_subfolders(folder_id)))
-
-                # Await all tasks for the current level
-                results = await asyncio.gather(*tasks)
-
-                for subfolder_list in results:
-                    for folder_id, folder_name in subfolder_list:
-                        if folder_id not in all_folders:
-                            all_folders.add(folder_id)
-                            to_process.append((folder_id, folder_name))
-                            self.all_folders.append((folder_id, folder_name))
+        while to_process:
+            current_level = to_process
+            to_process = []
+
+            # Fetch subfolders for each folder in the current level
+            results = await self.fetch_level(current_level)
+
+            for (parent_id, _), subfolder_list in zip(current_level, results):
+                to_process.extend(self.add_subfolders(parent_id, subfolder_list, seen))
 
 
 # Example usage
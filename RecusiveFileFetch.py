@@ -1,36 +1,37 @@
-from authenticate import authenticate
+import time
+
+from FileRecord import FileRecord
+from FlatDriveFetcher import FlatDriveFetcher
+from SyncManifest import SyncManifest
+from authenticate import get_service
+from drive_query import DriveQuery
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FOLDERS = DriveQuery.folders()
 
 
 class RecursiveFileFetch:
-    def __init__(self, service, mime_types=None, excluded_folders=None):
+    def __init__(self, service, mime_types=None, excluded_folders=None, flat_threshold=200, index=None,
+                 tree_cache=None, query=None):
         self.service = service
-        self.mime_types = mime_types if mime_types else [
-            "text/plain",
-            "application/vnd.google-apps.document",  # Google Docs
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",  # Word Document
-            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",  # Excel Spreadsheet
-            "application/pdf",  # PDF
-            "application/vnd.google-apps.presentation",  # Google Slides
-            "application/vnd.openxmlformats-officedocument.presentationml.presentation",  # PowerPoint Presentation
-            "application/vnd.google-apps.spreadsheet",  # Google Sheets
-            "application/json"  # JSON
-        ]
+        self.index = index  # Optional MetadataIndex; when set it replaces the output file
+        self.tree_cache = tree_cache  # Optional FolderTreeCache, so unchanged folders aren't listed again
+        # With the automatic strategy, a subtree that would cost more list calls than this is listed flat
+        self.flat_threshold = flat_threshold
+        # Supported MIME types and other filters, pushed into the listing query where Drive supports them
+        self.query = query or DriveQuery(mime_types or None)
+        self.mime_types = self.query.mime_types
         self.excluded_folders = excluded_folders if excluded_folders else []
+        self.file_metadata = {}  # Map of file id -> listing fields (md5Checksum, modifiedTime, version, size)
+        self.file_paths = {}  # Map of file id -> path below the listed folder (flat strategy only)
 
-    def list_files_in_folder(self, folder_id):
-        """Fetch files recursively from a folder and its subfolders, excluding specified folders."""
-        all_files = []
+    def list_folder_pages(self, folder_id, query, fields, mime_type=None):
+        """Yield the raw item pages of one folder listing, feeding the index when one is set."""
         page_token = None
-        mime_types_query = " or ".join([f"mimeType='{mime_type}'" for mime_type in self.mime_types])
-
-        # Query to fetch files (not folders) from the current folder
-        query = f"({mime_types_query}) and '{folder_id}' in parents and trashed=false"
-
-        # Fetch files from the current folder
         while True:
             results = self.service.files().list(
                 pageSize=1000,
-                fields="nextPageToken, files(id, name, mimeType)",
+                fields=fields,
                 pageToken=page_token,
                 supportsAllDrives=True,
                 includeItemsFromAllDrives=True,
@@ -38,54 +39,142 @@ class RecursiveFileFetch:
             ).execute()
 
             items = results.get('files', [])
-            all_files.extend([(item['name'], item['id'], item['mimeType']) for item in items])
+            if self.index is not None:
+                self.index.add_items(items, parent_id=folder_id, mime_type=mime_type)
+            yield items
 
             page_token = results.get('nextPageToken')
             if not page_token:
                 break
 
-        # Now, list all subfolders and recursively fetch files from them
-        subfolders_query = f"mimeType='application/vnd.google-apps.folder' and '{folder_id}' in parents and trashed=false"
-        page_token = None
-        subfolders = []
+    def revalidate_tree_cache(self, folder_id):
+        """Check the cached tree under folder_id for changed files and folders, a packed query per batch."""
+        for query, folder_ids in self.tree_cache.revalidation_queries(folder_id):
+            changed_items = []
+            page_token = None
+            while True:
+                results = self.service.files().list(
+                    pageSize=1000,
+                    fields="nextPageToken, files(id, parents)",
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                    q=query
+                ).execute()
+                changed_items.extend(results.get('files', []))
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+            self.tree_cache.revalidate(folder_ids, changed_items)
+
+    def iter_files_in_folder(self, folder_id):
+        """Yield pages of FileRecords from a folder and its subfolders, excluding specified folders.
+
+        Folders are walked depth-first with an explicit stack, in the same order as list_files_in_folder,
+        and only the subfolders still to visit are kept. With a tree cache, folders whose children haven't
+        changed are taken from the cache instead of being listed.
+        """
+        stack = [folder_id]
+        if self.tree_cache is not None:
+            self.revalidate_tree_cache(folder_id)
+
+        while stack:
+            current_folder_id = stack.pop()
+
+            if self.tree_cache is not None and self.tree_cache.is_fresh(current_folder_id, self.query.q()):
+                yield [FileRecord.from_item(item, current_folder_id)
+                       for item in self.query.filter(self.tree_cache.files(current_folder_id))]
+                subfolders = self.tree_cache.child_items(current_folder_id)
+            else:
+                listed_at = time.time()
+                files = []
+
+                # Query to fetch files (not folders) from the current folder
+                for items in self.list_folder_pages(current_folder_id, self.query.q(current_folder_id),
+                                                    self.query.fields(SyncManifest.LISTING_FIELDS)):
+                    yield [FileRecord.from_item(item, current_folder_id) for item in self.query.filter(items)]
+                    if self.tree_cache is not None:
+                        files.extend(items)
+
+                # Now, list all subfolders to visit next
+                subfolders = []
+                for items in self.list_folder_pages(current_folder_id, FOLDERS.q(current_folder_id),
+                                                    FOLDERS.fields("id, name, modifiedTime"),
+                                                    mime_type=FOLDER_MIME_TYPE):
+                    subfolders.extend(items)
+
+                if self.tree_cache is not None:
+                    self.tree_cache.record(current_folder_id, subfolders, files, self.query.q(), listed_at)
+
+            # Skip excluded folders; push in reverse so subfolders are visited in listing order
+            for subfolder in subfolders:
+                if subfolder['id'] not in self.excluded_folders:
+                    print(f"Processing subfolder: {subfolder['name']}")
+                else:
+                    print(f"Skipping excluded folder: {subfolder['name']}")
+            stack.extend(subfolder['id'] for subfolder in reversed(subfolders)
+                         if subfolder['id'] not in self.excluded_folders)
 
-        while True:
-            results = self.service.files().list(
-                pageSize=1000,
-                fields="nextPageToken, files(id, name)",
-                pageToken=page_token,
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-                q=subfolders_query
-            ).execute()
+    def list_files_in_folder(self, folder_id):
+        """Fetch files recursively from a folder and its subfolders, excluding specified folders."""
+        all_files = []
+        for records in self.iter_files_in_folder(folder_id):
+            all_files.extend([(record.name, record.id, record.mime_type) for record in records])
+            self.file_metadata.update({record.id: record.metadata() for record in records})
+        if self.tree_cache is not None:
+            self.tree_cache.save()
+            print(f"Folder tree cache: {self.tree_cache.stats}")
+        return all_files
 
-            items = results.get('files', [])
-            subfolders.extend(items)
+    def list_files_flat(self, folder_id, flat_fetcher):
+        """Fetch all files under a folder from a flat listing of the drive, excluding specified folders."""
+        flat_fetcher.index_files(self.excluded_folders)
+        all_files = []
+        for file_name, file_id, mime_type, path in flat_fetcher.files_under(folder_id, self.excluded_folders):
+            all_files.append((file_name, file_id, mime_type))
+            self.file_paths[file_id] = path
+        self.file_metadata.update(flat_fetcher.file_metadata)
+        return all_files
 
-            page_token = results.get('nextPageToken')
-            if not page_token:
-                break
+    def choose_strategy(self, folder_id, flat_fetcher):
+        """Pick 'recursive' or 'flat' from the size of the folder tree.
 
-        # Recursively fetch files from subfolders, excluding specified folders
-        for subfolder in subfolders:
-            if subfolder['id'] not in self.excluded_folders:
-                print(f"Processing subfolder: {subfolder['name']}")
-                subfolder_files = self.list_files_in_folder(subfolder['id'])
-                all_files.extend(subfolder_files)
-            else:
-                print(f"Skipping excluded folder: {subfolder['name']}")
+        Folders alone are listed flat (cheap, a few pages), then the recursive walk's cost of two list
+        calls per folder is compared against flat_threshold.
+        """
+        flat_fetcher.index_folders()
+        folder_count = len(flat_fetcher.folders_under(folder_id, self.excluded_folders))
+        recursive_calls = 2 * (folder_count + 1)
+        strategy = 'flat' if recursive_calls > self.flat_threshold else 'recursive'
+        print(f"Found {folder_count} folders (~{recursive_calls} recursive list calls), using {strategy} listing")
+        return strategy
 
-        return all_files
+    def list_all_files(self, folder_id='root', output_file='all_files.txt', strategy='auto', drive_id=None):
+        """Fetch all files from the given folder and save to a file, excluding specific folders.
 
-    def list_all_files(self, folder_id='root', output_file='all_files.txt'):
-        """Fetch all files recursively from the given folder and save to a file, excluding specific folders."""
+        strategy is 'recursive', 'flat' or 'auto'. drive_id limits the flat listing to one shared drive.
+        """
         print(f"Fetching files from folder: {folder_id} and its subfolders, excluding: {self.excluded_folders}")
-        all_files = self.list_files_in_folder(folder_id)
-
-        # Once all files are fetched, write them to the output file with utf-8 encoding
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for file_name, file_id, mime_type in all_files:
-                f.write(f"{file_name}, {file_id}, {mime_type}\n")
+        print(f"Filters: {self.query.report()}")
+
+        flat_fetcher = FlatDriveFetcher(self.service, drive_id=drive_id, index=self.index, query=self.query)
+        if strategy != 'recursive' and folder_id == 'root':
+            # The flat listing reports real parent ids, so resolve the 'root' alias first
+            folder_id = self.service.files().get(fileId='root', fields='id').execute()['id']
+        if strategy == 'auto':
+            strategy = self.choose_strategy(folder_id, flat_fetcher)
+        if strategy == 'flat':
+            if not flat_fetcher.items:
+                flat_fetcher.index_folders()
+            all_files = self.list_files_flat(folder_id, flat_fetcher)
+        else:
+            all_files = self.list_files_in_folder(folder_id)
+
+        # Once all files are fetched, write them to the output file with utf-8 encoding, unless they went to the index
+        if self.index is None:
+            with open(output_file, 'w', encoding='utf-8') as f:
+                for file_name, file_id, mime_type in all_files:
+                    f.write(f"{file_name}, {file_id}, {mime_type}\n")
 
         print(f"Total files fetched: {len(all_files)}")
         return all_files
@@ -94,7 +183,7 @@ class RecursiveFileFetch:
 # Example usage:
 if __name__ == '__main__':
     # Authenticate and initialize the service
-    service = build('drive', 'v3', credentials=authenticate())
+    service = get_service()
 
     # Define the folder IDs you want to exclude
     excluded_folders = ['folderId1', 'folderId2']  # Replace with actual folder IDs
@@ -102,12 +191,5 @@ if __name__ == '__main__':
     # Initialize RecursiveFileFetch class
     file_fetcher = RecursiveFileFetch(service=service, excluded_folders=excluded_folders)
 
-    # Decide to use recursive or other fetch approach
-    use_recursive = True  # Set this to False if you want to use a different approach
-
-    if use_recursive:
-        # Recursive fetch of all files
-        file_list = file_fetcher.list_all_files(folder_id='root', output_file='all_files.txt')
-    else:
-        # Placeholder for a different fetch approach, if implemented
-        print("Using non-recursive approach (yet to be implemented).")
+    # Pick the recursive walk or the flat whole-drive listing from the size of the tree
+    file_list = file_fetcher.list_all_files(folder_id='root', output_file='all_files.txt', strategy='auto')
@@ -0,0 +1,189 @@
+import bisect
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS work (
+    file_id TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    metadata TEXT,
+    shard INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS work_by_shard_state ON work (shard, state);
+'''
+
+WORK_COLUMNS = "file_id, file_name, mime_type, metadata"
+
+
+class HashRing:
+    """Consistent hash ring over shard numbers, with virtual nodes to even out the shares.
+
+    Changing the number of shards moves only about 1/shards of the files to another shard.
+    """
+
+    def __init__(self, shards, virtual_nodes=64):
+        self.shards = shards
+        self.ring = sorted((self.position(f"shard-{shard}-{node}"), shard)
+                           for shard in range(shards) for node in range(virtual_nodes))
+        self.positions = [position for position, _ in self.ring]
+
+    @staticmethod
+    def position(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def shard_of(self, file_id):
+        index = bisect.bisect(self.positions, self.position(file_id)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ShardLedger:
+    """Shared SQLite (WAL) ledger of the files to download, claimed in leases by shard workers.
+
+    Every listed file is a row with its shard, state ('pending', 'leased', 'done' or 'failed'), lease owner
+    and expiry. A claim leases a batch of the shard's pending files in one write transaction, so each file
+    is handed out once across processes. Finished files stay 'done' across runs until their listing
+    changes, and leases of a worker that died expire and are claimed again. WAL mode needs memory shared by
+    the processes, so the database must be on a local disk of the one host running the workers; it is not
+    safe on a network filesystem. Workers on several hosts would need a database service in place of this class.
+    """
+
+    def __init__(self, db_file='sync_ledger.sqlite', lease_seconds=600, max_attempts=3):
+        self.db_file = db_file
+        self.lease_seconds = lease_seconds  # Leases not renewed for this long can be claimed by another worker
+        self.max_attempts = max_attempts  # Files leased this often without finishing are marked failed
+        # Workers of several processes write at once; the timeout waits out their transactions
+        self.connection = sqlite3.connect(db_file, timeout=60, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def add(self, file_list, file_metadata, shards):
+        """Record a listing, spread over shards by consistent hash of the file id.
+
+        Files whose listing is unchanged keep their state, so done work isn't repeated after a restart;
+        changed and failed files become pending again.
+        """
+        ring = HashRing(shards)
+        now = time.time()
+        rows = []
+        for file_item in file_list:
+            file_name, file_id, mime_type = file_item[:3]
+            metadata = file_metadata.get(file_id)
+            rows.append((file_id, file_name, mime_type, json.dumps(metadata, sort_keys=True) if metadata else None,
+                         ring.shard_of(file_id), now))
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                '''INSERT INTO work (file_id, file_name, mime_type, metadata, shard, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(file_id) DO UPDATE SET
+                       file_name=excluded.file_name, mime_type=excluded.mime_type, shard=excluded.shard,
+                       state=CASE WHEN work.metadata IS NOT excluded.metadata OR work.state = 'failed'
+                                  THEN 'pending' ELSE work.state END,
+                       attempts=CASE WHEN work.metadata IS NOT excluded.metadata OR work.state = 'failed'
+                                     THEN 0 ELSE work.attempts END,
+                       metadata=excluded.metadata, updated_at=excluded.updated_at''',
+                rows
+            )
+
+    def claim(self, owner, shard, limit=50, steal=False):
+        """Lease up to limit files of shard to owner. Returns [(file_name, file_id, mime_type, metadata)].
+
+        Pending files come first, then files whose lease expired. With steal, a worker whose shard is
+        finished takes the remaining work of other shards, e.g. of a worker that never started.
+        """
+        now = time.time()
+        claimable = "(state = 'pending' OR (state = 'leased' AND lease_expires < ?))"
+        with self.lock:
+            # IMMEDIATE takes the write lock before reading, so two workers can't claim the same rows
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Leases that ran out too often are given up on
+                self.connection.execute(
+                    "UPDATE work SET state = 'failed', owner = NULL, updated_at = ? "
+                    "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                    (now, now, self.max_attempts)
+                )
+                rows = self.connection.execute(
+                    f"SELECT {WORK_COLUMNS} FROM work WHERE shard = ? AND {claimable} ORDER BY state DESC LIMIT ?",
+                    (shard, now, limit)
+                ).fetchall()
+                if not rows and steal:
+                    rows = self.connection.execute(
+                        f"SELECT {WORK_COLUMNS} FROM work WHERE {claimable} ORDER BY state DESC LIMIT ?",
+                        (now, limit)
+                    ).fetchall()
+                self.connection.executemany(
+                    "UPDATE work SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE file_id = ?",
+                    [(owner, now + self.lease_seconds, now, row['file_id']) for row in rows]
+                )
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return [(row['file_name'], row['file_id'], row['mime_type'],
+                 json.loads(row['metadata']) if row['metadata'] else None) for row in rows]
+
+    def renew(self, owner, file_ids):
+        """Extend owner's leases on file_ids, for downloads that are still running."""
+        if not file_ids:
+            return
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE work SET lease_expires = ? WHERE file_id = ? AND owner = ? AND state = 'leased'",
+                [(now + self.lease_seconds, file_id, owner) for file_id in file_ids]
+            )
+
+    def complete(self, owner, file_id, state='done'):
+        """Record the outcome of a leased file; ignored if the lease was lost to another worker meanwhile."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE work SET state = ?, owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE file_id = ? AND owner = ? AND state = 'leased'",
+                (state, time.time(), file_id, owner)
+            )
+
+    def progress(self):
+        """Number of files per shard and state, as {shard: {state: count}}."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT shard, state, COUNT(*) AS count FROM work GROUP BY shard, state ORDER BY shard"
+            ).fetchall()
+        progress = {}
+        for row in rows:
+            progress.setdefault(row['shard'], {})[row['state']] = row['count']
+        return progress
+
+    def failed_ids(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT file_id FROM work WHERE state = 'failed'")]
+
+    def remaining(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM work WHERE state IN ('pending', 'leased')"
+            ).fetchone()[0]
+
+
+def default_worker_id(shard):
+    # Unique per process, and readable in the ledger
+    return f"{os.uname().nodename if hasattr(os, 'uname') else 'host'}-{os.getpid()}-shard{shard}"
@@ -0,0 +1,150 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ShardLedger import ShardLedger, default_worker_id
+
+
+class ShardWorker:
+    """Downloads the files of one shard of a ShardLedger with a FileDownloader.
+
+    Files are claimed in leases as download slots free up, and leases of running downloads are renewed
+    until they finish. Once its own shard is done the worker steals pending work of other shards, and it
+    waits for leases held elsewhere, so files of a worker that died are claimed again when their lease expires.
+    """
+
+    def __init__(self, ledger, file_downloader, shard, worker_id=None, steal=True, poll_interval=5):
+        self.ledger = ledger
+        self.file_downloader = file_downloader
+        self.shard = shard
+        self.worker_id = worker_id or default_worker_id(shard)
+        self.steal = steal
+        self.poll_interval = poll_interval  # Seconds between claims while other workers hold the remaining files
+        self.renew_interval = ledger.lease_seconds / 3
+        self.in_flight = {}  # asyncio task -> file id
+        self.failed_ids = set()
+        self.failed_seen = 0  # Entries of file_downloader.failed_files already in failed_ids
+        self.counts = {'done': 0, 'failed': 0}
+
+    async def ledger_call(self, method, *args):
+        # SQLite waits on other processes' transactions; don't block the downloads meanwhile
+        return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+    async def renew_leases(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            await self.ledger_call(self.ledger.renew, self.worker_id, list(self.in_flight.values()))
+
+    def outcome(self, file_id):
+        failed_files = self.file_downloader.failed_files
+        self.failed_ids.update(entry[1] for entry in failed_files[self.failed_seen:])
+        self.failed_seen = len(failed_files)
+        return 'failed' if file_id in self.failed_ids else 'done'
+
+    async def finish(self, done):
+        for task in done:
+            file_id = self.in_flight.pop(task)
+            state = self.outcome(file_id)
+            self.counts[state] += 1
+            await self.ledger_call(self.ledger.complete, self.worker_id, file_id, state)
+
+    async def run(self):
+        downloader = self.file_downloader
+        limit = downloader.max_concurrent_downloads
+        semaphore = asyncio.Semaphore(limit)
+        renew_task = asyncio.ensure_future(self.renew_leases())
+        downloader.open_progress_bar()
+        try:
+            with ThreadPoolExecutor(max_workers=limit, thread_name_prefix='download') as executor:
+                while True:
+                    claimed = []
+                    if len(self.in_flight) < limit:
+                        claimed = await self.ledger_call(self.ledger.claim, self.worker_id, self.shard,
+                                                         limit - len(self.in_flight), self.steal)
+                    for file_name, file_id, mime_type, metadata in claimed:
+                        task = asyncio.ensure_future(
+                            downloader.download_file_async(file_name, file_id, mime_type, semaphore, metadata, executor)
+                        )
+                        self.in_flight[task] = file_id
+
+                    if self.in_flight:
+                        if claimed and len(self.in_flight) < limit:
+                            continue  # Claim more before waiting
+                        done, _ = await asyncio.wait(self.in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        await self.finish(done)
+                    elif await self.ledger_call(self.ledger.remaining):
+                        # Files leased by other workers; claimable here if their leases run out
+                        await asyncio.sleep(self.poll_interval)
+                    else:
+                        break
+        finally:
+            renew_task.cancel()
+            downloader.close_progress_bar()
+        downloader.finish_downloads()
+        print(f"Worker {self.worker_id}: {self.counts['done']} files done, {self.counts['failed']} failed")
+
+
+def run_worker(ledger_file, shard, sync_folder, shard_count=1, async_http=False, concurrency=20,
+               export_formats=None, lease_seconds=600, queries_per_second=150, extract=False):
+    """Entry point of a shard worker process, on the host that holds the ledger.
+
+    Each process gets its own rate controller with its share of the project's queries_per_second, and its
+    own manifest; the ledger records what is done, so workers never write the same state file.
+    """
+    from AsyncDriveClient import AsyncDriveClient
+    from ContentExtractor import ContentExtractor
+    from ContentStore import ContentStore
+    from ExportCache import ExportCache
+    from FileDownloader import FileDownloader
+    from RateController import RateController
+    from SyncManifest import SyncManifest
+
+    async def run():
+        controller = RateController(queries_per_second=queries_per_second / shard_count)
+        ledger = ShardLedger(ledger_file, lease_seconds=lease_seconds)
+
+        # The worker processes share the host's cores for extraction
+        extractor = ContentExtractor(os.path.join(sync_folder, '.extracted'),
+                                     workers=max(1, (os.cpu_count() or 1) // shard_count),
+                                     state_file=f'extraction_state.shard{shard}.json') if extract else None
+
+        async def download(client):
+            file_downloader = FileDownloader(
+                sync_folder=sync_folder, manifest=SyncManifest(f'sync_manifest.shard{shard}.json'), client=client,
+                max_concurrent_downloads=concurrency, controller=controller,
+                content_store=ContentStore(os.path.join(sync_folder, '.content_store')),
+                export_cache=ExportCache(os.path.join(sync_folder, '.export_cache')), export_formats=export_formats,
+                extractor=extractor
+            )
+            await ShardWorker(ledger, file_downloader, shard).run()
+
+        try:
+            if async_http:
+                async with AsyncDriveClient(max_connections=concurrency) as client:
+                    await download(client)
+            else:
+                await download(None)
+        finally:
+            ledger.close()
+            if extractor is not None:
+                extractor.close()
+
+    asyncio.run(run())
+
+
+def run_local_workers(ledger_file, shards, sync_folder, worker_shards=None, **worker_args):
+    """Run a worker process for each of worker_shards (default: all shards) and wait for them.
+
+    Returns the exit codes. Other processes on this host can run the remaining shards with run_worker.
+    """
+    # Spawned processes start clean, without the parent's event loop, threads and connections
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(ledger_file, shard, sync_folder),
+                                 kwargs=dict(worker_args, shard_count=shards), name=f"shard-{shard}")
+                 for shard in (range(shards) if worker_shards is None else worker_shards)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+
+
+class SyncManifest:
+    """Persistent record of what has been downloaded, used to skip files whose remote version hasn't changed."""
+
+    # Fields the listing fetchers request so downloads can be checked against the manifest
+    LISTING_FIELDS = "id, name, mimeType, md5Checksum, modifiedTime, version, size"
+
+    def __init__(self, manifest_file='sync_manifest.json'):
+        self.manifest_file = manifest_file
+        self.entries = {}  # file id -> {"md5Checksum", "modifiedTime", "version", "size", "path"}
+        self.lock = threading.Lock()  # Downloads update the manifest from executor threads
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        with self.lock:
+            tmp_file = f"{self.manifest_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.manifest_file)
+
+    def is_unchanged(self, file_id, metadata, file_path):
+        """True if the local copy at file_path matches the remote version described by metadata."""
+        if not metadata:
+            return False
+
+        with self.lock:
+            entry = self.entries.get(file_id)
+        if not entry or entry['path'] != file_path or not os.path.exists(file_path):
+            return False
+
+        # Binary files carry a checksum and size; Google-native documents only have a version
+        if metadata.get('md5Checksum'):
+            if metadata['md5Checksum'] != entry.get('md5Checksum'):
+                return False
+            if metadata.get('size') is not None and int(metadata['size']) != os.path.getsize(file_path):
+                return False
+            return True
+        if metadata.get('version'):
+            return metadata['version'] == entry.get('version')
+        return metadata.get('modifiedTime') is not None and metadata['modifiedTime'] == entry.get('modifiedTime')
+
+    def record(self, file_id, metadata, file_path):
+        metadata = metadata or {}
+        with self.lock:
+            self.entries[file_id] = {
+                'md5Checksum': metadata.get('md5Checksum'),
+                'modifiedTime': metadata.get('modifiedTime'),
+                'version': metadata.get('version'),
+                'size': metadata.get('size'),
+                'path': file_path,
+            }
+
+    def remove(self, file_id):
+        with self.lock:
+            self.entries.pop(file_id, None)
@@ -0,0 +1,109 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from FolderFilesFetcher import FolderFilesFetcher
+from Metrics import get_default_metrics
+from RecursiveFolderFetcher import RecursiveFolderFetcher
+
+
+class SyncPipeline:
+    """Streams folder discovery into file listing and file listing into downloads, without phase barriers.
+
+    Folder workers list a folder's subfolders and files as soon as it is discovered; listed files are
+    handed to download workers through a bounded queue, so listing slows down when downloads fall behind.
+    A folder that can't be listed doesn't stop the rest of the tree, but run() raises once the downloads are
+    done, so the incomplete tree isn't saved as a full sync.
+    """
+
+    def __init__(self, root_folder_id, file_downloader, max_concurrent_calls=20, download_workers=15,
+                 queue_size=1000, client=None, index=None, metrics=None, query=None, excluded_folders=()):
+        self.root_folder_id = root_folder_id
+        self.file_downloader = file_downloader
+        self.max_concurrent_calls = max_concurrent_calls  # Limit parallel listing calls
+        self.download_workers = download_workers  # Limit parallel downloads
+        self.queue_size = queue_size  # Files listed but not yet downloaded before listing waits
+        self.metrics = metrics or get_default_metrics()  # Queue depths, to see which stage is the bottleneck
+
+        # The fetchers keep the tree and file list they see, just like a phased full sync
+        self.folder_fetcher = RecursiveFolderFetcher(max_concurrent_calls=max_concurrent_calls, client=client,
+                                                     index=index, excluded_folders=excluded_folders)
+        self.file_fetcher = FolderFilesFetcher(folder_ids=[], max_concurrent_calls=max_concurrent_calls, client=client,
+                                               index=index, query=query)
+        self.listing_errors = []  # (folder_id, folder_name, error) of folders that couldn't be listed
+
+    async def folder_worker(self, folder_queue, file_queue, seen):
+        while True:
+            folder_id, folder_name = await folder_queue.get()
+            try:
+                subfolders = await self.folder_fetcher.fetch_subfolders(folder_id)
+                for subfolder in self.folder_fetcher.add_subfolders(folder_id, subfolders, seen):
+                    folder_queue.put_nowait(subfolder)
+                self.metrics.set('sync_queue_depth', folder_queue.qsize(), queue='folders')
+
+                # Files directly in the root folder are not synced, matching the phased crawl
+                if folder_id != self.root_folder_id:
+                    self.file_fetcher.folder_ids.append((folder_id, folder_name))
+                    for file_item in await self.file_fetcher.fetch_files_in_folder(folder_id, folder_name):
+                        await file_queue.put(file_item)
+                    self.metrics.set('sync_queue_depth', file_queue.qsize(), queue='files')
+            except Exception as e:
+                # Keep the worker alive so the rest of the tree is still synced; run() reports it at the end
+                print(f"Error listing folder {folder_name}: {e}")
+                self.listing_errors.append((folder_id, folder_name, e))
+            finally:
+                folder_queue.task_done()
+
+    async def download_worker(self, file_queue, semaphore, executor):
+        while True:
+            file_name, file_id, mime_type, _ = await file_queue.get()
+            self.metrics.set('sync_queue_depth', file_queue.qsize(), queue='files')
+            try:
+                await self.file_downloader.download_file_async(
+                    file_name, file_id, mime_type, semaphore, self.file_fetcher.file_metadata.get(file_id), executor
+                )
+            finally:
+                file_queue.task_done()
+
+    async def run(self):
+        """Crawl, list and download the whole tree. Returns the list of files seen."""
+        # Discovered folders are small and are fed back by the folder workers themselves, so that queue is
+        # unbounded; the file queue is bounded to give backpressure
+        folder_queue = asyncio.Queue()
+        file_queue = asyncio.Queue(maxsize=self.queue_size)
+        semaphore = asyncio.Semaphore(self.download_workers)
+        seen = set()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_calls) as listing_executor, \
+                ThreadPoolExecutor(max_workers=self.download_workers,
+                                   thread_name_prefix='download') as download_executor:
+            self.folder_fetcher.executor = listing_executor
+            self.file_fetcher.executor = listing_executor
+
+            folder_queue.put_nowait((self.root_folder_id, "Root Folder"))
+            workers = [asyncio.ensure_future(self.folder_worker(folder_queue, file_queue, seen))
+                       for _ in range(self.max_concurrent_calls)]
+            workers += [asyncio.ensure_future(self.download_worker(file_queue, semaphore, download_executor))
+                        for _ in range(self.download_workers)]
+
+            try:
+                # Every folder is listed before its files are queued as done, so once the folder queue is
+                # drained only the downloads already queued remain
+                await folder_queue.join()
+                await file_queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                self.folder_fetcher.executor = None
+                self.file_fetcher.executor = None
+
+        if self.file_downloader.manifest is not None:
+            self.file_downloader.manifest.save()
+
+        print(f"Total folders found: {len(self.folder_fetcher.all_folders)}")
+        print(f"Total files found: {len(self.file_fetcher.final_file_list)}")
+        if self.listing_errors:
+            folder_id, folder_name, error = self.listing_errors[0]
+            raise RuntimeError(f"Listing of {len(self.listing_errors)} folders failed, e.g. {folder_name} "
+                               f"({folder_id}): {error}") from error
+        return self.file_fetcher.final_file_list
@@ -1,10 +1,8 @@
-
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+# The google client libraries are imported where they are used; importing them costs a noticeable
+# share of a short cron run's wall time and is not needed when there is nothing to sync
+import json
 import os
+import threading
 
 SCOPES = [
     "https://www.googleapis.com/auth/drive",
@@ -17,15 +15,87 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive.readonly"
 ]
 
+# Pinned Drive discovery document, cached on disk so building a service never needs a network fetch
+DISCOVERY_API = 'drive'
+DISCOVERY_VERSION = 'v3'
+DISCOVERY_CACHE_FILE = f'./discovery_cache/{DISCOVERY_API}.{DISCOVERY_VERSION}.json'
+DISCOVERY_URL = f'https://www.googleapis.com/discovery/v1/apis/{DISCOVERY_API}/{DISCOVERY_VERSION}/rest'
+
+# Point every request at another Drive endpoint, e.g. http://127.0.0.1:8765/ for FakeDriveServer. Requests to
+# an overridden endpoint are sent without OAuth credentials.
+API_ROOT_URL_ENV = 'DRIVE_API_ROOT_URL'
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+
+def get_api_root_url_override():
+    return os.environ.get(API_ROOT_URL_ENV)
+
+
+def get_discovery_document():
+    """Return the parsed Drive v3 discovery document, loading it at most once per process."""
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            document = _load_discovery_document()
+            root_url = get_api_root_url_override()
+            if root_url:
+                document = dict(document, rootUrl=root_url, baseUrl=root_url + document['servicePath'],
+                                mtlsRootUrl=root_url)
+            _discovery_document = document
+    return _discovery_document
+
+
+def _load_discovery_document():
+    if os.path.exists(DISCOVERY_CACHE_FILE):
+        with open(DISCOVERY_CACHE_FILE, 'r', encoding='utf-8') as f:
+            document = json.load(f)
+    else:
+        # Prefer the copy shipped with googleapiclient, fall back to the discovery service once
+        from googleapiclient.discovery_cache import get_static_doc
+
+        content = get_static_doc(DISCOVERY_API, DISCOVERY_VERSION)
+        if content is None:
+            from urllib.request import urlopen
+
+            with urlopen(DISCOVERY_URL) as response:
+                content = response.read().decode('utf-8')
+        document = json.loads(content)
+
+        os.makedirs(os.path.dirname(DISCOVERY_CACHE_FILE), exist_ok=True)
+        tmp_file = f"{DISCOVERY_CACHE_FILE}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_file, DISCOVERY_CACHE_FILE)
+
+    if document.get('version') != DISCOVERY_VERSION:
+        raise ValueError(f"Discovery cache {DISCOVERY_CACHE_FILE} is not for {DISCOVERY_API} {DISCOVERY_VERSION}")
+    return document
+
+
+def build_drive_service(credentials=None, http=None):
+    """Build a Drive v3 service from the cached discovery document instead of calling build()."""
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(get_discovery_document(), credentials=credentials, http=http)
+
+
 SERVICE_ACCOUNT_FILE = './secrets/robust-summit-438914-g0-3220fe518938.json'
 # Authenticate using the service account
 def authenticate_service_account():
+    from google.oauth2 import service_account
+
     creds = service_account.Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    service = build('drive', 'v3', credentials=creds)
+    service = build_drive_service(credentials=creds)
     return service
 
 def authenticate():
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+
     creds = None
     # Check if token file already exists (to avoid re-authentication)
     if os.path.exists('token.json'):
@@ -39,12 +109,88 @@ def authenticate():
                 './secrets/my_secret.json', SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for future runs
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        save_token(creds)
     return creds
 
 
-# Create a separate service instance for each task
+def save_token(creds):
+    with open('token.json', 'w') as token:
+        token.write(creds.to_json())
+
+
+# Credentials and services shared by every task in the process
+_credentials = None
+_credentials_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_thread_local = threading.local()
+
+
+def _make_refresh_single_flight(creds):
+    # Only one thread refreshes the token; the others wait and then reuse the refreshed token
+    refresh = creds.refresh
+
+    def refresh_once(request):
+        # A token can be rejected with 401 before its local expiry, so validity alone doesn't skip the refresh;
+        # only a token replaced by another thread while this one waited for the lock does
+        seen_token = creds.token
+        with _refresh_lock:
+            if creds.valid and creds.token != seen_token:
+                return
+            refresh(request)
+            save_token(creds)
+
+    creds.refresh = refresh_once
+
+
+def get_credentials():
+    """Return the process-wide credentials, authenticating only on first use."""
+    global _credentials
+    if _credentials is None:
+        with _credentials_lock:
+            if _credentials is None and get_api_root_url_override():
+                from google.auth.credentials import AnonymousCredentials
+
+                _credentials = AnonymousCredentials()
+            if _credentials is None:
+                creds = authenticate()
+                _make_refresh_single_flight(creds)
+                _credentials = creds
+    return _credentials
+
+
+def get_service():
+    """Return the Drive service of the calling thread.
+
+    httplib2 connections are not thread-safe, so each worker thread keeps its own service and
+    keep-alive HTTP connection. The pool is bounded by the size of the executor running the tasks.
+    """
+    service = getattr(_thread_local, 'service', None)
+    if service is None:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+
+        raw_http = httplib2.Http()
+        # Drive answers unfinished resumable upload chunks with 308, which is not a redirect there
+        raw_http.redirect_codes = raw_http.redirect_codes - {308}
+        http = AuthorizedHttp(get_credentials(), http=raw_http)
+        service = build_drive_service(http=http)
+        _thread_local.http = http
+        _thread_local.service = service
+    return service
+
+
+def get_http():
+    """Return the calling thread's authorized keep-alive HTTP object, for requests the service can't make."""
+    get_service()
+    return _thread_local.http
+
+
+def get_api_base_url():
+    # e.g. https://www.googleapis.com/drive/v3/
+    document = get_discovery_document()
+    return document['rootUrl'] + document['servicePath']
+
+
+# Kept for existing callers; returns the calling thread's shared service
 def create_service():
-    credentials = authenticate()  # This function should return credentials
-    return build('drive', 'v3', credentials=credentials)
\ No newline at end of file
+    return get_service()
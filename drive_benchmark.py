@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from DownloadScheduler import POLICIES
+from FakeDriveServer import FakeDriveServer, generate_tree
+from authenticate import API_ROOT_URL_ENV
+
+ROOT_FOLDER_ID = 'root-folder'
+
+
+def report(name, wall_time, server, items, bytes_downloaded=None):
+    stats = server.stats()
+    calls = stats['total_calls'] + stats['throttled']
+    result = {
+        'calls': calls,
+        'throttled': stats['throttled'],
+        'wall_time': wall_time,
+        'items': items,
+        'items_per_second': items / wall_time if wall_time else 0.0,
+    }
+    line = (f"{name:<34} {calls:>7} calls {stats['throttled']:>5} throttled {wall_time:>8.2f} s "
+            f"{result['items_per_second']:>9.1f} items/s")
+    if bytes_downloaded is not None:
+        result['megabytes_per_second'] = bytes_downloaded / 1024 / 1024 / wall_time if wall_time else 0.0
+        line += f" {result['megabytes_per_second']:>8.1f} MB/s"
+    print(line)
+    return result
+
+
+async def run_benchmarks(server, concurrency, queries_per_second, async_http, download_folder, orders=()):
+    # Imported after DRIVE_API_ROOT_URL is set, so every service and client talks to the fake server
+    from AsyncDriveClient import AsyncDriveClient
+    from DownloadScheduler import DownloadScheduler
+    from FileDownloader import FileDownloader
+    from FolderFilesFetcher import FolderFilesFetcher
+    from RateController import RateController
+    from RecursiveFolderFetcher import RecursiveFolderFetcher
+    from RecusiveFileFetch import RecursiveFileFetch
+    from authenticate import get_service
+
+    def new_controller():
+        # A fresh budget per measurement, so one run's backoff doesn't slow the next
+        return RateController(initial_limit=concurrency, max_limit=concurrency, queries_per_second=queries_per_second)
+
+    client = AsyncDriveClient(max_connections=concurrency) if async_http else None
+    if client is not None:
+        await client.open()
+
+    results = {}
+    try:
+        for batch_parents in (False, True):
+            name = f"RecursiveFolderFetcher{' batched' if batch_parents else ''}"
+            folder_fetcher = RecursiveFolderFetcher(max_concurrent_calls=concurrency, batch_parents=batch_parents,
+                                                    client=client, controller=new_controller())
+            server.reset_stats()
+            start = time.perf_counter()
+            await folder_fetcher.fetch_all_folders(ROOT_FOLDER_ID)
+            results[name] = report(name, time.perf_counter() - start, server, len(folder_fetcher.all_folders))
+
+        for batch_parents in (False, True):
+            name = f"FolderFilesFetcher{' batched' if batch_parents else ''}"
+            file_fetcher = FolderFilesFetcher(folder_fetcher.all_folders, max_concurrent_calls=concurrency,
+                                              batch_parents=batch_parents, client=client, controller=new_controller())
+            server.reset_stats()
+            start = time.perf_counter()
+            await file_fetcher.fetch_all_files()
+            results[name] = report(name, time.perf_counter() - start, server, len(file_fetcher.final_file_list))
+
+        for strategy in ('recursive', 'flat'):
+            name = f"RecursiveFileFetch {strategy}"
+            recursive_fetcher = RecursiveFileFetch(service=get_service())
+            server.reset_stats()
+            start = time.perf_counter()
+            try:
+                all_files = await asyncio.get_event_loop().run_in_executor(
+                    None, lambda: recursive_fetcher.list_all_files(
+                        ROOT_FOLDER_ID, output_file=os.path.join(download_folder, 'all_files.txt'), strategy=strategy
+                    )
+                )
+            except Exception as e:
+                # This fetcher makes plain blocking calls without the rate controller, so throttling ends the run
+                print(f"{name:<34} failed: {e}")
+                results[name] = {'error': str(e)}
+                continue
+            results[name] = report(name, time.perf_counter() - start, server, len(all_files))
+
+        name = f"FileDownloader{' async-http' if async_http else ''}"
+        file_downloader = FileDownloader(os.path.join(download_folder, 'files'), client=client,
+                                         max_concurrent_downloads=concurrency, controller=new_controller())
+        os.makedirs(file_downloader.sync_folder, exist_ok=True)
+        server.reset_stats()
+        start = time.perf_counter()
+        await file_downloader.download_all_files_async(file_fetcher.final_file_list, file_fetcher.file_metadata)
+        wall_time = time.perf_counter() - start
+        results[name] = report(name, wall_time, server, len(file_fetcher.final_file_list),
+                               server.stats()['bytes_served'])
+
+        for order in orders:
+            name = f"DownloadScheduler {order}"
+            file_downloader = FileDownloader(os.path.join(download_folder, order), client=client,
+                                             max_concurrent_downloads=concurrency, controller=new_controller())
+            export_workers = max(1, concurrency // 4)
+            scheduler = DownloadScheduler(file_downloader, policy=order, export_workers=export_workers,
+                                          binary_workers=concurrency - export_workers)
+            server.reset_stats()
+            start = time.perf_counter()
+            await scheduler.run(file_fetcher.final_file_list, file_fetcher.file_metadata)
+            wall_time = time.perf_counter() - start
+            results[name] = report(name, wall_time, server, len(file_fetcher.final_file_list),
+                                   server.stats()['bytes_served'])
+    finally:
+        if client is not None:
+            await client.close()
+    return results
+
+
+def main(depth=3, fan_out=4, files_per_folder=10, size_distribution='lognormal', mean_size=256 * 1024,
+         latency=0.02, throttle_rate=0.0, concurrency=20, queries_per_second=1000, async_http=False, orders=()):
+    """Run the listing and download stages against a fake Drive server holding a synthetic tree."""
+    items = generate_tree(depth=depth, fan_out=fan_out, files_per_folder=files_per_folder,
+                          size_distribution=size_distribution, mean_size=mean_size, root_id=ROOT_FOLDER_ID)
+    total_size = sum(int(item.get('size', 0)) for item in items)
+    print(f"Synthetic tree: {len(items)} items, {total_size / 1024 / 1024:.1f} MB of binary content, "
+          f"latency {latency * 1000:.0f} ms, throttle rate {throttle_rate:.0%}, concurrency {concurrency}")
+
+    download_folder = tempfile.mkdtemp(prefix='drive_benchmark_')
+    try:
+        with FakeDriveServer(items, latency=latency, throttle_rate=throttle_rate) as server:
+            os.environ[API_ROOT_URL_ENV] = server.root_url
+            return asyncio.run(run_benchmarks(server, concurrency, queries_per_second, async_http, download_folder,
+                                              orders))
+    finally:
+        shutil.rmtree(download_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark listing and downloads against a local fake Drive")
+    parser.add_argument('--depth', type=int, default=3, help="Levels of folders below the root")
+    parser.add_argument('--fan-out', type=int, default=4, help="Subfolders per folder")
+    parser.add_argument('--files-per-folder', type=int, default=10)
+    parser.add_argument('--size-distribution', choices=['fixed', 'uniform', 'lognormal'], default='lognormal')
+    parser.add_argument('--mean-size', type=int, default=256 * 1024, help="Mean size of binary files in bytes")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds the server waits before each response")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Share of requests answered with 403 rateLimitExceeded or 429")
+    parser.add_argument('--concurrency', type=int, default=20, help="Parallel listing calls and downloads")
+    parser.add_argument('--qps', type=float, default=1000, help="Request rate allowed by the rate controller")
+    parser.add_argument('--async-http', action='store_true', help="Use the native asyncio HTTP client")
+    parser.add_argument('--order', nargs='+', default=[], choices=POLICIES,
+                        help="Also download with DownloadScheduler under each of these policies")
+    parser.add_argument('--json', action='store_true', help="Also print the results as JSON")
+    args = parser.parse_args()
+
+    benchmark_results = main(depth=args.depth, fan_out=args.fan_out, files_per_folder=args.files_per_folder,
+                             size_distribution=args.size_distribution, mean_size=args.mean_size,
+                             latency=args.latency, throttle_rate=args.throttle_rate, concurrency=args.concurrency,
+                             queries_per_second=args.qps, async_http=args.async_http, orders=args.order)
+    if args.json:
+        print(json.dumps(benchmark_results))
@@ -0,0 +1,232 @@
+# Helpers for building Drive `q` expressions shared by the listing fetchers
+import re
+import time
+from datetime import datetime, timezone
+
+# Default upper bound for a packed query. googleapiclient sends long queries as POST, but Drive rejects
+# queries with too many clauses, so keep the packed OR list well below that.
+DEFAULT_MAX_QUERY_LENGTH = 5000
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# File types the sync downloads
+SUPPORTED_MIME_TYPES = [
+    "text/plain",
+    "application/vnd.google-apps.document",  # Google Docs
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",  # Word Document
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",  # Excel Spreadsheet
+    "application/pdf",  # PDF
+    "application/vnd.google-apps.presentation",  # Google Slides
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",  # PowerPoint Presentation
+    "application/vnd.google-apps.spreadsheet",  # Google Sheets
+    "application/json"  # JSON
+]
+
+
+def drive_time(timestamp):
+    # Drive reads zone-less times in queries as UTC
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.timestamp()
+    if isinstance(timestamp, str):
+        return timestamp  # Already RFC 3339, e.g. '2024-10-01' or '2024-10-01T12:00:00Z'
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp))
+
+
+def parse_drive_time(value):
+    # RFC 3339 as Drive returns and drive_time() writes it; zone-less times are UTC
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+def quote(value):
+    # String literals in queries escape backslashes and single quotes
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def parents_clause(folder_ids):
+    return " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids)
+
+
+def parents_query(base_query, folder_ids):
+    """Combine a base query with an OR of parent clauses for the given folder ids."""
+    return f"({base_query}) and ({parents_clause(folder_ids)})"
+
+
+def batch_parent_ids(folder_ids, base_query, max_query_length=DEFAULT_MAX_QUERY_LENGTH):
+    """Split folder ids into batches whose packed parents query stays within max_query_length."""
+    batch = []
+    query_length = len(parents_query(base_query, []))
+
+    for folder_id in folder_ids:
+        clause_length = len(f"'{folder_id}' in parents") + (len(" or ") if batch else 0)
+        if batch and query_length + clause_length > max_query_length:
+            yield batch
+            batch = []
+            query_length = len(parents_query(base_query, []))
+            clause_length = len(f"'{folder_id}' in parents")
+        batch.append(folder_id)
+        query_length += clause_length
+
+    if batch:
+        yield batch
+
+
+class DriveQuery:
+    """Filters for a files().list call, pushed into the `q` expression and fields mask where Drive can apply them.
+
+    mime_types, modified_after/modified_before, name_contains (Drive matches it against the start of the
+    words in a name), owner and excluded_parents run on the server. min_size/max_size and name_pattern (a
+    regex) have no query term and are checked by matches() on the returned items; client_predicates lists
+    them, so a caller can see what still costs listing pages. excluded_parents that don't fit in
+    max_query_length are checked on the client too. accepts() checks every predicate, for items that didn't
+    come from a listing with this query, e.g. the files of the Changes feed.
+    """
+
+    def __init__(self, mime_types=None, modified_after=None, modified_before=None, name_contains=None, owner=None,
+                 min_size=None, max_size=None, name_pattern=None, excluded_parents=(), trashed=False,
+                 max_query_length=DEFAULT_MAX_QUERY_LENGTH):
+        self.mime_types = list(mime_types) if mime_types is not None else list(SUPPORTED_MIME_TYPES)
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        self.name_contains = name_contains
+        self.owner = owner
+        self.min_size = min_size
+        self.max_size = max_size
+        self.name_pattern = re.compile(name_pattern) if isinstance(name_pattern, str) else name_pattern
+        self.excluded_parents = list(excluded_parents)
+        self.trashed = trashed
+        self.max_query_length = max_query_length
+
+        self.server_predicates = []
+        clauses = []
+        if self.mime_types:
+            clauses.append(" or ".join(f"mimeType='{mime_type}'" for mime_type in self.mime_types))
+            self.server_predicates.append('mimeType')
+        if modified_after is not None:
+            clauses.append(f"modifiedTime > '{drive_time(modified_after)}'")
+            self.server_predicates.append('modifiedTime >')
+        if modified_before is not None:
+            clauses.append(f"modifiedTime < '{drive_time(modified_before)}'")
+            self.server_predicates.append('modifiedTime <')
+        if name_contains:
+            clauses.append(f"name contains {quote(name_contains)}")
+            self.server_predicates.append('name contains')
+        if owner:
+            clauses.append(f"{quote(owner)} in owners")
+            self.server_predicates.append('owner')
+        if not trashed:
+            clauses.append("trashed=false")
+
+        # Exclusions fill whatever room the rest of the query leaves; parents clauses of packed queries come
+        # on top, so keep half of the budget for them
+        base = " and ".join(f"({clause})" if " or " in clause else clause for clause in clauses)
+        self.client_excluded_parents = set()
+        pushed = []
+        for parent_id in self.excluded_parents:
+            clause = f"not '{parent_id}' in parents"
+            if len(base) + len(" and ".join(pushed + [clause])) + 5 > max_query_length // 2:
+                self.client_excluded_parents.add(parent_id)
+            else:
+                pushed.append(clause)
+        if pushed:
+            clauses.extend(pushed)
+            self.server_predicates.append(f'excluded parents ({len(pushed)})')
+        self.base_query = " and ".join(f"({clause})" if " or " in clause else clause for clause in clauses)
+
+        self.client_predicates = []
+        if min_size is not None or max_size is not None:
+            self.client_predicates.append('size')
+        if self.name_pattern is not None:
+            self.client_predicates.append('name pattern')
+        if self.client_excluded_parents:
+            self.client_predicates.append(f'excluded parents ({len(self.client_excluded_parents)})')
+
+    @classmethod
+    def folders(cls, **kwargs):
+        return cls(mime_types=[FOLDER_MIME_TYPE], **kwargs)
+
+    def q(self, folder_ids=None):
+        """The `q` expression, limited to children of one folder id or several (a packed parents query)."""
+        if folder_ids is None:
+            return self.base_query
+        if isinstance(folder_ids, str):
+            return f"{self.base_query} and '{folder_ids}' in parents"
+        return parents_query(self.base_query, folder_ids)
+
+    def fields(self, fields):
+        """Fields mask of a list call for the given item fields, plus those the client-side predicates need."""
+        names = [name.strip() for name in fields.split(',')]
+        if self.min_size is not None or self.max_size is not None:
+            names.append('size')
+        if self.name_pattern is not None:
+            names.append('name')
+        if self.client_excluded_parents:
+            names.append('parents')
+        return f"nextPageToken, files({', '.join(dict.fromkeys(names))})"
+
+    def matches(self, item):
+        """Check an item against the predicates the server couldn't apply."""
+        size = item.get('size')
+        # Google-native documents have no size and always pass
+        if self.min_size is not None and size is not None and int(size) < self.min_size:
+            return False
+        if self.max_size is not None and size is not None and int(size) > self.max_size:
+            return False
+        if self.name_pattern is not None and not self.name_pattern.search(item['name']):
+            return False
+        if self.client_excluded_parents and self.client_excluded_parents & set(item.get('parents', [])):
+            return False
+        return True
+
+    def accepts(self, item):
+        """Check an item against all predicates, those Drive applies to listings included."""
+        if self.mime_types and item.get('mimeType') not in self.mime_types:
+            return False
+        if not self.trashed and item.get('trashed'):
+            return False
+        modified_time = parse_drive_time(item['modifiedTime']) if item.get('modifiedTime') else None
+        if self.modified_after is not None and (
+                modified_time is None or modified_time <= parse_drive_time(drive_time(self.modified_after))):
+            return False
+        if self.modified_before is not None and (
+                modified_time is None or modified_time >= parse_drive_time(drive_time(self.modified_before))):
+            return False
+        if self.name_contains:
+            # Drive matches the start of words, case-insensitively
+            prefix = self.name_contains.lower()
+            if not any(word.startswith(prefix) for word in re.findall(r'\w+', item.get('name', '').lower())):
+                return False
+        if self.owner and self.owner not in [owner.get('emailAddress') for owner in item.get('owners', [])]:
+            return False
+        if set(self.excluded_parents) & set(item.get('parents', [])):
+            return False
+        return self.matches(item)
+
+    def filter(self, items):
+        if not self.client_predicates:
+            return items
+        return [item for item in items if self.matches(item)]
+
+    def excluding(self, parent_ids):
+        """A copy of this query that also leaves out the children of parent_ids, e.g. a known excluded subtree."""
+        return DriveQuery(self.mime_types, self.modified_after, self.modified_before, self.name_contains, self.owner,
+                          self.min_size, self.max_size, self.name_pattern, self.excluded_parents + list(parent_ids),
+                          self.trashed, self.max_query_length)
+
+    def settings(self):
+        """The filters as JSON-serializable keyword arguments, e.g. to save them with the sync state."""
+        return {
+            'mime_types': self.mime_types,
+            'modified_after': drive_time(self.modified_after) if self.modified_after is not None else None,
+            'modified_before': drive_time(self.modified_before) if self.modified_before is not None else None,
+            'name_contains': self.name_contains, 'owner': self.owner, 'min_size': self.min_size,
+            'max_size': self.max_size, 'name_pattern': self.name_pattern.pattern if self.name_pattern else None,
+            'excluded_parents': self.excluded_parents, 'trashed': self.trashed,
+        }
+
+    @classmethod
+    def from_settings(cls, settings, max_query_length=DEFAULT_MAX_QUERY_LENGTH):
+        return cls(max_query_length=max_query_length, **settings)
+
+    def report(self):
+        return f"server: {', '.join(self.server_predicates) or '-'}; client: {', '.join(self.client_predicates) or '-'}"
@@ -1,9 +1,7 @@
-from authenticate import authenticate
-from googleapiclient.discovery import build
+from authenticate import get_service
 
 def get_file_by_id(file_id):
-    creds = authenticate()
-    service = build('drive', 'v3', credentials=creds)
+    service = get_service()
 
     try:
         # Fetch the file metadata, supporting shared drives
@@ -18,8 +16,7 @@ def get_file_by_id(file_id):
 
 
 def list_my_drive_files():
-    creds = authenticate()
-    service = build('drive', 'v3', credentials=creds)
+    service = get_service()
 
     # Call the Drive API to list files only from "My Drive", excluding shared drives
     results = service.files().list(
@@ -1,17 +1,99 @@
-from FileDownloader import FileDownloader
+from AsyncDriveClient import AsyncDriveClient
+from ChangesSync import ChangesSync
+from ContentExtractor import ContentExtractor
+from ContentStore import ContentStore
+from DownloadScheduler import POLICIES, DownloadScheduler
+from ExportCache import ExportCache
+from Metrics import get_default_metrics
+from RateController import get_default_controller
+from FileDownloader import GOOGLE_NATIVE_PREFIX, FileDownloader
+from FileUploader import FileUploader
 from FolderFilesFetcher import FolderFilesFetcher
+from FolderTreeCache import FolderTreeCache
+from MetadataIndex import MetadataIndex
 from RecursiveFolderFetcher import RecursiveFolderFetcher
+from ShardLedger import ShardLedger
+from ShardWorker import run_local_workers
+from drive_query import DriveQuery
+from SyncManifest import SyncManifest
+from SyncPipeline import SyncPipeline
+import argparse
 import asyncio
+import os
 
-async def main():
+# Concurrency with googleapiclient is bounded by one thread per request; the native client is not
+THREADED_CONCURRENCY = 20
+ASYNC_CONCURRENCY = 100
+
+
+ROOT_FOLDER_ID = '1VWELDrSkd1wAbR-L8sho4-eVQmNpxRx8'  # Kinit guidelines
+SYNC_FOLDER = './guidelines'
+LEDGER_FILE = 'sync_ledger.sqlite'
+
+
+def parse_export_formats(values):
+    # 'document=text/plain' or 'application/vnd.google-apps.document=text/plain' -> {native type: export type}
+    export_formats = {}
+    for value in values or []:
+        native_mime_type, _, export_mime_type = value.partition('=')
+        if '/' not in native_mime_type:
+            native_mime_type = GOOGLE_NATIVE_PREFIX + native_mime_type
+        export_formats[native_mime_type] = export_mime_type
+    return export_formats
+
+
+async def sync(full_sync, batch_parents, pipeline, client, concurrency, *, root_folder_id=ROOT_FOLDER_ID, order=None,
+               export_formats=None, refresh_tree=False, shards=None, local_workers=None, ledger_file=LEDGER_FILE,
+               extract=False, query=None, excluded_folders=()):
+    # Every listing page and download outcome is recorded in the SQLite index for later runs and tooling
+    index = MetadataIndex()
+
+    # File downloading
+    sync_folder = SYNC_FOLDER
+    # Identical files copied into many folders are downloaded once and hardlinked from the content store
+    content_store = ContentStore(os.path.join(sync_folder, '.content_store'))
+    # Google-native documents are exported once per version and format
+    export_cache = ExportCache(os.path.join(sync_folder, '.export_cache'))
+    # Text of synced documents is extracted in a process pool while the downloads go on
+    extractor = ContentExtractor(os.path.join(sync_folder, '.extracted'), index=index) if extract else None
+    file_downloader = FileDownloader(sync_folder=sync_folder, manifest=SyncManifest(), client=client,
+                                     max_concurrent_downloads=concurrency, content_store=content_store, index=index,
+                                     export_cache=export_cache, export_formats=export_formats, extractor=extractor)
     try:
-        # Initialize RecursiveFolderFetcher to get all folder IDs
-        folder_fetcher = RecursiveFolderFetcher(max_concurrent_calls=20)
-        root_folder_id = '1VWELDrSkd1wAbR-L8sho4-eVQmNpxRx8'  # Kinit guidelines
+        # After the first full sync, only apply the changes reported by the Drive Changes feed
+        changes_sync = ChangesSync(root_folder_id, file_downloader, max_concurrent_calls=concurrency, client=client,
+                                   index=index, query=query, excluded_folders=excluded_folders)
+        if not full_sync and changes_sync.has_state():
+            await changes_sync.sync_changes()
+            # Blobs of files deleted or replaced by the changes are no longer linked from the sync folder
+            content_store.collect_garbage()
+            return
+
+        # Take the changes token before crawling, so changes made during the crawl are picked up next run
+        start_page_token = changes_sync.get_start_page_token()
+
+        if pipeline:
+            # Crawl, list and download concurrently instead of in three phases
+            sync_pipeline = SyncPipeline(root_folder_id, file_downloader, max_concurrent_calls=concurrency,
+                                         download_workers=concurrency, client=client, index=index, query=query,
+                                         excluded_folders=excluded_folders)
+            # Raises when a folder couldn't be listed, so an incomplete tree isn't saved as the sync state
+            await sync_pipeline.run()
+            changes_sync.record_full_sync(start_page_token, sync_pipeline.folder_fetcher, sync_pipeline.file_fetcher)
+            content_store.collect_garbage()
+            return
+
+        # Initialize RecursiveFolderFetcher to get all folder IDs; subtrees unchanged since the last crawl come from
+        # the tree cache
+        tree_cache = FolderTreeCache(force_refresh=refresh_tree)
+        folder_fetcher = RecursiveFolderFetcher(max_concurrent_calls=concurrency, batch_parents=batch_parents,
+                                                client=client, index=index, tree_cache=tree_cache,
+                                                excluded_folders=excluded_folders)
         await folder_fetcher.fetch_all_folders(root_folder_id)
 
         # Initialize FolderFilesFetcher with folder IDs and names collected from RecursiveFolderFetcher
-        file_fetcher = FolderFilesFetcher(folder_ids=folder_fetcher.all_folders, max_concurrent_calls=20)
+        file_fetcher = FolderFilesFetcher(folder_ids=folder_fetcher.all_folders, max_concurrent_calls=concurrency,
+                                          batch_parents=batch_parents, client=client, index=index, query=query)
 
         # Run asynchronous fetching of all files
         await file_fetcher.fetch_all_files()
@@ -21,15 +103,149 @@ async def main():
         for file_name, file_id, mime_type, folder_name in file_fetcher.final_file_list:
             print(f"File Name: {file_name}, File ID: {file_id}, MIME Type: {mime_type}, Folder: {folder_name}")
 
-        # File downloading
-        sync_folder = './guidelines'
-        file_downloader = FileDownloader(sync_folder=sync_folder)
-
         # Run asynchronous download of all files
-        await file_downloader.download_all_files_async(file_fetcher.final_file_list)
+        failed_ids = None  # Files to download again next run; by default those file_downloader failed on
+        if shards:
+            # Hand the listing to worker processes on this host through the shared ledger
+            ledger = ShardLedger(ledger_file)
+            ledger.add(file_fetcher.final_file_list, file_fetcher.file_metadata, shards)
+            print(f"Ledger {ledger_file}: {ledger.progress()}")
+            ledger.close()
+            worker_shards = range(shards if local_workers is None else local_workers)
+            if worker_shards:
+                exit_codes = await asyncio.get_event_loop().run_in_executor(
+                    None, lambda: run_local_workers(ledger_file, shards, sync_folder, worker_shards=worker_shards,
+                                                    async_http=client is not None, concurrency=concurrency,
+                                                    export_formats=export_formats, extract=extract)
+                )
+                print(f"Shard workers exited with {exit_codes}")
+            ledger = ShardLedger(ledger_file)
+            failed_ids = ledger.failed_ids()
+            ledger.close()
+        elif order:
+            # Ordered downloads, with exports and binary files in separate lanes
+            file_groups = DownloadScheduler.top_level_groups(file_fetcher.file_parents, folder_fetcher.folder_parents,
+                                                             root_folder_id)
+            export_workers = max(1, concurrency // 4)
+            scheduler = DownloadScheduler(file_downloader, policy=order, export_workers=export_workers,
+                                          binary_workers=concurrency - export_workers, file_groups=file_groups)
+            await scheduler.run(file_fetcher.final_file_list, file_fetcher.file_metadata)
+        else:
+            await file_downloader.download_all_files_async(file_fetcher.final_file_list, file_fetcher.file_metadata)
+
+        # Save the token and tree so the next run can sync incrementally
+        changes_sync.record_full_sync(start_page_token, folder_fetcher, file_fetcher, failed_ids)
+        # Workers run elsewhere may still be linking blobs
+        if not shards or local_workers is None:
+            content_store.collect_garbage()
+    finally:
+        if extractor is not None:
+            extractor.close()
+        # After the extractor, which records its results in the index
+        index.close()
+
+
+async def upload(local_folder, root_folder_id=ROOT_FOLDER_ID, concurrency=THREADED_CONCURRENCY, refresh_tree=False):
+    # The folder-id map comes from a crawl of the target tree, mostly from the tree cache after a sync
+    folder_fetcher = RecursiveFolderFetcher(max_concurrent_calls=concurrency, batch_parents=True,
+                                            tree_cache=FolderTreeCache(force_refresh=refresh_tree))
+    await folder_fetcher.fetch_all_folders(root_folder_id)
+
+    # Uploads run in googleapiclient threads, also with --async-http
+    file_uploader = FileUploader(root_folder_id, folder_fetcher, max_concurrent_uploads=concurrency)
+    await file_uploader.upload_folder(local_folder)
+
+
+async def main(*, full_sync=False, batch_parents=False, pipeline=False, async_http=False, root_folder_id=ROOT_FOLDER_ID,
+               metrics_file=None, trace_file=None, upload_folder=None, **sync_options):
+    """Run a sync and the optional upload. sync_options are the keyword-only options of sync()."""
+    metrics = get_default_metrics()
+    metrics.trace = trace_file is not None
+    try:
+        if async_http:
+            async with AsyncDriveClient(max_connections=ASYNC_CONCURRENCY) as client:
+                await sync(full_sync, batch_parents, pipeline, client, ASYNC_CONCURRENCY,
+                           root_folder_id=root_folder_id, **sync_options)
+        else:
+            await sync(full_sync, batch_parents, pipeline, None, THREADED_CONCURRENCY, root_folder_id=root_folder_id,
+                       **sync_options)
+        if upload_folder:
+            # Push local artifacts back into the synced tree
+            await upload(upload_folder, root_folder_id=root_folder_id, concurrency=THREADED_CONCURRENCY,
+                         refresh_tree=sync_options.get('refresh_tree', False))
+        print(f"API usage: {get_default_controller().stats()}")
 
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        # Written even for a failed run, which is when they are most useful
+        if metrics_file:
+            metrics.write(metrics_file)
+        if trace_file:
+            metrics.write_trace(trace_file)
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Sync the guidelines folder from Google Drive",
+                                     epilog="Listing filters and excluded folders are saved with the sync state and "
+                                            "apply to the incremental runs after a full sync; changing them needs "
+                                            "--full.")
+    parser.add_argument('--full', action='store_true', help="Ignore saved sync state and re-crawl the whole tree")
+    parser.add_argument('--batch-parents', action='store_true',
+                        help="Pack many folder ids into each listing query to cut API calls on wide trees")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Start downloading while the tree is still being crawled (ignores --batch-parents)")
+    parser.add_argument('--async-http', action='store_true',
+                        help="Use the native asyncio HTTP client (needs httpx) instead of googleapiclient threads")
+    parser.add_argument('--root-folder', default=ROOT_FOLDER_ID,
+                        help="Folder to sync, e.g. 'root-folder' when DRIVE_API_ROOT_URL points at FakeDriveServer")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="Write request latencies, retries, bytes and queue depths (.json, or Prometheus text)")
+    parser.add_argument('--trace', metavar='FILE', help="Record a span per request and write a Chrome trace")
+    parser.add_argument('--order', choices=POLICIES,
+                        help="Download order of a full sync, with separate lanes for exports and binary files")
+    parser.add_argument('--export-format', action='append', metavar='TYPE=FORMAT',
+                        help="Export a Google-native type in another format, e.g. document=text/plain; repeatable")
+    parser.add_argument('--refresh-tree', action='store_true',
+                        help="List every folder again instead of reusing unchanged subtrees from the tree cache")
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help="Split the downloads of a full sync over N worker processes via a shared ledger")
+    parser.add_argument('--local-workers', type=int, metavar='M',
+                        help="With --shards, run workers for shards 0..M-1 here (default all; 0 only fills the ledger)")
+    parser.add_argument('--shard-worker', type=int, action='append', metavar='K',
+                        help="Only run the worker of shard K against an existing ledger, e.g. from another terminal; "
+                             "repeatable")
+    parser.add_argument('--ledger', default=LEDGER_FILE, metavar='FILE',
+                        help="Shard ledger; SQLite in WAL mode, so on a local disk, not a network filesystem")
+    parser.add_argument('--extract', action='store_true',
+                        help="Extract the text of synced docx/xlsx/pptx/pdf files into the index and .extracted")
+    parser.add_argument('--modified-after', metavar='TIME',
+                        help="Only list files modified after an RFC 3339 time, e.g. 2024-10-01")
+    parser.add_argument('--name-contains', metavar='TEXT',
+                        help="Only list files with a name (or a word in it) starting with TEXT")
+    parser.add_argument('--owner', metavar='EMAIL', help="Only list files owned by EMAIL")
+    parser.add_argument('--min-size', type=int, metavar='BYTES', help="Skip smaller binary files")
+    parser.add_argument('--max-size', type=int, metavar='BYTES', help="Skip larger binary files")
+    parser.add_argument('--name-pattern', metavar='REGEX', help="Only sync files whose name matches REGEX")
+    parser.add_argument('--exclude-folder', action='append', default=[], metavar='ID',
+                        help="Leave out a folder and its subtree; repeatable")
+    parser.add_argument('--upload', metavar='FOLDER',
+                        help="After syncing, upload new and changed files of a local folder into the root folder")
+    args = parser.parse_args()
+    if args.shard_worker:
+        if not args.shards:
+            parser.error("--shard-worker needs --shards, the total number of shards")
+        run_local_workers(args.ledger, args.shards, SYNC_FOLDER, worker_shards=args.shard_worker,
+                          async_http=args.async_http,
+                          concurrency=ASYNC_CONCURRENCY if args.async_http else THREADED_CONCURRENCY,
+                          export_formats=parse_export_formats(args.export_format), extract=args.extract)
+    else:
+        asyncio.run(main(full_sync=args.full, batch_parents=args.batch_parents, pipeline=args.pipeline,
+                         async_http=args.async_http, root_folder_id=args.root_folder, metrics_file=args.metrics,
+                         trace_file=args.trace, order=args.order,
+                         export_formats=parse_export_formats(args.export_format), refresh_tree=args.refresh_tree,
+                         shards=args.shards, local_workers=args.local_workers, ledger_file=args.ledger,
+                         extract=args.extract,
+                         query=DriveQuery(modified_after=args.modified_after, name_contains=args.name_contains,
+                                          owner=args.owner, min_size=args.min_size, max_size=args.max_size,
+                                          name_pattern=args.name_pattern),
+                         excluded_folders=args.exclude_folder, upload_folder=args.upload))
@@ -0,0 +1,91 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# Each measurement runs in a fresh interpreter, so peak RSS belongs to that listing alone.
+# The service below generates pages on the fly, so the only growing memory is what the listing code keeps.
+LISTING = '''
+import resource
+import sys
+
+from FileFetcher import FileFetcher
+
+TOTAL_FILES = {total_files}
+
+
+class Request:
+    def __init__(self, page):
+        self.page = page
+
+    def execute(self):
+        return self.page
+
+
+class SyntheticFiles:
+    def list(self, pageSize=1000, pageToken=None, **params):
+        start = int(pageToken or 0)
+        end = min(start + pageSize, TOTAL_FILES)
+        page = {{'files': [{{
+            'id': f"{{index:033d}}", 'name': f"Document {{index}}.pdf", 'mimeType': 'application/pdf',
+            'md5Checksum': f"{{index:032x}}", 'modifiedTime': '2024-01-01T00:00:00.000Z', 'version': '3',
+            'size': str(index * 7),
+        }} for index in range(start, end)]}}
+        if end < TOTAL_FILES:
+            page['nextPageToken'] = str(end)
+        return Request(page)
+
+
+class SyntheticService:
+    def files(self):
+        return SyntheticFiles()
+
+
+class Index:
+    # Stands in for MetadataIndex so list_all_files doesn't write all_files.txt
+    def add_items(self, items, parent_id=None):
+        pass
+
+
+sys.stdout = open('/dev/null', 'w')
+fetcher = FileFetcher(SyntheticService(), index=Index())
+count = 0
+if '{mode}' == 'stream':
+    for records in fetcher.iter_pages():
+        count += len(records)
+else:
+    count = len(fetcher.list_all_files())
+sys.stdout = sys.__stdout__
+# ru_maxrss is in KiB on Linux
+print(count, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def measure(mode, total_files):
+    code = LISTING.format(mode=mode, total_files=total_files)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    count, peak_kib = output.strip().splitlines()[-1].split()
+    return int(count), int(peak_kib) / 1024
+
+
+def main(sizes=(10000, 100000, 500000)):
+    """Print the peak RSS of listing with the streaming generator and with the list method, per drive size."""
+    results = {}
+    for total_files in sizes:
+        _, stream_mib = measure('stream', total_files)
+        _, list_mib = measure('list', total_files)
+        results[total_files] = {'stream': stream_mib, 'list': list_mib}
+        print(f"{total_files:>9} files   iter_pages {stream_mib:8.1f} MiB   list_all_files {list_mib:8.1f} MiB")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure peak memory of listing a synthetic drive")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 500000],
+                        help="Number of files in the synthetic drive, one measurement each")
+    parser.add_argument('--json', action='store_true', help="Also print the results as JSON")
+    args = parser.parse_args()
+
+    results = main(sizes=args.sizes)
+    if args.json:
+        print(json.dumps(results))
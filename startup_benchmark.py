@@ -0,0 +1,65 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# Each measurement runs in a fresh interpreter, the way the cron jobs start
+IMPORT_MAIN = '''
+import time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+'''
+
+BUILD_WITH_DISCOVERY = '''
+import time
+start = time.perf_counter()
+import httplib2
+from googleapiclient.discovery import build
+build('drive', 'v3', http=httplib2.Http())
+print(time.perf_counter() - start)
+'''
+
+BUILD_WITH_CACHED_DOCUMENT = '''
+import time
+start = time.perf_counter()
+import httplib2
+from authenticate import build_drive_service
+build_drive_service(http=httplib2.Http())
+print(time.perf_counter() - start)
+'''
+
+
+def measure(code, runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return min(timings), sum(timings) / len(timings)
+
+
+def main(runs=5):
+    """Print the time a fresh process needs to import main.py and to get a ready Drive service."""
+    # Make sure the on-disk discovery cache exists before timing the cached path
+    from authenticate import get_discovery_document
+    get_discovery_document()
+
+    results = {
+        'import main': measure(IMPORT_MAIN, runs),
+        "build('drive', 'v3')": measure(BUILD_WITH_DISCOVERY, runs),
+        'build_drive_service()': measure(BUILD_WITH_CACHED_DOCUMENT, runs),
+    }
+    for name, (best, mean) in results.items():
+        print(f"{name:<24} best {best * 1000:8.1f} ms   mean {mean * 1000:8.1f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure cold start of the sync entry points")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters to start per measurement")
+    parser.add_argument('--json', action='store_true', help="Also print the results as JSON")
+    args = parser.parse_args()
+
+    results = main(runs=args.runs)
+    if args.json:
+        print(json.dumps({name: {'best': best, 'mean': mean} for name, (best, mean) in results.items()}))